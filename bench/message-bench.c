@@ -0,0 +1,155 @@
+/*
+ *  message-bench: micro-benchmark for the message parser and builder
+ *
+ *  Runs the path every channel PRIVMSG takes through chirc (parsing the
+ *  message received from the sender, constructing the message relayed
+ *  to the channel, and serializing it) many times, and reports how long
+ *  each step takes and how many memory allocations it makes.
+ *
+ *  Allocations are counted by interposing malloc and friends, which
+ *  also catches allocations made inside the C library (e.g., by strdup).
+ *  This relies on glibc's __libc_* allocator entry points.
+ *
+ *  Usage: message-bench [ITERATIONS]
+ */
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+
+#include "message.h"
+
+#define ITERATIONS_DEFAULT (1000000)
+
+extern void *__libc_malloc(size_t size);
+extern void *__libc_calloc(size_t nmemb, size_t size);
+extern void *__libc_realloc(void *ptr, size_t size);
+extern void __libc_free(void *ptr);
+
+static unsigned long allocations = 0;
+
+void *malloc(size_t size)
+{
+    allocations++;
+    return __libc_malloc(size);
+}
+
+void *calloc(size_t nmemb, size_t size)
+{
+    allocations++;
+    return __libc_calloc(nmemb, size);
+}
+
+void *realloc(void *ptr, size_t size)
+{
+    allocations++;
+    return __libc_realloc(ptr, size);
+}
+
+void free(void *ptr)
+{
+    __libc_free(ptr);
+}
+
+
+static double now()
+{
+    struct timespec ts;
+
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+
+    return ts.tv_sec + ts.tv_nsec / 1e9;
+}
+
+
+static void report(char *name, long iterations, double elapsed, unsigned long allocs)
+{
+    printf("%-32s %10.1f ns/msg %8.2f allocs/msg\n",
+           name, elapsed * 1e9 / iterations, (double) allocs / iterations);
+}
+
+
+int main(int argc, char *argv[])
+{
+    char *line = "PRIVMSG #chirc :Hello, how are you?\r\n";
+    char *prefix = "jrandom!jrandom@client.example.com";
+    char inbuf[MSG_MAX + 1], outbuf[MSG_MAX + 1];
+    chirc_message_t msg, relay;
+    size_t linelen, outlen, total = 0;
+    unsigned long allocs;
+    long iterations = ITERATIONS_DEFAULT;
+    double start;
+
+    if (argc > 1)
+        iterations = atol(argv[1]);
+    if (iterations <= 0)
+    {
+        fprintf(stderr, "Usage: %s [ITERATIONS]\n", argv[0]);
+        exit(-1);
+    }
+
+    linelen = strlen(line);
+
+    /* Parsing in place (as done with messages read from a connection) */
+    allocs = allocations;
+    start = now();
+    for (long i = 0; i < iterations; i++)
+    {
+        memcpy(inbuf, line, linelen);
+        chirc_message_parse(&msg, inbuf, linelen - 2);
+        total += msg.nparams;
+        chirc_message_free(&msg);
+    }
+    report("chirc_message_parse", iterations, now() - start, allocations - allocs);
+
+    allocs = allocations;
+    start = now();
+    for (long i = 0; i < iterations; i++)
+    {
+        chirc_message_from_string(&msg, line);
+        total += msg.nparams;
+        chirc_message_free(&msg);
+    }
+    report("chirc_message_from_string", iterations, now() - start, allocations - allocs);
+
+    /* Constructing and serializing the relayed message */
+    memcpy(inbuf, line, linelen);
+    chirc_message_parse(&msg, inbuf, linelen - 2);
+
+    allocs = allocations;
+    start = now();
+    for (long i = 0; i < iterations; i++)
+    {
+        chirc_message_construct(&relay, prefix, msg.cmd);
+        chirc_message_add_parameter(&relay, msg.params[0], false);
+        chirc_message_add_parameter(&relay, msg.params[1], true);
+        chirc_message_serialize(&relay, outbuf, sizeof(outbuf), &outlen);
+        total += outlen;
+        chirc_message_free(&relay);
+    }
+    report("construct + serialize", iterations, now() - start, allocations - allocs);
+
+    /* The whole path */
+    allocs = allocations;
+    start = now();
+    for (long i = 0; i < iterations; i++)
+    {
+        memcpy(inbuf, line, linelen);
+        chirc_message_parse(&msg, inbuf, linelen - 2);
+        chirc_message_construct(&relay, prefix, msg.cmd);
+        chirc_message_add_parameter(&relay, msg.params[0], false);
+        chirc_message_add_parameter(&relay, msg.params[1], true);
+        chirc_message_serialize(&relay, outbuf, sizeof(outbuf), &outlen);
+        total += outlen;
+        chirc_message_free(&relay);
+        chirc_message_free(&msg);
+    }
+    report("PRIVMSG (parse + relay)", iterations, now() - start, allocations - allocs);
+
+    /* Keeps the compiler from optimizing the loops away */
+    if (total == 0)
+        printf("%s", outbuf);
+
+    return 0;
+}
@@ -9,15 +9,18 @@
 #include "channel.h"
 #include "utils.h"
 #include "chirc.h"
+#include "log.h"
 
 /* See channel.h */
 void chirc_channel_init(chirc_channel_t *channel)
 {
     channel->name = NULL;
+    channel->name_folded = NULL;
     channel->topic = NULL;
     channel->modes[0] = '\0';
 
     channel->users = NULL;
+    pthread_rwlock_init(&channel->lock, NULL);
 }
 
 
@@ -25,10 +28,13 @@ void chirc_channel_init(chirc_channel_t *channel)
 void chirc_channel_free(chirc_channel_t *channel)
 {
     sdsfree(channel->name);
+    sdsfree(channel->name_folded);
     sdsfree(channel->topic);
 
     /* Should only be called when all users have left the channel */
     assert(channel->users == NULL);
+
+    pthread_rwlock_destroy(&channel->lock);
 }
 
 
@@ -67,7 +73,46 @@ int chirc_channel_remove_mode(chirc_channel_t *channel, char mode)
 /* See channel.h */
 int chirc_channel_num_users(chirc_channel_t *channel)
 {
-    return HASH_CNT(hh_from_channel, channel->users);
+    int n;
+
+    pthread_rwlock_rdlock(&channel->lock);
+    n = HASH_CNT(hh_from_channel, channel->users);
+    pthread_rwlock_unlock(&channel->lock);
+
+    return n;
+}
+
+
+/* See channel.h */
+int chirc_channel_send_message(chirc_ctx_t *ctx, chirc_channel_t *channel, chirc_message_t *msg,
+                               chirc_user_t *exclude)
+{
+    chirc_wire_t *wire;
+
+    wire = chirc_message_to_wire(msg);
+    if (!wire)
+        return CHIRC_FAIL;
+
+    /* Messages can be relayed to the same channel by several threads
+     * at once (sending a message only requires the lock of the
+     * connection it is sent through). A user leaves all its channels
+     * before its connection is detached and freed (see
+     * chirc_ctx_detach_user), so the channel's lock keeps the
+     * connections of the users in it from being freed */
+    pthread_rwlock_rdlock(&channel->lock);
+    for (chirc_channeluser_t *cu = channel->users; cu != NULL; cu = cu->hh_from_channel.next)
+    {
+        if (cu->user == exclude || cu->user->conn == NULL)
+            continue;
+
+        if (chirc_connection_send_wire(ctx, cu->user->conn, wire))
+            serverlog(DEBUG, cu->user->conn, "Could not relay message to %s", channel->name);
+    }
+    pthread_rwlock_unlock(&channel->lock);
+
+    chirc_wire_unref(wire);
+
+    return CHIRC_OK;
 }
 
 
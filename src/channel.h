@@ -78,4 +78,23 @@ int chirc_channel_remove_mode(chirc_channel_t *channel, char mode);
 int chirc_channel_num_users(chirc_channel_t *channel);
 
 
+/*! \brief Sends a message to all the users in a channel
+ *
+ * The message is serialized only once, and the same serialized
+ * message is sent to every user in the channel.
+ *
+ * \param ctx Server context
+ * \param channel Channel
+ * \param msg Message to send
+ * \param exclude User that the message should not be sent to
+ *        (typically, the user the message is being relayed from).
+ *        Can be NULL.
+ * \return 0 on success, non-zero on failure (sending the message
+ *         to a user failing is not considered a failure; that user's
+ *         connection will be closed when the failure is detected)
+ */
+int chirc_channel_send_message(chirc_ctx_t *ctx, chirc_channel_t *channel, chirc_message_t *msg,
+                               chirc_user_t *exclude);
+
+
 #endif /* CHANNEL_H_ */
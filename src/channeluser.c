@@ -1,9 +1,11 @@
 /* See channeluser.h for details about the functions in this module */
 
+#include <stdlib.h>
 #include <string.h>
 #include <pthread.h>
 #include "channeluser.h"
 #include "utils.h"
+#include "pool.h"
 
 
 /* See channeluser.h */
@@ -61,7 +63,9 @@ chirc_channeluser_t* chirc_channeluser_get(chirc_channel_t *channel, chirc_user_
 {
     chirc_channeluser_t *channeluser;
 
+    pthread_rwlock_rdlock(&channel->lock);
     HASH_FIND(hh_from_channel,channel->users, &user,sizeof(chirc_user_t *), channeluser);
+    pthread_rwlock_unlock(&channel->lock);
 
     return channeluser;
 }
@@ -72,6 +76,7 @@ bool chirc_channeluser_get_or_create(chirc_channel_t *channel, chirc_user_t *use
 {
     bool created;
 
+    pthread_rwlock_wrlock(&channel->lock);
     HASH_FIND(hh_from_channel,channel->users, &user,sizeof(chirc_user_t *), *channeluser);
     if(*channeluser)
     {
@@ -81,13 +86,16 @@ bool chirc_channeluser_get_or_create(chirc_channel_t *channel, chirc_user_t *use
     {
         created = true;
 
-        *channeluser = malloc(sizeof(chirc_channeluser_t));
+        *channeluser = chirc_pool_alloc(&chirc_channeluser_pool);
         chirc_channeluser_init(*channeluser);
         (*channeluser)->channel = channel;
         (*channeluser)->user = user;
+        pthread_mutex_lock(&user->lock);
         HASH_ADD(hh_from_user, user->channels, channel, sizeof(chirc_channel_t *), *channeluser);
+        pthread_mutex_unlock(&user->lock);
         HASH_ADD(hh_from_channel, channel->users, user, sizeof(chirc_user_t *), *channeluser);
     }
+    pthread_rwlock_unlock(&channel->lock);
 
     return created;
 }
@@ -99,8 +107,12 @@ int chirc_channeluser_remove(chirc_channeluser_t *channeluser)
     chirc_user_t *user = channeluser->user;
     chirc_channel_t *channel = channeluser->channel;
 
+    pthread_rwlock_wrlock(&channel->lock);
     HASH_DELETE(hh_from_channel, channel->users, channeluser);
+    pthread_mutex_lock(&user->lock);
     HASH_DELETE(hh_from_user, user->channels, channeluser);
+    pthread_mutex_unlock(&user->lock);
+    pthread_rwlock_unlock(&channel->lock);
 
     return CHIRC_OK;
 }
\ No newline at end of file
@@ -5,6 +5,7 @@
  *  the server.
  *
  *  - chirc_message_t: An IRC message
+ *  - chirc_wire_t: A serialized IRC message, ready to be sent
  *  - chirc_server_t: An IRC server in an IRC Network
  *  - chirc_user_t: A user connected to an IRC server
  *  - chirc_connection_t: A connection to an IRC server
@@ -18,6 +19,75 @@
  *  all the global state of the server, and it is passed to
  *  practically all functions.
  *
+ *  Locking
+ *  -------
+ *
+ *  When each connection is handled by its own thread, messages are
+ *  processed concurrently, so the server state is protected by several
+ *  locks (instead of a single one, so that, e.g., messages sent to
+ *  unrelated channels can be relayed in parallel):
+ *
+ *  1. chirc_ctx_t.users_lock (read/write): the users (nick) hash table.
+ *  2. chirc_ctx_t.channels_lock (read/write): the channels hash table.
+ *  3. chirc_channel_t.lock (read/write): the channel's users hash table
+ *     (and the rest of the channel's fields).
+ *  4. chirc_user_t.lock: the user's channels hash table (and the rest
+ *     of the user's fields).
+ *  5. chirc_connection_t.send_lock: the connection's send queue.
+ *
+ *  A thread that holds one of these locks may only acquire locks that
+ *  come *after* it in this list (and, if it needs the locks of several
+ *  channels, it must acquire them in increasing order of address). So,
+ *  for example, relaying a QUIT to all the channels a user is in requires
+ *  making a copy of the user's channels (while holding the user's lock),
+ *  and then releasing the user's lock before locking each channel.
+ *
+ *  chirc_ctx_t.connections_lock protects the connections hash table,
+ *  and no other lock may be acquired while holding it.
+ *
+ *  The functions in ctx.h, channel.h, and channeluser.h acquire
+ *  these locks themselves, and release them before returning.
+ *
+ *  Lifetime of users and connections
+ *  ---------------------------------
+ *
+ *  Users are only freed by the thread handling the user's connection,
+ *  once the connection is closed, and channels are only freed when the
+ *  last user leaves the channel (see chirc_ctx_part_channel). So, a
+ *  chirc_channel_t returned by these functions can be used without
+ *  holding any locks as long as the current user is in the channel.
+ *
+ *  Before a user's connection is freed, the user is detached from the
+ *  server (see chirc_ctx_detach_user, which chirc_ctx_remove_connection
+ *  calls), in this order:
+ *
+ *  1. The user is removed from chirc_ctx_t.users (under users_lock).
+ *  2. The user is removed from all its channels (under each channel's
+ *     lock).
+ *  3. The user's conn field is cleared (under the user's lock).
+ *
+ *  Only then are the user and the connection freed. So, the user and
+ *  its connection can be safely used by another thread while it holds
+ *  users_lock (if it found the user in the users hash table), the lock
+ *  of a channel the user is in, or the user's lock (if user->conn is
+ *  not NULL). Since the send lock comes last in the list above, messages
+ *  can be sent to the user while holding any of these locks (e.g., see
+ *  chirc_ctx_send_to_user and chirc_channel_send_message). A user
+ *  pointer must not be used once these locks are released, unless it
+ *  is the user of the connection being handled by the current thread.
+ *
+ *  In event loop mode (see reactor.h), each connection is handled by a
+ *  single event loop. With a single event loop (-e), all messages are
+ *  processed by the same thread, so the locks are never contended. With
+ *  several event loops (-w), messages are processed concurrently by all
+ *  of them (just like with one thread per connection), and the same
+ *  rules apply. Only the event loop that handles a connection sends
+ *  through it: the other event loops post messages to its mailbox (see
+ *  chirc_reactor_post). Posting reads the connection's reactor and id
+ *  fields, so the connection must be kept alive (as described above)
+ *  while the message is posted. The mail only refers to the connection
+ *  by its id, so if the connection is closed before the mail is read,
+ *  the message is discarded.
  */
 
 #ifndef CHIRC_H_
@@ -26,17 +96,50 @@
 #include <sds.h>
 #include <uthash.h>
 #include <stdbool.h>
+#include <stdint.h>
 #include <pthread.h>
+#include <stdatomic.h>
+#include <time.h>
+
+#include "timer.h"
 
 /*! Maximum size of an IRC message */
 #define MSG_MAX (512)
 
+/*! Maximum number of parameters in an IRC message */
+#define MSG_MAX_PARAMS (15)
+
 /*! Function return value: success */
 #define CHIRC_OK (0)
 
 /*! Function return value: failure */
 #define CHIRC_FAIL (-1)
 
+/*! Default maximum number of bytes that can be waiting
+ *  to be sent through a connection (see sendq in chirc_connection_t) */
+#define SENDQ_MAX_DEFAULT (1024 * 1024)
+
+/*! Default number of seconds a connection can stay unregistered
+ *  before it is closed */
+#define REGISTRATION_TIMEOUT_DEFAULT (60)
+
+/*! Default number of seconds a connection can stay quiet before the
+ *  server sends it a PING (and then, before it is closed if it hasn't
+ *  answered the PING) */
+#define PING_INTERVAL_DEFAULT (120)
+
+/*! Default number of tokens in a connection's flood control bucket
+ *  (i.e., the number of commands that can be sent in a burst) */
+#define FLOOD_BURST_DEFAULT (10)
+
+/*! Default maximum number of bytes received through a connection that
+ *  can be waiting to be processed because of flood control (if exceeded,
+ *  the connection is closed) */
+#define FLOOD_RECVQ_MAX_DEFAULT (8 * 1024)
+
+/*! Maximum number of event loops (see the -w option) */
+#define CHIRC_WORKERS_MAX (256)
+
 /*! Server version */
 #define VERSION "chirc-0.6.0"
 
@@ -52,12 +155,20 @@
 /* Forward declarations */
 typedef struct chirc_connection chirc_connection_t;
 typedef struct chirc_channeluser chirc_channeluser_t;
+typedef struct chirc_reactor chirc_reactor_t;
 
 /*! \struct chirc_message_t
  * \brief An IRC message
  *
  * This struct represents a single IRC message. To create/update
  * this struct, use the functions provided in message.h.
+ *
+ * None of the fields of a message are allocated separately: the
+ * prefix, command, and parameters point either into the buffer the
+ * message was parsed from, or into the message's own frame (where
+ * they are copied when the message is constructed). Since the fields
+ * can point into the struct itself, a chirc_message_t must not be
+ * copied by value.
  */
 typedef struct {
     /*! \brief Prefix. NULL if there is no prefix. */
@@ -66,8 +177,12 @@ typedef struct {
     /*! \brief Command (NICK, USER, PRIVMSG, ...) */
     char *cmd;
 
+    /*! \brief Command, packed into an integer (see chirc_message_pack_cmd).
+     *  Used to find the command's handler without comparing strings. */
+    uint64_t cmdcode;
+
     /*! \brief Command parameters */
-    char *params[15];
+    char *params[MSG_MAX_PARAMS];
 
     /*! \brief Number of parameters */
     unsigned int nparams;
@@ -79,11 +194,53 @@ typedef struct {
      */
     bool longlast;
 
-    /*! \brief The raw contents of the message */
+    /*! \brief The raw contents of the message
+     *
+     * The buffer the message was parsed from (the fields of the
+     * message point into it, so it is no longer a single string
+     * once the message has been parsed). NULL if the message
+     * was constructed.
+     */
     char *raw;
+
+    /*! \brief Storage for the fields of the message
+     *
+     * chirc_message_construct and chirc_message_add_parameter copy
+     * their arguments here, one after the other (each followed by
+     * a NUL). The fields are truncated as necessary so that the
+     * message never takes up more than MSG_MAX bytes on the wire.
+     */
+    char frame[MSG_MAX];
+
+    /*! \brief Number of bytes of the frame in use */
+    size_t framelen;
 } chirc_message_t;
 
 
+/*! \struct chirc_wire_t
+ * \brief A serialized IRC message
+ *
+ * This struct contains the string representation of a message
+ * (including the trailing \r\n), exactly as it will be sent through
+ * a connection. It is reference-counted so that, when a message is
+ * relayed to many users (e.g., a PRIVMSG to a channel), the message
+ * is serialized only once and the same chirc_wire_t is shared by all
+ * the recipients. To create/update this struct, use the functions
+ * provided in message.h.
+ */
+typedef struct {
+    /*! \brief Number of references to the struct. It is freed
+     *  when this drops to zero. */
+    atomic_int refcount;
+
+    /*! \brief Length of the serialized message */
+    size_t len;
+
+    /*! \brief The serialized message (NUL-terminated) */
+    char data[];
+} chirc_wire_t;
+
+
 /*! \struct chirc_server_t
  * \brief An IRC server in an IRC Network
  *
@@ -158,6 +315,10 @@ typedef struct
     /*! \brief The user's nick */
 	sds nick;
 
+    /*! \brief The user's nick, folded with irc_casefold. This is the
+     *  user's key in the users hash table (so nicks are case-insensitive) */
+    sds nick_folded;
+
     /*! \brief The user's username */
 	sds username;
 
@@ -170,6 +331,10 @@ typedef struct
     /*! \brief Has the user fully registered with the server */
     bool registered;
 
+    /*! \brief Lock for the user's fields (most notably, the
+     *  user's channels hash table) */
+    pthread_mutex_t lock;
+
     /*! \brief User modes
      *
      * This string-like array contains one character for
@@ -200,7 +365,10 @@ typedef struct
      */
     chirc_channeluser_t *channels;
 
-    /*! \brief Connection corresponding to this user */
+    /*! \brief Connection corresponding to this user
+     *
+     * Cleared (while holding the user's lock) when the connection
+     * is closed (see chirc_ctx_detach_user) */
     chirc_connection_t *conn;
 
     /*! \brief uthash handle
@@ -211,6 +379,19 @@ typedef struct
 } chirc_user_t;
 
 
+/*! \struct chirc_sendq_entry_t
+ * \brief A message in a connection's send queue
+ */
+typedef struct chirc_sendq_entry
+{
+    /*! \brief The message (the queue holds a reference to it) */
+    chirc_wire_t *wire;
+
+    /*! \brief Next message in the queue */
+    struct chirc_sendq_entry *next;
+} chirc_sendq_entry_t;
+
+
 /*! \brief Connection type
  *
  * When a peer first connects to the server, the connection
@@ -227,6 +408,22 @@ typedef enum
 } conn_type_t;
 
 
+/*! \brief Command classes
+ *
+ * For flood control, each command has a cost (in tokens) that
+ * depends on its class (see flood in chirc_ctx_t)
+ */
+typedef enum
+{
+    CMD_CLASS_DEFAULT = 0,
+    CMD_CLASS_KEEPALIVE = 1,   /* PING, PONG */
+    CMD_CLASS_QUERY = 2,       /* WHO, WHOIS, LIST, NAMES, ... */
+    CMD_CLASS_MESSAGE = 3,     /* PRIVMSG, NOTICE */
+    CMD_CLASS_CHANNEL = 4,     /* JOIN, PART, TOPIC, MODE */
+    NUM_CMD_CLASSES
+} cmd_class_t;
+
+
 /*! \struct chirc_connection_t
  * \brief A connection to an IRC server
  */
@@ -253,10 +450,111 @@ typedef struct chirc_connection
     /*! \brief Socket for the connection */
     int socket;
 
+    /*! \brief Bytes received through the socket that do not
+     *  form a complete message yet */
+    sds inbuf;
+
+    /*! \brief Lock for the send queue (and the closing field) */
+    pthread_mutex_t send_lock;
+
+    /*! \brief Send queue
+     *
+     * Messages that could not be sent right away (because the socket's
+     * send buffer was full) wait here, and are sent (with as few system
+     * calls as possible) once the socket becomes writable. If the peer
+     * doesn't read fast enough and the queue grows beyond the server's
+     * sendq_max bytes, the connection is closed. */
+    struct {
+        /*! \brief First message in the queue */
+        chirc_sendq_entry_t *head;
+
+        /*! \brief Last message in the queue */
+        chirc_sendq_entry_t *tail;
+
+        /*! \brief Number of bytes of the first message that
+         *  have already been sent */
+        size_t offset;
+
+        /*! \brief Number of bytes waiting to be sent */
+        size_t bytes;
+    } sendq;
+
+    /*! \brief Is the connection being closed?
+     *
+     * Once set, nothing else will be sent through the connection */
+    bool closing;
+
+    /*! \brief eventfd used to wake up the connection's thread when
+     *  there are messages waiting to be sent.
+     *
+     * Only used when the connection is handled by its own thread */
+    int wakeup_fd;
+
+    /*! \brief Event loop handling the connection
+     *
+     * NULL if the connection is handled by its own thread */
+    chirc_reactor_t *reactor;
+
+    /*! \brief Identifier of the connection
+     *
+     * Unlike the socket (or the address of this struct), it is never
+     * reused by another connection, so it can be used to refer to a
+     * connection that may have been closed in the meantime (see the
+     * mailbox in chirc_reactor_t) */
+    uint64_t id;
+
+    /*! \brief Timer for the registration timeout and the PING keepalives
+     *
+     * In event loop mode, it is in the event loop's timer wheel.
+     * Otherwise, it is in a timer wheel shared by all the connection
+     * threads (see connection.c) */
+    chirc_timer_t timer;
+
+    /*! \brief Time (see chirc_timer_now) when something
+     *  was last received through the connection */
+    _Atomic(time_t) last_input;
+
+    /*! \brief Time (see chirc_timer_now) when the peer last sent a command
+     *  other than PING or PONG (used to report a user's idle time) */
+    _Atomic(time_t) last_active;
+
+    /*! \brief Time (see chirc_timer_now) when the server sent a PING
+     *  to the peer, or zero if it isn't waiting for a reply. Only
+     *  accessed from the connection's timer callback. */
+    time_t ping_sent;
+
+    /*! \brief Flood control (see flood in chirc_ctx_t)
+     *
+     * Only accessed by the thread or event loop handling the connection */
+    struct {
+        /*! \brief Tokens in the bucket (in thousandths of a token). Can
+         *  be negative, since a command's cost is only deducted after it
+         *  has been handled */
+        int64_t tokens;
+
+        /*! \brief Time (see chirc_timer_now_ms) when the bucket was
+         *  last refilled, or zero if it hasn't been filled yet */
+        uint64_t refilled;
+
+        /*! \brief Are there complete messages in the input buffer
+         *  waiting for the bucket to be refilled? */
+        bool throttled;
+
+        /*! \brief Timer used (in event loop mode) to process the
+         *  waiting messages once the bucket has been refilled */
+        chirc_timer_t timer;
+    } flood;
+
     /*! \brief uthash handle
      *
      * Used by the connections hash table in chirc_ctx_t */
     UT_hash_handle hh;
+
+    /*! \brief uthash handle
+     *
+     * Used by the connections hash table (keyed by id)
+     * of the event loop handling the connection */
+    UT_hash_handle hh_reactor;
 } chirc_connection_t;
 
 
@@ -268,6 +566,11 @@ typedef struct
     /*! \brief Channel name */
 	sds name;
 
+    /*! \brief Channel name, folded with irc_casefold. This is the
+     *  channel's key in the channels hash table (so channel names
+     *  are case-insensitive) */
+    sds name_folded;
+
     /*! \brief Channel topic */
 	sds topic;
 
@@ -287,6 +590,10 @@ typedef struct
      */
     chirc_channeluser_t *users;
 
+    /*! \brief Lock for the channel's fields (most notably,
+     *  the channel's users hash table) */
+    pthread_rwlock_t lock;
+
     /*! \brief uthash handle
      *
      * Used by the channels hash table in chirc_ctx_t */
@@ -347,9 +654,15 @@ typedef struct
     /*! \brief Hash table of channels */
     chirc_channel_t *channels;
 
+    /*! \brief Lock for the channels hash table */
+    pthread_rwlock_t channels_lock;
+
     /*! \brief Hash table of users */
     chirc_user_t *users;
 
+    /*! \brief Lock for the users hash table */
+    pthread_rwlock_t users_lock;
+
     /*! \brief IRC network
      *
      * When running in standalone mode, the servers
@@ -377,6 +690,81 @@ typedef struct
 
     /*! \brief Hash table of connections into the server*/
     chirc_connection_t *connections;
+
+    /*! \brief Lock for the connections hash table */
+    pthread_mutex_t connections_lock;
+
+    /*! \brief Counters reported by LUSERS
+     *
+     * These are updated as users, channels, etc. are added, removed,
+     * and updated (through the functions in ctx.h), so producing the
+     * LUSERS replies doesn't require iterating over the hash tables. */
+    struct {
+        /*! \brief Number of registered users */
+        atomic_int users;
+
+        /*! \brief Number of IRC operators */
+        atomic_int ops;
+
+        /*! \brief Number of unknown connections */
+        atomic_int unknown;
+
+        /*! \brief Number of channels */
+        atomic_int channels;
+
+        /*! \brief Number of registered servers (not including
+         *  the running server) */
+        atomic_int servers;
+    } counts;
+
+    /*! \brief Handle all the connections with an epoll event loop,
+     *  instead of with one thread per connection */
+    bool event_loop;
+
+    /*! \brief Number of event loops (each with its own thread and its
+     *  own listening socket) when event_loop is true */
+    unsigned int workers;
+
+    /*! \brief Maximum number of bytes that can be waiting to be sent
+     *  through a connection before it is closed */
+    size_t sendq_max;
+
+    /*! \brief If non-zero, the occupancy of the object pools
+     *  (see pool.h) is logged every pool_report_interval seconds */
+    unsigned int pool_report_interval;
+
+    /*! \brief Number of seconds a connection can stay unregistered
+     *  before it is closed */
+    unsigned int registration_timeout;
+
+    /*! \brief Number of seconds a connection can stay quiet before
+     *  the server sends it a PING, and then before the connection
+     *  is closed if nothing has been received */
+    unsigned int ping_interval;
+
+    /*! \brief Flood control
+     *
+     * Each connection has a bucket of tokens, which is refilled at a
+     * constant rate (up to a maximum), and each command takes some tokens
+     * from the bucket, depending on its class. When the bucket is empty,
+     * the commands received through the connection are not processed
+     * until the bucket has been refilled (they are delayed, not dropped).
+     * If too many bytes pile up waiting to be processed, the connection
+     * is closed. */
+    struct {
+        /*! \brief Tokens added to each bucket per second
+         *  (zero disables flood control) */
+        unsigned int rate;
+
+        /*! \brief Maximum number of tokens in a bucket */
+        unsigned int burst;
+
+        /*! \brief Maximum number of bytes waiting to be processed */
+        size_t recvq_max;
+
+        /*! \brief Tokens taken by a command of each class */
+        unsigned int costs[NUM_CMD_CLASSES];
+    } flood;
 } chirc_ctx_t;
 
 #endif /* CHIRC_H_ */
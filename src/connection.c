@@ -1,11 +1,17 @@
 /* See connection.h for details about the functions in this module */
 
+#include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
 #include <unistd.h>
 #include <errno.h>
+#include <limits.h>
+#include <poll.h>
 #include <pthread.h>
+#include <stdint.h>
 #include <sys/socket.h>
+#include <sys/eventfd.h>
+#include <netdb.h>
 
 #include "ctx.h"
 #include "connection.h"
@@ -14,6 +20,29 @@
 #include "handlers.h"
 #include "chirc.h"
 #include "log.h"
+#include "reactor.h"
+#include "pool.h"
+
+/* Number of bytes read from the socket at a time */
+#define RECV_SIZE (4096)
+
+/* Maximum number of messages sent with a single sendmsg() */
+#define SENDQ_IOV_MAX (64)
+
+/* Sent to a connection that is closed because its send queue is full */
+#define SENDQ_EXCEEDED "ERROR :SendQ exceeded\r\n"
+
+
+/* In thread-per-connection mode, the timers of all the connections are
+ * in this timer wheel, which is advanced by its own thread (in event
+ * loop mode, each event loop has its own timer wheel instead) */
+static chirc_timer_wheel_t thread_wheel;
+static pthread_mutex_t thread_wheel_lock = PTHREAD_MUTEX_INITIALIZER;
+static pthread_once_t thread_wheel_once = PTHREAD_ONCE_INIT;
+static chirc_ctx_t *thread_wheel_ctx;
+
+static void chirc_connection_timer_expired(chirc_timer_wheel_t *wheel, chirc_timer_t *timer);
+static void chirc_connection_flood_expired(chirc_timer_wheel_t *wheel, chirc_timer_t *timer);
 
 /* See connection.h */
 void chirc_connection_init(chirc_connection_t *conn)
@@ -23,6 +52,53 @@ void chirc_connection_init(chirc_connection_t *conn)
     conn->hostname = NULL;
     conn->port = 0;
 
+    conn->socket = -1;
+    conn->inbuf = sdsempty();
+    conn->reactor = NULL;
+    conn->id = 0;
+
+    conn->timer.callback = chirc_connection_timer_expired;
+    conn->timer.data = conn;
+    conn->timer.next = NULL;
+    conn->timer.pprev = NULL;
+    atomic_init(&conn->last_input, chirc_timer_now());
+    atomic_init(&conn->last_active, atomic_load(&conn->last_input));
+    conn->ping_sent = 0;
+
+    conn->flood.tokens = 0;
+    conn->flood.refilled = 0;
+    conn->flood.throttled = false;
+    conn->flood.timer.callback = chirc_connection_flood_expired;
+    conn->flood.timer.data = conn;
+    conn->flood.timer.next = NULL;
+    conn->flood.timer.pprev = NULL;
+
+    conn->sendq.head = NULL;
+    conn->sendq.tail = NULL;
+    conn->sendq.offset = 0;
+    conn->sendq.bytes = 0;
+    conn->closing = false;
+    conn->wakeup_fd = -1;
+    pthread_mutex_init(&conn->send_lock, NULL);
+}
+
+
+/* Removes all the messages from a connection's send queue */
+static void chirc_connection_clear_sendq(chirc_connection_t *conn)
+{
+    chirc_sendq_entry_t *entry, *next;
+
+    for (entry = conn->sendq.head; entry != NULL; entry = next)
+    {
+        next = entry->next;
+        chirc_wire_unref(entry->wire);
+        free(entry);
+    }
+
+    conn->sendq.head = NULL;
+    conn->sendq.tail = NULL;
+    conn->sendq.offset = 0;
+    conn->sendq.bytes = 0;
 }
 
 
@@ -30,22 +106,731 @@ void chirc_connection_init(chirc_connection_t *conn)
 void chirc_connection_free(chirc_connection_t *conn)
 {
     sdsfree(conn->hostname);
+    sdsfree(conn->port);
+    sdsfree(conn->inbuf);
+    chirc_connection_clear_sendq(conn);
+    pthread_mutex_destroy(&conn->send_lock);
+}
+
+
+/* Closes a connection whose send queue is full. The messages
+ * in the queue are discarded and, if possible, the peer is told
+ * why the connection is being closed. The connection is then shut
+ * down, which will make its thread (or the event loop) notice that
+ * it has been closed and free it. */
+static void chirc_connection_sendq_exceeded(chirc_ctx_t *ctx, chirc_connection_t *conn)
+{
+    serverlog(WARNING, conn, "SendQ exceeded (%zu bytes). Closing connection.", conn->sendq.bytes);
 
+    chirc_connection_clear_sendq(conn);
+    conn->closing = true;
+
+    send(conn->socket, SENDQ_EXCEEDED, strlen(SENDQ_EXCEEDED), MSG_DONTWAIT | MSG_NOSIGNAL);
+    shutdown(conn->socket, SHUT_RDWR);
+}
+
+
+/* Sends the bytes in one or more buffers through a connection or, if
+ * they can't be sent right away, adds them to its send queue. If wire
+ * is not NULL, there must be a single buffer pointing to its contents,
+ * and it is queued as is (with an additional reference). Otherwise,
+ * whatever couldn't be sent is copied into a new chirc_wire_t. */
+static int chirc_connection_send_data(chirc_ctx_t *ctx, chirc_connection_t *conn,
+                                      struct iovec *iov, int iovcnt, chirc_wire_t *wire)
+{
+    chirc_sendq_entry_t *entry;
+    struct msghdr mh;
+    bool was_empty;
+    ssize_t nbytes = 0;
+    size_t len = 0;
+    uint64_t one = 1;
+    int rc = CHIRC_OK;
+
+    for (int i = 0; i < iovcnt; i++)
+        len += iov[i].iov_len;
+
+    /* Only the thread running the event loop that handles a connection
+     * can send through it. Other threads post the message to that event
+     * loop's mailbox instead. The caller keeps the connection from being
+     * freed while we read its reactor and id (see "Lifetime of users and
+     * connections" in chirc.h), and the mail only keeps the id, in case
+     * the connection is closed before the mail is read. */
+    if (conn->reactor && conn->reactor != chirc_reactor_current())
+    {
+        if (wire)
+            return chirc_reactor_post(conn->reactor, conn, wire);
+
+        wire = chirc_wire_from_iov(iov, iovcnt, 0);
+        if (!wire)
+            return CHIRC_FAIL;
+        rc = chirc_reactor_post(conn->reactor, conn, wire);
+        chirc_wire_unref(wire);
+
+        return rc;
+    }
+
+    pthread_mutex_lock(&conn->send_lock);
+
+    if (conn->closing)
+    {
+        pthread_mutex_unlock(&conn->send_lock);
+        return CHIRC_FAIL;
+    }
+
+    /* If the queue isn't empty, we're already waiting for the socket
+     * to become writable, and this message will be sent along with
+     * the rest of the queue. Otherwise, we try to send it right away,
+     * and only queue it (and allocate memory for it) if it can't
+     * be sent in full. */
+    was_empty = (conn->sendq.head == NULL);
+    if (was_empty)
+    {
+        memset(&mh, 0, sizeof(mh));
+        mh.msg_iov = iov;
+        mh.msg_iovlen = iovcnt;
+
+        do
+            nbytes = sendmsg(conn->socket, &mh, MSG_DONTWAIT | MSG_NOSIGNAL);
+        while (nbytes == -1 && errno == EINTR);
+
+        if (nbytes == -1)
+        {
+            if (errno != EAGAIN && errno != EWOULDBLOCK)
+            {
+                pthread_mutex_unlock(&conn->send_lock);
+                return CHIRC_FAIL;
+            }
+            nbytes = 0;
+        }
+
+        if (nbytes == len)
+        {
+            pthread_mutex_unlock(&conn->send_lock);
+            return CHIRC_OK;
+        }
+    }
+
+    entry = malloc(sizeof(chirc_sendq_entry_t));
+    if (entry && wire)
+    {
+        entry->wire = chirc_wire_ref(wire);
+        if (was_empty)
+            conn->sendq.offset = nbytes;
+    }
+    else if (entry)
+    {
+        entry->wire = chirc_wire_from_iov(iov, iovcnt, nbytes);
+        if (!entry->wire)
+        {
+            free(entry);
+            entry = NULL;
+        }
+    }
+    if (!entry)
+    {
+        pthread_mutex_unlock(&conn->send_lock);
+        return CHIRC_FAIL;
+    }
+    entry->next = NULL;
+
+    if (was_empty)
+        conn->sendq.head = entry;
+    else
+        conn->sendq.tail->next = entry;
+    conn->sendq.tail = entry;
+    conn->sendq.bytes += len - nbytes;
+
+    if (conn->sendq.bytes > ctx->sendq_max)
+    {
+        chirc_connection_sendq_exceeded(ctx, conn);
+        rc = CHIRC_FAIL;
+    }
+    else if (was_empty)
+    {
+        /* Wait for the socket to become writable */
+        if (conn->reactor)
+            rc = chirc_reactor_want_write(conn->reactor, conn, true);
+        else if (write(conn->wakeup_fd, &one, sizeof(one)) == -1)
+            rc = CHIRC_FAIL;
+    }
+
+    pthread_mutex_unlock(&conn->send_lock);
+
+    return rc;
 }
 
 
 /* See connection.h */
 int chirc_connection_send_message(chirc_ctx_t *ctx, chirc_connection_t *conn, chirc_message_t *msg)
 {
-    /* Your code here */
+    char buf[MSG_MAX + 1];
+    struct iovec iov;
+    chirc_wire_t *wire;
+    size_t len;
+    int rc;
+
+    if (chirc_message_serialize(msg, buf, sizeof(buf), &len) == 0)
+    {
+        iov.iov_base = buf;
+        iov.iov_len = len;
+        return chirc_connection_send_data(ctx, conn, &iov, 1, NULL);
+    }
+
+    /* Parsed messages can be a bit longer than MSG_MAX
+     * (e.g., if a ":" has to be added to their last parameter) */
+    wire = chirc_message_to_wire(msg);
+    if (!wire)
+        return CHIRC_FAIL;
+
+    rc = chirc_connection_send_wire(ctx, conn, wire);
+
+    chirc_wire_unref(wire);
+
+    return rc;
+}
+
+
+/* See connection.h */
+int chirc_connection_send_wire(chirc_ctx_t *ctx, chirc_connection_t *conn, chirc_wire_t *wire)
+{
+    struct iovec iov;
+
+    iov.iov_base = wire->data;
+    iov.iov_len = wire->len;
+
+    return chirc_connection_send_data(ctx, conn, &iov, 1, wire);
+}
+
+
+/* See connection.h */
+int chirc_connection_send_iov(chirc_ctx_t *ctx, chirc_connection_t *conn, struct iovec *iov, int iovcnt)
+{
+    return chirc_connection_send_data(ctx, conn, iov, iovcnt, NULL);
+}
+
+
+/* See connection.h */
+int chirc_connection_flush(chirc_connection_t *conn)
+{
+    struct iovec iov[SENDQ_IOV_MAX];
+    struct msghdr mh;
+    chirc_sendq_entry_t *entry;
+    ssize_t nbytes;
+    size_t n;
+    int niov;
+
+    while (conn->sendq.head != NULL)
+    {
+        /* Gather as many queued messages as possible */
+        niov = 0;
+        for (entry = conn->sendq.head; entry != NULL && niov < SENDQ_IOV_MAX; entry = entry->next)
+        {
+            iov[niov].iov_base = entry->wire->data;
+            iov[niov].iov_len = entry->wire->len;
+            niov++;
+        }
+        iov[0].iov_base = (char *) iov[0].iov_base + conn->sendq.offset;
+        iov[0].iov_len -= conn->sendq.offset;
+
+        memset(&mh, 0, sizeof(mh));
+        mh.msg_iov = iov;
+        mh.msg_iovlen = niov;
+
+        nbytes = sendmsg(conn->socket, &mh, MSG_DONTWAIT | MSG_NOSIGNAL);
+        if (nbytes == -1)
+        {
+            if (errno == EINTR)
+                continue;
+            if (errno == EAGAIN || errno == EWOULDBLOCK)
+                return CHIRC_OK;
+            return CHIRC_FAIL;
+        }
+
+        /* Remove the messages that were sent in full */
+        conn->sendq.bytes -= nbytes;
+        while (nbytes > 0)
+        {
+            entry = conn->sendq.head;
+            n = entry->wire->len - conn->sendq.offset;
+            if (nbytes < n)
+            {
+                conn->sendq.offset += nbytes;
+                break;
+            }
+
+            nbytes -= n;
+            conn->sendq.offset = 0;
+            conn->sendq.head = entry->next;
+            chirc_wire_unref(entry->wire);
+            free(entry);
+        }
+        if (conn->sendq.head == NULL)
+            conn->sendq.tail = NULL;
+    }
+
+    return CHIRC_OK;
+}
+
+
+/* See connection.h */
+int chirc_connection_set_peer(chirc_connection_t *conn, int socket, struct sockaddr *addr,
+                              socklen_t addrlen, bool numeric)
+{
+    char host[NI_MAXHOST], port[NI_MAXSERV];
+    int rc;
+
+    conn->socket = socket;
+
+    rc = getnameinfo(addr, addrlen, host, sizeof(host), port, sizeof(port),
+                     NI_NUMERICSERV | (numeric ? NI_NUMERICHOST : 0));
+    if (rc != 0)
+    {
+        serverlog(ERROR, NULL, "getnameinfo() failed: %s", gai_strerror(rc));
+        return CHIRC_FAIL;
+    }
+
+    conn->hostname = sdsnew(host);
+    conn->port = sdsnew(port);
+
     return CHIRC_OK;
 }
 
 
+/* Sends the peer an ERROR message telling it that
+ * the connection is about to be closed */
+static void chirc_connection_send_error(chirc_ctx_t *ctx, chirc_connection_t *conn, char *reason)
+{
+    chirc_message_t msg;
+    char buf[MSG_MAX];
+
+    serverlog(INFO, conn, "Closing connection: %s", reason);
+
+    snprintf(buf, sizeof(buf), "Closing Link: %s (%s)", conn->hostname, reason);
+    chirc_message_construct(&msg, NULL, "ERROR");
+    chirc_message_add_parameter(&msg, buf, true);
+    chirc_connection_send_message(ctx, conn, &msg);
+    chirc_message_free(&msg);
+}
+
+
+/* Closes a connection from a timer callback. We send the peer an
+ * ERROR message and shut down the reading side of the socket, so the
+ * thread or event loop handling the connection sees the end of the
+ * connection, and closes it (after trying to send the ERROR). */
+static void chirc_connection_timeout(chirc_ctx_t *ctx, chirc_connection_t *conn, char *reason)
+{
+    chirc_connection_send_error(ctx, conn, reason);
+
+    shutdown(conn->socket, SHUT_RD);
+}
+
+
+/* Called when a connection's timer expires. The first time, this is
+ * the registration timeout. After that, the timer checks whether the
+ * connection has been quiet for too long: if so, we send it a PING
+ * and, if nothing has been received after another ping_interval
+ * seconds, we close it. */
+static void chirc_connection_timer_expired(chirc_timer_wheel_t *wheel, chirc_timer_t *timer)
+{
+    chirc_ctx_t *ctx = wheel->data;
+    chirc_connection_t *conn = timer->data;
+    chirc_message_t msg;
+    time_t now, last_input, idle;
+
+    if (conn->type == CONN_TYPE_UNKNOWN)
+    {
+        chirc_connection_timeout(ctx, conn, "Registration timed out");
+        return;
+    }
+
+    now = chirc_timer_now();
+    last_input = atomic_load_explicit(&conn->last_input, memory_order_relaxed);
+    idle = now - last_input;
+
+    /* Anything received after our PING counts as an answer */
+    if (conn->ping_sent != 0 && last_input >= conn->ping_sent)
+        conn->ping_sent = 0;
+
+    if (idle < ctx->ping_interval)
+        chirc_timer_add(wheel, timer, ctx->ping_interval - idle);
+    else if (conn->ping_sent == 0)
+    {
+        chirc_message_construct(&msg, NULL, "PING");
+        chirc_message_add_parameter(&msg, ctx->network.this_server->servername, false);
+        chirc_connection_send_message(ctx, conn, &msg);
+        chirc_message_free(&msg);
+
+        conn->ping_sent = now;
+        chirc_timer_add(wheel, timer, ctx->ping_interval);
+    }
+    else
+        chirc_connection_timeout(ctx, conn, "Ping timeout");
+}
+
+
+/* See connection.h */
+void chirc_connection_start_timer(chirc_timer_wheel_t *wheel, chirc_connection_t *conn)
+{
+    chirc_ctx_t *ctx = wheel->data;
+
+    chirc_timer_add(wheel, &conn->timer, ctx->registration_timeout);
+}
+
+
+/* See connection.h */
+time_t chirc_connection_idle_time(chirc_connection_t *conn)
+{
+    return chirc_timer_now() - atomic_load_explicit(&conn->last_active, memory_order_relaxed);
+}
+
+
+/* Refills a connection's flood control bucket with the tokens it has
+ * earned since it was last refilled. The bucket can't hold more than
+ * ctx->flood.burst tokens, except if messages have been waiting for
+ * it to be refilled (in event loop mode, the waiting messages are only
+ * processed once per timer tick, and the tokens earned until then
+ * belong to them, even if they are more than the bucket can hold) */
+static void chirc_connection_flood_refill(chirc_ctx_t *ctx, chirc_connection_t *conn, bool waiting)
+{
+    uint64_t now = chirc_timer_now_ms();
+    int64_t max = (int64_t) ctx->flood.burst * 1000;
+
+    /* The bucket starts out full */
+    if (conn->flood.refilled == 0)
+        conn->flood.tokens = max;
+    else
+        conn->flood.tokens += (now - conn->flood.refilled) * ctx->flood.rate;
+
+    if (conn->flood.tokens > max && !waiting)
+        conn->flood.tokens = max;
+    conn->flood.refilled = now;
+}
+
+
+/* Returns the number of milliseconds until a connection's
+ * (empty) flood control bucket has some tokens again */
+static uint64_t chirc_connection_flood_delay(chirc_ctx_t *ctx, chirc_connection_t *conn)
+{
+    return (1 - conn->flood.tokens + ctx->flood.rate - 1) / ctx->flood.rate;
+}
+
+
+/* Called (in event loop mode) when a throttled connection's flood
+ * control bucket should have been refilled, to process the messages
+ * that have been waiting for it */
+static void chirc_connection_flood_expired(chirc_timer_wheel_t *wheel, chirc_timer_t *timer)
+{
+    chirc_ctx_t *ctx = wheel->data;
+    chirc_connection_t *conn = timer->data;
+
+    /* The event loop will see the end of the connection and close it */
+    if (chirc_connection_process_input(ctx, conn, NULL, 0) == CHIRC_HANDLER_DISCONNECT)
+        shutdown(conn->socket, SHUT_RD);
+}
+
+
+/* Parses and handles a single message (len includes the
+ * message's trailing \r\n). The message is parsed in place,
+ * so the bytes at s are modified. */
+static int chirc_connection_handle_line(chirc_ctx_t *ctx, chirc_connection_t *conn, char *s, size_t len)
+{
+    chirc_message_t msg;
+    int rc;
+
+    /* Messages with NUL characters can't be handled as strings */
+    if (memchr(s, '\0', len))
+    {
+        serverlog(WARNING, conn, "Ignoring message with a NUL character");
+        return CHIRC_OK;
+    }
+
+    if (len > MSG_MAX)
+    {
+        serverlog(DEBUG, conn, "Truncating message of length %zu", len);
+        len = MSG_MAX;
+    }
+
+    /* Empty messages are silently ignored */
+    if (chirc_message_parse(&msg, s, len - 2))
+        return CHIRC_OK;
+
+    /* The command's cost is deducted after handling it (so the bucket
+     * can go below zero), so we don't have to "unparse" messages that
+     * would have to wait for the bucket to be refilled */
+    if (ctx->flood.rate > 0)
+        conn->flood.tokens -= (int64_t) ctx->flood.costs[chirc_handler_class(msg.cmdcode)] * 1000;
+
+    rc = chirc_handle(ctx, conn, &msg);
+
+    chirc_message_free(&msg);
+
+    return rc;
+}
+
+
+/* See connection.h */
+int chirc_connection_process_input(chirc_ctx_t *ctx, chirc_connection_t *conn, char *buf, size_t len)
+{
+    size_t start = 0, end;
+    char *data, *nl;
+    bool waiting = conn->flood.throttled;
+    int rc = CHIRC_OK;
+
+    /* Messages that were held back by flood control don't count as input
+     * (otherwise, a peer with a backlog would never be considered dead) */
+    if (len > 0)
+        atomic_store_explicit(&conn->last_input, chirc_timer_now(), memory_order_relaxed);
+
+    /* If nothing was left over from previous reads, the messages are
+     * parsed directly in buf, and only the bytes after the last complete
+     * message (if any) are copied to the connection's input buffer */
+    if (sdslen(conn->inbuf) == 0)
+        data = buf;
+    else
+    {
+        if (len > 0)
+            conn->inbuf = sdscatlen(conn->inbuf, buf, len);
+        data = conn->inbuf;
+        len = sdslen(conn->inbuf);
+    }
+
+    conn->flood.throttled = false;
+
+    while (start < len && (nl = memchr(data + start, '\n', len - start)) != NULL)
+    {
+        /* If the flood control bucket is empty, the rest of the
+         * messages have to wait in the input buffer */
+        if (ctx->flood.rate > 0 && conn->flood.tokens <= 0)
+        {
+            chirc_connection_flood_refill(ctx, conn, waiting);
+            if (conn->flood.tokens <= 0)
+            {
+                conn->flood.throttled = true;
+                break;
+            }
+        }
+
+        end = nl - data + 1;
+
+        /* Messages must end in \r\n. A lone \n is ignored, along
+         * with everything before it */
+        if (end - start >= 2 && data[end - 2] == '\r')
+            rc = chirc_connection_handle_line(ctx, conn, data + start, end - start);
+
+        start = end;
+
+        if (rc == CHIRC_HANDLER_DISCONNECT)
+            break;
+    }
+
+    if (data == buf)
+    {
+        if (start < len)
+            conn->inbuf = sdscatlen(conn->inbuf, buf + start, len - start);
+    }
+    else
+        sdsrange(conn->inbuf, start, -1);
+
+    if (conn->flood.throttled)
+    {
+        /* The peer keeps sending messages faster than we are willing
+         * to process them */
+        if (sdslen(conn->inbuf) > ctx->flood.recvq_max)
+        {
+            chirc_connection_send_error(ctx, conn, "Excess Flood");
+            return CHIRC_HANDLER_DISCONNECT;
+        }
+
+        /* In thread-per-connection mode, the connection's thread takes
+         * care of processing the waiting messages (see chirc_connection_thread) */
+        if (conn->reactor)
+            chirc_timer_add(&conn->reactor->wheel, &conn->flood.timer,
+                            (chirc_connection_flood_delay(ctx, conn) + 999) / 1000);
+    }
+    /* The peer is sending a message that is too long. We discard
+     * what we have so far so the buffer doesn't grow unbounded
+     * (the rest of the message will be handled as if it was a
+     * separate message) */
+    else if (sdslen(conn->inbuf) > MSG_MAX)
+    {
+        serverlog(WARNING, conn, "Discarding %zu bytes without a \\r\\n", sdslen(conn->inbuf));
+        sdsclear(conn->inbuf);
+    }
+
+    return rc;
+}
+
+
+/* Advances the timer wheel shared by the connection threads */
+static void *chirc_connection_timer_thread(void *args)
+{
+    while (true)
+    {
+        sleep(1);
+
+        pthread_mutex_lock(&thread_wheel_lock);
+        chirc_timer_wheel_advance(&thread_wheel, chirc_timer_now());
+        pthread_mutex_unlock(&thread_wheel_lock);
+    }
+
+    return NULL;
+}
+
+
+/* Starts the thread that advances the timer wheel
+ * shared by the connection threads */
+static void chirc_connection_start_timer_thread()
+{
+    pthread_t thread;
+
+    chirc_timer_wheel_init(&thread_wheel, thread_wheel_ctx);
+
+    if (pthread_create(&thread, NULL, chirc_connection_timer_thread, NULL) != 0)
+        serverlog(ERROR, NULL, "Could not create the timer thread");
+    else
+        pthread_detach(thread);
+}
+
+
+/* Arguments to the connection threads */
+struct worker_args
+{
+    chirc_ctx_t *ctx;
+    chirc_connection_t *conn;
+};
+
+
+/* Thread function for a connection: processes everything
+ * received through the connection until it is closed */
+static void *chirc_connection_thread(void *args)
+{
+    struct worker_args *wa = (struct worker_args*) args;
+    chirc_ctx_t *ctx = wa->ctx;
+    chirc_connection_t *conn = wa->conn;
+    char buf[RECV_SIZE];
+    struct pollfd pfds[2];
+    ssize_t nbytes;
+    uint64_t wakeups;
+    int rc, timeout;
+
+    free(wa);
+
+    pthread_mutex_lock(&thread_wheel_lock);
+    chirc_connection_start_timer(&thread_wheel, conn);
+    pthread_mutex_unlock(&thread_wheel_lock);
+
+    /* We wait for the socket to be readable (or, if there are messages
+     * waiting to be sent, writable), and for other threads to tell us
+     * (through the eventfd) that they have queued messages that
+     * could not be sent right away */
+    pfds[0].fd = conn->socket;
+    pfds[1].fd = conn->wakeup_fd;
+    pfds[1].events = POLLIN;
+
+    while (true)
+    {
+        pthread_mutex_lock(&conn->send_lock);
+        pfds[0].events = POLLIN | (conn->sendq.head != NULL ? POLLOUT : 0);
+        pthread_mutex_unlock(&conn->send_lock);
+
+        /* If there are messages waiting for the flood control bucket
+         * to be refilled, we only wait until then */
+        timeout = conn->flood.throttled ? (int) chirc_connection_flood_delay(ctx, conn) : -1;
+
+        if (poll(pfds, 2, timeout) == -1)
+        {
+            if (errno == EINTR)
+                continue;
+            break;
+        }
+
+        if (pfds[1].revents & POLLIN)
+            read(conn->wakeup_fd, &wakeups, sizeof(wakeups));
+
+        if (pfds[0].revents & POLLOUT)
+        {
+            pthread_mutex_lock(&conn->send_lock);
+            rc = chirc_connection_flush(conn);
+            pthread_mutex_unlock(&conn->send_lock);
+            if (rc)
+                break;
+        }
+
+        if (pfds[0].revents & (POLLIN | POLLHUP | POLLERR))
+        {
+            nbytes = recv(conn->socket, buf, sizeof(buf), 0);
+            if (nbytes == -1 && errno == EINTR)
+                continue;
+            if (nbytes <= 0)
+                break;
+
+            if (chirc_connection_process_input(ctx, conn, buf, nbytes) == CHIRC_HANDLER_DISCONNECT)
+                break;
+        }
+
+        if (conn->flood.throttled &&
+            chirc_connection_process_input(ctx, conn, NULL, 0) == CHIRC_HANDLER_DISCONNECT)
+            break;
+    }
+
+    serverlog(DEBUG, conn, "Closing connection");
+
+    /* Once this returns, the timer's callback can't be running
+     * (and won't run again) for this connection */
+    pthread_mutex_lock(&thread_wheel_lock);
+    chirc_timer_cancel(&thread_wheel, &conn->timer);
+    pthread_mutex_unlock(&thread_wheel_lock);
+
+    /* Make a best effort to send any pending messages
+     * (e.g., the reply to a QUIT) */
+    pthread_mutex_lock(&conn->send_lock);
+    conn->closing = true;
+    chirc_connection_flush(conn);
+    pthread_mutex_unlock(&conn->send_lock);
+
+    chirc_ctx_remove_connection(ctx, conn);
+
+    close(conn->socket);
+    close(conn->wakeup_fd);
+    chirc_connection_free(conn);
+    chirc_pool_free(&chirc_connection_pool, conn);
+
+    return NULL;
+}
+
+
 /* See connection.h */
 int chirc_connection_create_thread(chirc_ctx_t *ctx, chirc_connection_t *connection)
 {
-    /* Your code here */
+    pthread_t thread;
+    struct worker_args *wa;
+
+    thread_wheel_ctx = ctx;
+    pthread_once(&thread_wheel_once, chirc_connection_start_timer_thread);
+
+    connection->wakeup_fd = eventfd(0, EFD_NONBLOCK | EFD_CLOEXEC);
+    if (connection->wakeup_fd == -1)
+    {
+        serverlog(ERROR, connection, "Could not create an eventfd for the connection");
+        return CHIRC_FAIL;
+    }
+
+    wa = calloc(1, sizeof(struct worker_args));
+    wa->ctx = ctx;
+    wa->conn = connection;
+
+    chirc_ctx_add_connection(ctx, connection);
+
+    if (pthread_create(&thread, NULL, chirc_connection_thread, wa) != 0)
+    {
+        serverlog(ERROR, connection, "Could not create a thread for the connection");
+        chirc_ctx_remove_connection(ctx, connection);
+        close(connection->wakeup_fd);
+        free(wa);
+        return CHIRC_FAIL;
+    }
+
+    pthread_detach(thread);
 
     return CHIRC_OK;
 }
@@ -13,6 +13,8 @@
 #ifndef CONNECTION_H_
 #define CONNECTION_H_
 
+#include <sys/socket.h>
+#include <sys/uio.h>
 #include "chirc.h"
 
 /*! \brief Initializes a chirc_connection_t struct
@@ -37,6 +39,10 @@ void chirc_connection_init(chirc_connection_t *conn);
 void chirc_connection_free(chirc_connection_t *conn);
 
 /*! \brief Send a message through a connection
+ *
+ * The message is serialized into a buffer on the stack, and sent right
+ * away if possible, so no memory is allocated unless the message has to
+ * wait in the send queue (see chirc_connection_send_wire).
  *
  * \param ctx Server context
  * \param conn The connection to send the message through
@@ -45,6 +51,119 @@ void chirc_connection_free(chirc_connection_t *conn);
  */
 int chirc_connection_send_message(chirc_ctx_t *ctx, chirc_connection_t *conn, chirc_message_t *msg);
 
+/*! \brief Send a serialized message through a connection
+ *
+ * The message is sent right away if possible. Otherwise, it is added
+ * to the connection's send queue, and will be sent once the connection
+ * becomes writable. If this makes the send queue grow beyond the server's
+ * maximum send queue size (the -Q option), the messages in the queue are
+ * discarded, the peer is sent an "ERROR :SendQ exceeded" message (if
+ * possible), and the connection is closed.
+ *
+ * When sending the same message through multiple connections,
+ * serialize it just once (with chirc_message_to_wire) and
+ * use this function instead of chirc_connection_send_message.
+ *
+ * \param ctx Server context
+ * \param conn The connection to send the message through
+ * \param wire The serialized message to send
+ * \return 0 on success, non-zero on failure
+ */
+int chirc_connection_send_wire(chirc_ctx_t *ctx, chirc_connection_t *conn, chirc_wire_t *wire);
+
+/*! \brief Send the bytes in several buffers through a connection
+ *
+ * The buffers are sent with a single sendmsg() call, if possible
+ * (otherwise, what couldn't be sent is copied into the send queue,
+ * just like with chirc_connection_send_wire). The buffers must
+ * contain one or more complete messages.
+ *
+ * \param ctx Server context
+ * \param conn The connection to send the messages through
+ * \param iov Buffers (at most IOV_MAX)
+ * \param iovcnt Number of buffers
+ * \return 0 on success, non-zero on failure
+ */
+int chirc_connection_send_iov(chirc_ctx_t *ctx, chirc_connection_t *conn, struct iovec *iov, int iovcnt);
+
+/*! \brief Sends as much of a connection's send queue as possible
+ *
+ * This function never blocks: it stops sending once the
+ * socket's send buffer is full.
+ *
+ * The caller must hold the connection's send_lock.
+ *
+ * \param conn The connection
+ * \return 0 on success, non-zero if the connection has failed
+ */
+int chirc_connection_flush(chirc_connection_t *conn);
+
+/*! \brief Sets the socket and peer information of a connection
+ *
+ * \param conn The connection
+ * \param socket Socket returned by accept()
+ * \param addr Peer address returned by accept()
+ * \param addrlen Length of addr
+ * \param numeric If true, the peer's hostname is set to its numeric
+ *        address, instead of doing a (blocking) reverse DNS lookup
+ * \return 0 on success, non-zero on failure
+ */
+int chirc_connection_set_peer(chirc_connection_t *conn, int socket, struct sockaddr *addr,
+                              socklen_t addrlen, bool numeric);
+
+/*! \brief Processes bytes received through a connection
+ *
+ * The bytes are appended to the connection's input buffer, and every
+ * complete message in the buffer is parsed and handled (with chirc_handle).
+ * Any bytes after the last complete message are kept in the buffer until
+ * more bytes arrive.
+ *
+ * Messages are parsed in place (with chirc_message_parse), without copying
+ * them. When the input buffer is empty, they are parsed directly in buf,
+ * so the contents of buf are modified.
+ *
+ * Messages longer than MSG_MAX bytes are truncated.
+ *
+ * If flood control is enabled (see flood in chirc_ctx_t) and the
+ * connection's bucket runs out of tokens, the remaining messages are
+ * left in the input buffer (and conn->flood.throttled is set) until the
+ * bucket is refilled. Calling this function with no bytes processes
+ * the messages that are waiting in the input buffer.
+ *
+ * \param ctx Server context
+ * \param conn The connection the bytes were received through
+ * \param buf Bytes received (may be modified)
+ * \param len Number of bytes received (can be zero)
+ * \return 0 on success. If handling a message results in the connection
+ *         having to be closed, CHIRC_HANDLER_DISCONNECT is returned
+ *         (and any messages after that one are not processed). This is
+ *         also returned if too many bytes are waiting in the input buffer
+ *         because of flood control.
+ */
+int chirc_connection_process_input(chirc_ctx_t *ctx, chirc_connection_t *conn, char *buf, size_t len);
+
+/*! \brief Adds a connection's timer to a timer wheel
+ *
+ * The timer first expires after the registration timeout (if the
+ * connection hasn't registered by then, it is closed), and then
+ * takes care of sending PINGs to the peer when the connection has
+ * been quiet for a while, and of closing the connection if the peer
+ * doesn't answer. Whoever closes the connection must remove the
+ * timer from the wheel (with chirc_timer_cancel).
+ *
+ * \param wheel The timer wheel (its data must be the server context)
+ * \param conn The connection
+ */
+void chirc_connection_start_timer(chirc_timer_wheel_t *wheel, chirc_connection_t *conn);
+
+/*! \brief Returns the number of seconds since the peer sent a command
+ *  other than PING or PONG (e.g., for RPL_WHOISIDLE)
+ *
+ * \param conn The connection
+ * \return Idle time, in seconds
+ */
+time_t chirc_connection_idle_time(chirc_connection_t *conn);
+
 /*! \brief Creates a thread to handle a connection
  *
  * \param ctx Server context
@@ -12,6 +12,9 @@
 #include "channeluser.h"
 #include "server.h"
 #include "log.h"
+#include "utils.h"
+#include "pool.h"
+#include "connection.h"
 #include "chirc.h"
 
 /* See ctx.h */
@@ -20,10 +23,35 @@ void chirc_ctx_init(chirc_ctx_t *ctx)
     time_t t = time(NULL);
 
     ctx->channels = NULL;
+    pthread_rwlock_init(&ctx->channels_lock, NULL);
 
     ctx->users = NULL;
+    pthread_rwlock_init(&ctx->users_lock, NULL);
 
     ctx->connections = NULL;
+    pthread_mutex_init(&ctx->connections_lock, NULL);
+
+    atomic_init(&ctx->counts.users, 0);
+    atomic_init(&ctx->counts.ops, 0);
+    atomic_init(&ctx->counts.unknown, 0);
+    atomic_init(&ctx->counts.channels, 0);
+    atomic_init(&ctx->counts.servers, 0);
+
+    ctx->event_loop = false;
+    ctx->workers = 1;
+    ctx->sendq_max = SENDQ_MAX_DEFAULT;
+    ctx->pool_report_interval = 0;
+    ctx->registration_timeout = REGISTRATION_TIMEOUT_DEFAULT;
+    ctx->ping_interval = PING_INTERVAL_DEFAULT;
+
+    ctx->flood.rate = 0;
+    ctx->flood.burst = FLOOD_BURST_DEFAULT;
+    ctx->flood.recvq_max = FLOOD_RECVQ_MAX_DEFAULT;
+    ctx->flood.costs[CMD_CLASS_DEFAULT] = 1;
+    ctx->flood.costs[CMD_CLASS_KEEPALIVE] = 1;
+    ctx->flood.costs[CMD_CLASS_QUERY] = 2;
+    ctx->flood.costs[CMD_CLASS_MESSAGE] = 1;
+    ctx->flood.costs[CMD_CLASS_CHANNEL] = 2;
 
     ctx->network.this_server = NULL;
     ctx->network.servers = NULL;
@@ -36,6 +64,9 @@ void chirc_ctx_init(chirc_ctx_t *ctx)
 void chirc_ctx_free(chirc_ctx_t *ctx)
 {
     sdsfree(ctx->version);
+    pthread_rwlock_destroy(&ctx->channels_lock);
+    pthread_rwlock_destroy(&ctx->users_lock);
+    pthread_mutex_destroy(&ctx->connections_lock);
 
     /* Free channels */
     chirc_channel_t *channel, *tmp_channel;
@@ -43,7 +74,7 @@ void chirc_ctx_free(chirc_ctx_t *ctx)
     {
         chirc_channel_free(channel);
         HASH_DEL(ctx->channels, channel);
-        free(channel);
+        chirc_pool_free(&chirc_channel_pool, channel);
     }
 
     /* Free users */
@@ -52,7 +83,7 @@ void chirc_ctx_free(chirc_ctx_t *ctx)
     {
         chirc_user_free(user);
         HASH_DEL(ctx->users, user);
-        free(user);
+        chirc_pool_free(&chirc_user_pool, user);
     }
 
     /* Free connections */
@@ -61,7 +92,7 @@ void chirc_ctx_free(chirc_ctx_t *ctx)
     {
         chirc_connection_free(conn);
         HASH_DEL(ctx->connections, conn);
-        free(conn);
+        chirc_pool_free(&chirc_connection_pool, conn);
     }
 
     /* Free servers */
@@ -88,72 +119,159 @@ void chirc_ctx_free(chirc_ctx_t *ctx)
 }
 
 
+/* Size of the buffers that names are folded into before looking them
+ * up (a nick or channel name can't be longer than an IRC message, so
+ * they are never truncated) */
+#define FOLDED_MAX (MSG_MAX)
+
+
+/* Returns a folded copy of a nick or channel name, to use as its key
+ * in the users or channels hash table */
+static sds chirc_ctx_fold_key(sds name)
+{
+    sds key;
+
+    key = sdsdup(name);
+    irc_casefold(key, key, sdslen(key) + 1);
+
+    return key;
+}
+
+
+/* Gets or creates a channel. Must be called with
+ * the channels lock held for writing */
+static bool chirc_ctx_get_or_create_channel_locked(chirc_ctx_t *ctx, char *channelname, chirc_channel_t **channel)
+{
+    char key[FOLDED_MAX];
+
+    irc_casefold(key, channelname, sizeof(key));
+
+    HASH_FIND_STR(ctx->channels, key, *channel);
+    if(*channel)
+        return false;
+
+    *channel = chirc_pool_alloc(&chirc_channel_pool);
+    chirc_channel_init(*channel);
+    (*channel)->name = sdsnew(channelname);
+    (*channel)->name_folded = sdsnew(key);
+    HASH_ADD_KEYPTR(hh, ctx->channels, (*channel)->name_folded, sdslen((*channel)->name_folded), *channel);
+    atomic_fetch_add(&ctx->counts.channels, 1);
+
+    return true;
+}
+
+
 /* See ctx.h */
 void chirc_ctx_add_connection(chirc_ctx_t *ctx, chirc_connection_t *conn)
 {
+    pthread_mutex_lock(&ctx->connections_lock);
     HASH_ADD_INT(ctx->connections, socket, conn);
+    pthread_mutex_unlock(&ctx->connections_lock);
+
+    if (conn->type == CONN_TYPE_UNKNOWN)
+        atomic_fetch_add(&ctx->counts.unknown, 1);
 }
 
 
 /* See ctx.h */
 void chirc_ctx_remove_connection(chirc_ctx_t *ctx, chirc_connection_t *conn)
 {
+    chirc_user_t *user;
+
+    pthread_mutex_lock(&ctx->connections_lock);
     HASH_DEL(ctx->connections, conn);
+    pthread_mutex_unlock(&ctx->connections_lock);
+
+    if (conn->type == CONN_TYPE_UNKNOWN)
+        atomic_fetch_sub(&ctx->counts.unknown, 1);
+
+    if (conn->type == CONN_TYPE_USER && conn->peer.user != NULL)
+    {
+        user = conn->peer.user;
+        conn->peer.user = NULL;
+
+        chirc_ctx_detach_user(ctx, user);
+        chirc_user_free(user);
+        chirc_pool_free(&chirc_user_pool, user);
+    }
 }
 
 
 /* See ctx.h */
-int chirc_ctx_numusers(chirc_ctx_t *ctx)
+void chirc_ctx_detach_user(chirc_ctx_t *ctx, chirc_user_t *user)
 {
-    int n = 0;
-    for (chirc_user_t *u = ctx->users; u != NULL; u = u->hh.next)
-    {
-        if (u->registered)
-            n++;
-    }
+    chirc_channeluser_t **channels, *cu, *tmp;
+    unsigned int nchannels, i = 0;
+
+    /* Once the user is out of the users hash table, no other thread
+     * can find it (and chirc_ctx_send_to_user won't send to it) */
+    chirc_ctx_remove_user(ctx, user);
+
+    /* We can't lock the channels while holding the user's lock, so we
+     * part the channels from a copy of the user's channels */
+    pthread_mutex_lock(&user->lock);
+    nchannels = HASH_CNT(hh_from_user, user->channels);
+    channels = malloc(nchannels * sizeof(chirc_channeluser_t *));
+    HASH_ITER(hh_from_user, user->channels, cu, tmp)
+        channels[i++] = cu;
+    pthread_mutex_unlock(&user->lock);
+
+    /* Once the user is out of a channel, no thread relaying a message
+     * to the channel can be using the user's connection */
+    for (i = 0; i < nchannels; i++)
+        chirc_ctx_part_channel(ctx, channels[i]);
+    free(channels);
+
+    pthread_mutex_lock(&user->lock);
+    user->conn = NULL;
+    pthread_mutex_unlock(&user->lock);
+}
 
-    return n;
+
+/* See ctx.h */
+void chirc_ctx_set_connection_type(chirc_ctx_t *ctx, chirc_connection_t *conn, conn_type_t type)
+{
+    if (conn->type == CONN_TYPE_UNKNOWN && type != CONN_TYPE_UNKNOWN)
+        atomic_fetch_sub(&ctx->counts.unknown, 1);
+    else if (conn->type != CONN_TYPE_UNKNOWN && type == CONN_TYPE_UNKNOWN)
+        atomic_fetch_add(&ctx->counts.unknown, 1);
+
+    conn->type = type;
 }
 
 
 /* See ctx.h */
-int chirc_ctx_numchannels(chirc_ctx_t *ctx)
+int chirc_ctx_numusers(chirc_ctx_t *ctx)
 {
-    int size;
+    return atomic_load(&ctx->counts.users);
+}
 
-    size = HASH_COUNT(ctx->channels);
 
-    return size;
+/* See ctx.h */
+int chirc_ctx_numchannels(chirc_ctx_t *ctx)
+{
+    return atomic_load(&ctx->counts.channels);
 }
 
 
 /* See ctx.h */
 int chirc_ctx_numops(chirc_ctx_t *ctx)
 {
-    int n = 0;
+    return atomic_load(&ctx->counts.ops);
+}
 
-    for (chirc_user_t *u = ctx->users; u != NULL; u = u->hh.next)
-    {
-        if (chirc_user_has_mode(u, 'o'))
-            n++;
-    }
 
-    return n;
+/* See ctx.h */
+int chirc_ctx_numservers(chirc_ctx_t *ctx)
+{
+    return atomic_load(&ctx->counts.servers) + 1;
 }
 
 
 /* See ctx.h */
 int chirc_ctx_unknown_connections(chirc_ctx_t *ctx)
 {
-    int n=0;
-
-    for (chirc_connection_t *c = ctx->connections; c != NULL; c = c->hh.next)
-    {
-        if (c->type == CONN_TYPE_UNKNOWN)
-            n++;
-    }
-
-    return n;
+    return atomic_load(&ctx->counts.unknown);
 }
 
 
@@ -161,8 +279,13 @@ int chirc_ctx_unknown_connections(chirc_ctx_t *ctx)
 chirc_channel_t* chirc_ctx_get_channel(chirc_ctx_t *ctx, char *channelname)
 {
     chirc_channel_t *channel;
+    char key[FOLDED_MAX];
+
+    irc_casefold(key, channelname, sizeof(key));
 
-    HASH_FIND_STR(ctx->channels, channelname, channel);
+    pthread_rwlock_rdlock(&ctx->channels_lock);
+    HASH_FIND_STR(ctx->channels, key, channel);
+    pthread_rwlock_unlock(&ctx->channels_lock);
 
     return channel;
 }
@@ -171,7 +294,14 @@ chirc_channel_t* chirc_ctx_get_channel(chirc_ctx_t *ctx, char *channelname)
 /* See ctx.h */
 int chirc_ctx_add_channel(chirc_ctx_t *ctx, chirc_channel_t *channel)
 {
-    HASH_ADD_KEYPTR(hh, ctx->channels, channel->name, sdslen(channel->name), channel);
+    if (!channel->name_folded)
+        channel->name_folded = chirc_ctx_fold_key(channel->name);
+
+    pthread_rwlock_wrlock(&ctx->channels_lock);
+    HASH_ADD_KEYPTR(hh, ctx->channels, channel->name_folded, sdslen(channel->name_folded), channel);
+    pthread_rwlock_unlock(&ctx->channels_lock);
+
+    atomic_fetch_add(&ctx->counts.channels, 1);
 
     return CHIRC_OK;
 }
@@ -182,21 +312,9 @@ bool chirc_ctx_get_or_create_channel(chirc_ctx_t *ctx, char *channelname, chirc_
 {
     bool created;
 
-
-    HASH_FIND_STR(ctx->channels, channelname, *channel);
-    if(*channel)
-    {
-        created = false;
-    }
-    else
-    {
-        created = true;
-
-        *channel = malloc(sizeof(chirc_channel_t));
-        chirc_channel_init(*channel);
-        (*channel)->name = sdsnew(channelname);
-        HASH_ADD_KEYPTR(hh, ctx->channels, (*channel)->name, sdslen((*channel)->name), *channel);
-    }
+    pthread_rwlock_wrlock(&ctx->channels_lock);
+    created = chirc_ctx_get_or_create_channel_locked(ctx, channelname, channel);
+    pthread_rwlock_unlock(&ctx->channels_lock);
 
     return created;
 }
@@ -205,27 +323,121 @@ bool chirc_ctx_get_or_create_channel(chirc_ctx_t *ctx, char *channelname, chirc_
 /* See ctx.h */
 int chirc_ctx_remove_channel(chirc_ctx_t *ctx, chirc_channel_t *channel)
 {
+    pthread_rwlock_wrlock(&ctx->channels_lock);
     HASH_DEL(ctx->channels, channel);
+    pthread_rwlock_unlock(&ctx->channels_lock);
+
+    atomic_fetch_sub(&ctx->counts.channels, 1);
 
     return CHIRC_OK;
 }
 
 
+/* See ctx.h */
+bool chirc_ctx_join_channel(chirc_ctx_t *ctx, char *channelname, chirc_user_t *user, chirc_channeluser_t **channeluser)
+{
+    chirc_channel_t *channel;
+    bool created;
+
+    /* Holding the channels lock ensures the channel can't be removed
+     * (by the last user in the channel leaving it) before we join it */
+    pthread_rwlock_wrlock(&ctx->channels_lock);
+    created = chirc_ctx_get_or_create_channel_locked(ctx, channelname, &channel);
+    chirc_channeluser_get_or_create(channel, user, channeluser);
+    pthread_rwlock_unlock(&ctx->channels_lock);
+
+    return created;
+}
+
+
+/* See ctx.h */
+bool chirc_ctx_part_channel(chirc_ctx_t *ctx, chirc_channeluser_t *channeluser)
+{
+    chirc_channel_t *channel = channeluser->channel;
+    bool removed;
+
+    pthread_rwlock_wrlock(&ctx->channels_lock);
+
+    chirc_channeluser_remove(channeluser);
+    chirc_channeluser_free(channeluser);
+    chirc_pool_free(&chirc_channeluser_pool, channeluser);
+
+    /* No one can join the channel while we hold the channels lock, so
+     * if it's empty now, it's safe to remove it */
+    pthread_rwlock_rdlock(&channel->lock);
+    removed = (channel->users == NULL);
+    pthread_rwlock_unlock(&channel->lock);
+
+    if (removed)
+    {
+        HASH_DEL(ctx->channels, channel);
+        atomic_fetch_sub(&ctx->counts.channels, 1);
+    }
+
+    pthread_rwlock_unlock(&ctx->channels_lock);
+
+    if (removed)
+    {
+        chirc_channel_free(channel);
+        chirc_pool_free(&chirc_channel_pool, channel);
+    }
+
+    return removed;
+}
+
+
 /* See ctx.h */
 chirc_user_t* chirc_ctx_get_user(chirc_ctx_t *ctx, char *nick)
 {
     chirc_user_t *user;
+    char key[FOLDED_MAX];
+
+    irc_casefold(key, nick, sizeof(key));
 
-    HASH_FIND_STR(ctx->users, nick, user);
+    pthread_rwlock_rdlock(&ctx->users_lock);
+    HASH_FIND_STR(ctx->users, key, user);
+    pthread_rwlock_unlock(&ctx->users_lock);
 
     return user;
 }
 
 
+/* See ctx.h */
+int chirc_ctx_send_to_user(chirc_ctx_t *ctx, char *nick, chirc_wire_t *wire)
+{
+    chirc_user_t *user;
+    char key[FOLDED_MAX];
+    int rc = CHIRC_FAIL;
+
+    irc_casefold(key, nick, sizeof(key));
+
+    /* A user is removed from the users hash table before its connection
+     * is detached (see chirc_ctx_detach_user), so holding the users
+     * lock keeps both the user and its connection from being freed */
+    pthread_rwlock_rdlock(&ctx->users_lock);
+    HASH_FIND_STR(ctx->users, key, user);
+    if (user)
+    {
+        pthread_mutex_lock(&user->lock);
+        if (user->conn)
+            rc = chirc_connection_send_wire(ctx, user->conn, wire);
+        pthread_mutex_unlock(&user->lock);
+    }
+    pthread_rwlock_unlock(&ctx->users_lock);
+
+    return rc;
+}
+
+
 /* See ctx.h */
 int chirc_ctx_add_user(chirc_ctx_t *ctx, chirc_user_t *user)
 {
-    HASH_ADD_KEYPTR(hh, ctx->users, user->nick, sdslen(user->nick), user);
+    if (!user->nick_folded)
+        user->nick_folded = chirc_ctx_fold_key(user->nick);
+
+    pthread_rwlock_wrlock(&ctx->users_lock);
+    HASH_ADD_KEYPTR(hh, ctx->users, user->nick_folded, sdslen(user->nick_folded), user);
+    pthread_rwlock_unlock(&ctx->users_lock);
 
     return CHIRC_OK;
 }
@@ -233,10 +445,13 @@ int chirc_ctx_add_user(chirc_ctx_t *ctx, chirc_user_t *user)
 /* See ctx.h */
 bool chirc_ctx_get_or_create_user(chirc_ctx_t *ctx, char *nick, chirc_user_t **user)
 {
+    char key[FOLDED_MAX];
     bool created;
 
+    irc_casefold(key, nick, sizeof(key));
 
-    HASH_FIND_STR(ctx->users, nick, *user);
+    pthread_rwlock_wrlock(&ctx->users_lock);
+    HASH_FIND_STR(ctx->users, key, *user);
     if(*user)
     {
         created = false;
@@ -245,24 +460,130 @@ bool chirc_ctx_get_or_create_user(chirc_ctx_t *ctx, char *nick, chirc_user_t **u
     {
         created = true;
 
-        *user = malloc(sizeof(chirc_user_t));
+        *user = chirc_pool_alloc(&chirc_user_pool);
         chirc_user_init(*user);
         (*user)->nick = sdsnew(nick);
-        HASH_ADD_KEYPTR(hh, ctx->users, (*user)->nick, sdslen((*user)->nick), *user);
+        (*user)->nick_folded = sdsnew(key);
+        HASH_ADD_KEYPTR(hh, ctx->users, (*user)->nick_folded, sdslen((*user)->nick_folded), *user);
     }
+    pthread_rwlock_unlock(&ctx->users_lock);
 
     return created;
 }
 
 
+/* See ctx.h */
+int chirc_ctx_rename_user(chirc_ctx_t *ctx, chirc_user_t *user, char *nick)
+{
+    chirc_user_t *other;
+    char key[FOLDED_MAX];
+    int rc = CHIRC_OK;
+
+    irc_casefold(key, nick, sizeof(key));
+
+    pthread_rwlock_wrlock(&ctx->users_lock);
+    HASH_FIND_STR(ctx->users, key, other);
+    /* A user can change the case of their own nick */
+    if (other && other != user)
+    {
+        rc = CHIRC_FAIL;
+    }
+    else
+    {
+        HASH_DEL(ctx->users, user);
+        pthread_mutex_lock(&user->lock);
+        sdsfree(user->nick);
+        user->nick = sdsnew(nick);
+        pthread_mutex_unlock(&user->lock);
+        sdsfree(user->nick_folded);
+        user->nick_folded = sdsnew(key);
+        HASH_ADD_KEYPTR(hh, ctx->users, user->nick_folded, sdslen(user->nick_folded), user);
+    }
+    pthread_rwlock_unlock(&ctx->users_lock);
+
+    return rc;
+}
+
+
+/* See ctx.h */
 int chirc_ctx_remove_user(chirc_ctx_t *ctx, chirc_user_t *user)
 {
-    HASH_DEL(ctx->users, user);
+    chirc_user_t *found = NULL;
+
+    pthread_rwlock_wrlock(&ctx->users_lock);
+    if (user->nick_folded)
+        HASH_FIND_STR(ctx->users, user->nick_folded, found);
+    if (found == user)
+        HASH_DEL(ctx->users, user);
+    pthread_rwlock_unlock(&ctx->users_lock);
+
+    /* The user was already removed (or never added) */
+    if (found != user)
+        return CHIRC_FAIL;
+
+    pthread_mutex_lock(&user->lock);
+    if (user->registered)
+        atomic_fetch_sub(&ctx->counts.users, 1);
+    if (chirc_user_has_mode(user, 'o'))
+        atomic_fetch_sub(&ctx->counts.ops, 1);
+    pthread_mutex_unlock(&user->lock);
 
     return CHIRC_OK;
 }
 
 
+/* See ctx.h */
+int chirc_ctx_register_user(chirc_ctx_t *ctx, chirc_user_t *user)
+{
+    int rc = CHIRC_OK;
+
+    pthread_mutex_lock(&user->lock);
+    if (user->registered)
+        rc = CHIRC_FAIL;
+    else
+    {
+        user->registered = true;
+        atomic_fetch_add(&ctx->counts.users, 1);
+    }
+    pthread_mutex_unlock(&user->lock);
+
+    return rc;
+}
+
+
+/* See ctx.h */
+int chirc_ctx_set_user_mode(chirc_ctx_t *ctx, chirc_user_t *user, char mode)
+{
+    int rc = CHIRC_OK;
+
+    pthread_mutex_lock(&user->lock);
+    if (!chirc_user_has_mode(user, mode))
+    {
+        rc = chirc_user_set_mode(user, mode);
+        if (rc == CHIRC_OK && mode == 'o')
+            atomic_fetch_add(&ctx->counts.ops, 1);
+    }
+    pthread_mutex_unlock(&user->lock);
+
+    return rc;
+}
+
+
+/* See ctx.h */
+int chirc_ctx_remove_user_mode(chirc_ctx_t *ctx, chirc_user_t *user, char mode)
+{
+    int rc;
+
+    pthread_mutex_lock(&user->lock);
+    rc = chirc_user_remove_mode(user, mode);
+    if (rc == CHIRC_OK && mode == 'o')
+        atomic_fetch_sub(&ctx->counts.ops, 1);
+    pthread_mutex_unlock(&user->lock);
+
+    return rc;
+}
+
+
 
 /* See ctx.h */
 chirc_server_t* chirc_ctx_get_server(chirc_ctx_t *ctx, char *servername)
@@ -284,6 +605,32 @@ int chirc_ctx_add_server(chirc_ctx_t *ctx, chirc_server_t *server)
 }
 
 
+/* See ctx.h */
+int chirc_ctx_register_server(chirc_ctx_t *ctx, chirc_server_t *server)
+{
+    if (server->registered)
+        return CHIRC_FAIL;
+
+    server->registered = true;
+    atomic_fetch_add(&ctx->counts.servers, 1);
+
+    return CHIRC_OK;
+}
+
+
+/* See ctx.h */
+int chirc_ctx_unregister_server(chirc_ctx_t *ctx, chirc_server_t *server)
+{
+    if (!server->registered)
+        return CHIRC_FAIL;
+
+    server->registered = false;
+    atomic_fetch_sub(&ctx->counts.servers, 1);
+
+    return CHIRC_OK;
+}
+
+
 /* See ctx.h */
 int chirc_ctx_load_network(chirc_ctx_t *ctx, char *file, char *servername)
 {
@@ -9,6 +9,14 @@
  *  and channels) can be accessed starting from this struct. This
  *  module provides some convenience functions for updating/accessing
  *  the information contained in the struct.
+ *
+ *  The server keeps count of its users, operators, unknown connections,
+ *  channels, and servers (as reported by LUSERS), instead of counting
+ *  them each time. For these counts to be correct, connection types,
+ *  user registrations, user modes, and server registrations must be
+ *  updated through the functions in this module (e.g., use
+ *  chirc_ctx_register_user instead of setting the user's registered
+ *  field directly).
  */
 
 #ifndef CTX_H_
@@ -47,6 +55,10 @@ void chirc_ctx_add_connection(chirc_ctx_t *ctx, chirc_connection_t *conn);
 
 
 /*! \brief Removes a connection from the server context
+ *
+ * If the connection's peer is a user, the user is detached from the
+ * server (see chirc_ctx_detach_user) and freed. This must be called
+ * before the connection is freed.
  *
  * \param ctx Server context
  * \param conn The connection to remove
@@ -54,6 +66,29 @@ void chirc_ctx_add_connection(chirc_ctx_t *ctx, chirc_connection_t *conn);
 void chirc_ctx_remove_connection(chirc_ctx_t *ctx, chirc_connection_t *conn);
 
 
+/*! \brief Detaches a user from the server, so that no other thread
+ *  can reach the user or its connection
+ *
+ * The user is removed from the users hash table, then from all its
+ * channels, and then its conn field is cleared (while holding the
+ * user's lock). Once this returns, the user's connection can be freed,
+ * and so can the user (but see chirc_ctx_get_user).
+ *
+ * \param ctx Server context
+ * \param user The user
+ */
+void chirc_ctx_detach_user(chirc_ctx_t *ctx, chirc_user_t *user);
+
+
+/*! \brief Sets the type of a connection
+ *
+ * \param ctx Server context
+ * \param conn The connection
+ * \param type The connection's new type
+ */
+void chirc_ctx_set_connection_type(chirc_ctx_t *ctx, chirc_connection_t *conn, conn_type_t type);
+
+
 /*! \brief Gets the number of registered users in the server
  *
  * Note that this function will exclude connections that haven't
@@ -74,6 +109,17 @@ int chirc_ctx_numusers(chirc_ctx_t *ctx);
 int chirc_ctx_numops(chirc_ctx_t *ctx);
 
 
+/*! \brief Gets the number of servers in the IRC network
+ *
+ * This includes the running server, and all the servers that
+ * have registered with it.
+ *
+ * \param ctx Server context
+ * \return Number of servers
+ */
+int chirc_ctx_numservers(chirc_ctx_t *ctx);
+
+
 /*! \brief Gets the number of channels in the server
  *
  * \param ctx Server context
@@ -96,6 +142,9 @@ int chirc_ctx_unknown_connections(chirc_ctx_t *ctx);
 
 /*!
  * \brief Get a channel with a given name (if one exists)
+ *
+ * Channel names are case-insensitive (see irc_casefold)
+ *
  * \param ctx Server context
  * \param channelname Channel name
  * \return The channel, if one exists. Otherwise, returns NULL.
@@ -107,7 +156,8 @@ chirc_channel_t* chirc_ctx_get_channel(chirc_ctx_t *ctx, char *channelname);
  * \brief Add a channel to the channels hash table.
  *
  * The channel struct must already be allocated/initialized,
- * and must have a valid value in its name field.
+ * and must have a valid value in its name field (its name_folded
+ * field is set from it, if it hasn't been set already).
  *
  * \param ctx Server context
  * \param channel Channel
@@ -135,6 +185,38 @@ int chirc_ctx_add_channel(chirc_ctx_t *ctx, chirc_channel_t *channel);
 bool chirc_ctx_get_or_create_channel(chirc_ctx_t *ctx, char *channelname, chirc_channel_t **channel);
 
 
+/*!
+ * \brief Join a channel
+ *
+ * Gets or creates a channel (like chirc_ctx_get_or_create_channel) and
+ * adds the user to it (like chirc_channeluser_get_or_create). Unlike
+ * calling those two functions separately, this function ensures that
+ * the channel isn't removed by another thread (because its last user
+ * left it) before the user joins it.
+ *
+ * \param ctx Server context
+ * \param channelname Channel name
+ * \param user User
+ * \param channeluser (Output parameter) User-in-Channel (the channel
+ *        can be accessed through its channel field)
+ * \return True if the channel was created, false otherwise
+ */
+bool chirc_ctx_join_channel(chirc_ctx_t *ctx, char *channelname, chirc_user_t *user, chirc_channeluser_t **channeluser);
+
+
+/*!
+ * \brief Leave a channel
+ *
+ * Removes the user from the channel, and frees the channeluser struct.
+ * If the channel is left empty, it is removed from the server and freed.
+ *
+ * \param ctx Server context
+ * \param channeluser User-in-Channel
+ * \return True if the channel was removed, false otherwise
+ */
+bool chirc_ctx_part_channel(chirc_ctx_t *ctx, chirc_channeluser_t *channeluser);
+
+
 /*!
  * \brief Remove a channel from the server
  *
@@ -142,6 +224,10 @@ bool chirc_ctx_get_or_create_channel(chirc_ctx_t *ctx, char *channelname, chirc_
  * It does not perform any operations on the channel itself
  * (e.g., it does not clear the list of users in the channel, etc.)
  *
+ * When a channel is removed because its last user left it, use
+ * chirc_ctx_part_channel instead (which ensures no one can join the
+ * channel while it's being removed)
+ *
  * \param ctx Server
  * \param channel Channel
  * \return 0 on success, non-zero on failure
@@ -151,18 +237,45 @@ int chirc_ctx_remove_channel(chirc_ctx_t *ctx, chirc_channel_t *channel);
 
 /*!
  * \brief Get a user with a given nick (if one exists)
+ *
+ * Nicks are case-insensitive (see irc_casefold)
+ *
+ * The users lock is released before returning, and users are freed
+ * when their connection is closed, which can happen in another thread
+ * at any time. So, the returned user can only be used safely by the
+ * thread handling the user's own connection (e.g., to check whether
+ * a nick is already in use, it's enough to compare the result with
+ * NULL). To send a message to another user, use chirc_ctx_send_to_user.
+ *
  * \param ctx Server context
  * \param nick User's nick
- * \return The channel, if one exists. Otherwise, returns NULL.
+ * \return The user, if one exists. Otherwise, returns NULL.
  */
 chirc_user_t* chirc_ctx_get_user(chirc_ctx_t *ctx, char *nick);
 
 
+/*!
+ * \brief Send a serialized message to the user with a given nick
+ *
+ * The message is sent while holding the users lock (for reading) and
+ * the user's lock, so the user and its connection can't be freed
+ * while it's being sent.
+ *
+ * \param ctx Server context
+ * \param nick User's nick
+ * \param wire The serialized message (see chirc_message_to_wire)
+ * \return 0 on success, non-zero if there is no user with that nick
+ *         (or it has no connection), or if the message could not be sent
+ */
+int chirc_ctx_send_to_user(chirc_ctx_t *ctx, char *nick, chirc_wire_t *wire);
+
+
 /*!
  * \brief Add a user to the users hash table
  *
  * The user struct must already be allocated/initialized,
- * and must have a valid value in its nick field.
+ * and must have a valid value in its nick field (its nick_folded
+ * field is set from it, if it hasn't been set already).
  *
  * \param ctx Server context
  * \param user User
@@ -190,16 +303,74 @@ int chirc_ctx_add_user(chirc_ctx_t *ctx, chirc_user_t *user);
 bool chirc_ctx_get_or_create_user(chirc_ctx_t *ctx, char *nick, chirc_user_t **user);
 
 
+/*!
+ * \brief Mark a user as registered
+ *
+ * \param ctx Server context
+ * \param user User
+ * \return 0 on success, non-zero if the user was already registered
+ */
+int chirc_ctx_register_user(chirc_ctx_t *ctx, chirc_user_t *user);
+
+
+/*!
+ * \brief Add a mode to a user
+ *
+ * This is a wrapper around chirc_user_set_mode that
+ * also keeps count of the IRC operators in the server.
+ *
+ * \param ctx Server context
+ * \param user User
+ * \param mode Mode
+ * \return 0 on success, non-zero on failure
+ */
+int chirc_ctx_set_user_mode(chirc_ctx_t *ctx, chirc_user_t *user, char mode);
+
+
+/*!
+ * \brief Remove a mode from a user
+ *
+ * This is a wrapper around chirc_user_remove_mode that
+ * also keeps count of the IRC operators in the server.
+ *
+ * \param ctx Server context
+ * \param user User
+ * \param mode Mode
+ * \return 0 on success, non-zero on failure (particularly
+ *         if the user does not have the specified mode)
+ */
+int chirc_ctx_remove_user_mode(chirc_ctx_t *ctx, chirc_user_t *user, char mode);
+
+
+/*!
+ * \brief Change a user's nick
+ *
+ * Checks that the nick is not in use and, if it isn't, updates the
+ * user's nick (and the users hash table). These are done atomically,
+ * so two users can't change their nick to the same nick at the
+ * same time.
+ *
+ * \param ctx Server context
+ * \param user User
+ * \param nick New nick
+ * \return 0 on success, non-zero if the nick is already in use
+ */
+int chirc_ctx_rename_user(chirc_ctx_t *ctx, chirc_user_t *user, char *nick);
+
+
 /*!
  * \brief Remove a user from the server
  *
  * This only removes the user from the users hash table.
  * It does not perform any operations on the user itself
  * (e.g., it does not clear the list of channels the user is in, etc.)
+ * To remove a user whose connection is closing, use
+ * chirc_ctx_detach_user instead.
  *
  * \param ctx Server
  * \param user User
- * \return 0 on success, non-zero on failure
+ * \return 0 on success, non-zero if the user is not in the
+ *         users hash table
  */
 int chirc_ctx_remove_user(chirc_ctx_t *ctx, chirc_user_t *user);
 
@@ -226,6 +397,27 @@ chirc_server_t* chirc_ctx_get_server(chirc_ctx_t *ctx, char *servername);
 int chirc_ctx_add_server(chirc_ctx_t *ctx, chirc_server_t *server);
 
 
+/*!
+ * \brief Mark a server as registered
+ *
+ * \param ctx Server context
+ * \param server Server
+ * \return 0 on success, non-zero if the server was already registered
+ */
+int chirc_ctx_register_server(chirc_ctx_t *ctx, chirc_server_t *server);
+
+
+/*!
+ * \brief Mark a server as no longer registered (e.g., when
+ *        its connection is closed)
+ *
+ * \param ctx Server context
+ * \param server Server
+ * \return 0 on success, non-zero if the server was not registered
+ */
+int chirc_ctx_unregister_server(chirc_ctx_t *ctx, chirc_server_t *server);
+
+
 /*! \brief Loads a network specification into the server context
  *
  * The network file is a CSV file like this:
@@ -24,6 +24,15 @@
  * array to add an entry for the new command. See the code
  * below for more details.
  *
+ * So that finding a command's handler doesn't require comparing the
+ * command against every entry in the "handlers" array, the array is
+ * indexed (the first time a message is handled) by a hash table that
+ * maps packed commands (see chirc_message_pack_cmd) to entries in the
+ * array. The same index is used to count how many messages have been
+ * dispatched to each handler, and to find each command's class (see
+ * cmd_class_t), which determines how much the command costs in terms
+ * of flood control.
+ *
  */
 #include <stdio.h>
 #include <stdlib.h>
@@ -31,6 +40,8 @@
 #include <string.h>
 #include <time.h>
 #include <assert.h>
+#include <pthread.h>
+#include <stdatomic.h>
 #include <sys/socket.h>
 #include <netdb.h>
 #include "ctx.h"
@@ -44,6 +55,8 @@
 #include "message.h"
 #include "user.h"
 #include "server.h"
+#include "motd.h"
+#include "lusers.h"
 
 
 /* The following typedef defines a type called "handler_function"
@@ -56,6 +69,8 @@ typedef int (*handler_function_t)(chirc_ctx_t *ctx, chirc_connection_t *conn, ch
 // Miscellaneous messages
 int chirc_handle_PING(chirc_ctx_t *ctx, chirc_connection_t *conn, chirc_message_t *msg);
 int chirc_handle_PONG(chirc_ctx_t *ctx, chirc_connection_t *conn, chirc_message_t *msg);
+int chirc_handle_MOTD(chirc_ctx_t *ctx, chirc_connection_t *conn, chirc_message_t *msg);
+int chirc_handle_LUSERS(chirc_ctx_t *ctx, chirc_connection_t *conn, chirc_message_t *msg);
 
 
 
@@ -92,37 +107,205 @@ struct handler_entry handlers[] =
 {
     HANDLER_ENTRY (PING),
     HANDLER_ENTRY (PONG),
+    HANDLER_ENTRY (MOTD),
+    HANDLER_ENTRY (LUSERS),
 
     NULL_ENTRY
 };
 
 
+/* The class of each command (for flood control; see cmd_class_t).
+ * Commands that are not in this table are in CMD_CLASS_DEFAULT,
+ * whether they have a handler or not. */
+static struct
+{
+    char *name;
+    cmd_class_t class;
+} command_classes[] =
+{
+    { "PING",    CMD_CLASS_KEEPALIVE },
+    { "PONG",    CMD_CLASS_KEEPALIVE },
+    { "PRIVMSG", CMD_CLASS_MESSAGE },
+    { "NOTICE",  CMD_CLASS_MESSAGE },
+    { "JOIN",    CMD_CLASS_CHANNEL },
+    { "PART",    CMD_CLASS_CHANNEL },
+    { "TOPIC",   CMD_CLASS_CHANNEL },
+    { "MODE",    CMD_CLASS_CHANNEL },
+    { "WHO",     CMD_CLASS_QUERY },
+    { "WHOIS",   CMD_CLASS_QUERY },
+    { "LIST",    CMD_CLASS_QUERY },
+    { "NAMES",   CMD_CLASS_QUERY },
+    { "LUSERS",  CMD_CLASS_QUERY },
+    { "MOTD",    CMD_CLASS_QUERY },
+    { "STATS",   CMD_CLASS_QUERY },
+    { NULL,      CMD_CLASS_DEFAULT }
+};
+
+/* Number of entries in the handlers array (not including the NULL_ENTRY) */
+#define NUM_HANDLERS (sizeof(handlers) / sizeof(struct handler_entry) - 1)
+
+/* Number of slots in the dispatch index. Must be a power of two,
+ * and comfortably larger than the number of handlers, so that most
+ * lookups find the command (or an empty slot) in the first slot */
+#define HANDLER_INDEX_BITS (7)
+#define HANDLER_INDEX_SIZE (1 << HANDLER_INDEX_BITS)
+
+/* The dispatch index: an open addressing hash table (with linear
+ * probing) that maps packed commands to positions in the handlers
+ * array (NUM_HANDLERS for commands that are only in the index because
+ * of their class), and to command classes. Empty slots have a code of 0. */
+struct handler_index_entry
+{
+    uint64_t code;
+    unsigned int handler;
+    cmd_class_t class;
+};
+
+static struct handler_index_entry handler_index[HANDLER_INDEX_SIZE];
+static pthread_once_t handler_index_once = PTHREAD_ONCE_INIT;
+
+/* Number of messages dispatched to each handler (in the same order
+ * as the handlers array). The last counter, in the position of the
+ * NULL_ENTRY, counts messages with commands that have no handler. */
+static atomic_ulong handler_hits[NUM_HANDLERS + 1];
+
+
+/* Returns the slot of the dispatch index where a packed command
+ * is (or where it would be, if it is not in the index) */
+static unsigned int chirc_handler_index_slot(uint64_t code)
+{
+    unsigned int slot;
+
+    /* Fibonacci hashing */
+    slot = (code * 0x9E3779B97F4A7C15ULL) >> (64 - HANDLER_INDEX_BITS);
+
+    while (handler_index[slot].code != 0 && handler_index[slot].code != code)
+        slot = (slot + 1) & (HANDLER_INDEX_SIZE - 1);
+
+    return slot;
+}
+
+
+/* Builds the dispatch index from the handlers array */
+static void chirc_handler_index_init()
+{
+    unsigned int slot;
+    uint64_t code;
+
+    assert(NUM_HANDLERS + sizeof(command_classes) / sizeof(command_classes[0]) < HANDLER_INDEX_SIZE / 2);
+
+    for(int h=0; handlers[h].name != NULL; h++)
+    {
+        code = chirc_message_pack_cmd(handlers[h].name);
+        /* Handled commands must be short enough to be packed */
+        assert(code != 0);
+
+        slot = chirc_handler_index_slot(code);
+        handler_index[slot].code = code;
+        handler_index[slot].handler = h;
+        handler_index[slot].class = CMD_CLASS_DEFAULT;
+    }
+
+    for(int c=0; command_classes[c].name != NULL; c++)
+    {
+        code = chirc_message_pack_cmd(command_classes[c].name);
+        assert(code != 0);
+
+        slot = chirc_handler_index_slot(code);
+        if (handler_index[slot].code == 0)
+        {
+            handler_index[slot].code = code;
+            handler_index[slot].handler = NUM_HANDLERS;
+        }
+        handler_index[slot].class = command_classes[c].class;
+    }
+}
+
+
+/* Returns the position of a command's handler in the handlers
+ * array, or NUM_HANDLERS if the command has no handler */
+static unsigned int chirc_handler_lookup(uint64_t code)
+{
+    unsigned int slot;
+
+    pthread_once(&handler_index_once, chirc_handler_index_init);
+
+    if (code == 0)
+        return NUM_HANDLERS;
+
+    slot = chirc_handler_index_slot(code);
+    if (handler_index[slot].code == 0)
+        return NUM_HANDLERS;
+
+    return handler_index[slot].handler;
+}
+
+
+/* See handlers.h */
+cmd_class_t chirc_handler_class(uint64_t cmdcode)
+{
+    unsigned int slot;
+
+    pthread_once(&handler_index_once, chirc_handler_index_init);
+
+    if (cmdcode == 0)
+        return CMD_CLASS_DEFAULT;
+
+    slot = chirc_handler_index_slot(cmdcode);
+    if (handler_index[slot].code == 0)
+        return CMD_CLASS_DEFAULT;
+
+    return handler_index[slot].class;
+}
+
+
 /* See handlers.h */
 int chirc_handle(chirc_ctx_t *ctx, chirc_connection_t *conn, chirc_message_t *msg)
 {
-    chirc_message_t reply;
-    int rc=0, h;
+    int rc=0;
+    unsigned int h;
 
     /* Print message to the server log */
-    serverlog(DEBUG, conn, "Handling command %s", msg->cmd);
-    for(int i=0; i<msg->nparams; i++)
-        serverlog(DEBUG, conn, "%s[%i] = %s", msg->cmd, i + 1, msg->params[i]);
-
-    /* Search the dispatch table for an entry corresponding to the
-     * message we are processing */
-    for(h=0; handlers[h].name != NULL; h++)
-        if (!strcmp(msg->cmd, handlers[h].name))
-        {
+    if (chirc_log_enabled(DEBUG))
+    {
+        serverlog(DEBUG, conn, "Handling command %s", msg->cmd);
+        for(int i=0; i<msg->nparams; i++)
+            serverlog(DEBUG, conn, "%s[%i] = %s", msg->cmd, i + 1, msg->params[i]);
+    }
 
-            rc = handlers[h].func(ctx, conn, msg);
-            break;
-        }
+    /* Look up the entry in the dispatch table corresponding
+     * to the message we are processing */
+    h = chirc_handler_lookup(msg->cmdcode);
+
+    atomic_fetch_add_explicit(&handler_hits[h], 1, memory_order_relaxed);
 
+    /* PINGs and PONGs don't count towards a user's idle time */
+    if (handlers[h].func != chirc_handle_PING && handlers[h].func != chirc_handle_PONG)
+        atomic_store_explicit(&conn->last_active, chirc_timer_now(), memory_order_relaxed);
+
+    if (handlers[h].func)
+        rc = handlers[h].func(ctx, conn, msg);
 
     return rc;
 }
 
 
+/* See handlers.h */
+unsigned long chirc_handler_hits(char *cmd)
+{
+    unsigned int h = NUM_HANDLERS;
+
+    if (cmd)
+    {
+        h = chirc_handler_lookup(chirc_message_pack_cmd(cmd));
+        if (h == NUM_HANDLERS)
+            return 0;
+    }
+
+    return atomic_load_explicit(&handler_hits[h], memory_order_relaxed);
+}
+
+
 int chirc_handle_PING(chirc_ctx_t *ctx, chirc_connection_t *conn, chirc_message_t *msg)
 {
     /* Construct a reply to the PING */
@@ -150,4 +333,42 @@ int chirc_handle_PONG(chirc_ctx_t *ctx, chirc_connection_t *conn, chirc_message_
     return CHIRC_OK;
 }
 
+/* Sends an ERR_NOTREGISTERED reply */
+static int chirc_reply_not_registered(chirc_ctx_t *ctx, chirc_connection_t *conn)
+{
+    chirc_message_t reply;
+    int rc;
+
+    chirc_message_construct(&reply, ctx->network.this_server->servername, ERR_NOTREGISTERED);
+    chirc_message_add_parameter(&reply, "*", false);
+    chirc_message_add_parameter(&reply, "You have not registered", true);
+    rc = chirc_connection_send_message(ctx, conn, &reply);
+    chirc_message_free(&reply);
 
+    return rc;
+}
+
+int chirc_handle_MOTD(chirc_ctx_t *ctx, chirc_connection_t *conn, chirc_message_t *msg)
+{
+    int rc;
+
+    /* The MOTD is only sent to registered users */
+    if (conn->type != CONN_TYPE_USER)
+        rc = chirc_reply_not_registered(ctx, conn);
+    else
+        rc = chirc_motd_send(ctx, conn, conn->peer.user->nick);
+
+    return rc ? CHIRC_HANDLER_DISCONNECT : CHIRC_OK;
+}
+
+int chirc_handle_LUSERS(chirc_ctx_t *ctx, chirc_connection_t *conn, chirc_message_t *msg)
+{
+    int rc;
+
+    if (conn->type != CONN_TYPE_USER)
+        rc = chirc_reply_not_registered(ctx, conn);
+    else
+        rc = chirc_lusers_send(ctx, conn, conn->peer.user->nick);
+
+    return rc ? CHIRC_HANDLER_DISCONNECT : CHIRC_OK;
+}
@@ -38,4 +38,23 @@
  */
 int chirc_handle(chirc_ctx_t *ctx, chirc_connection_t *conn, chirc_message_t *msg);
 
+/*! \brief Returns the class of a command (for flood control)
+ *
+ * \param cmdcode The packed command (see chirc_message_pack_cmd)
+ * \return The command's class (CMD_CLASS_DEFAULT if the
+ *         command isn't in any other class)
+ */
+cmd_class_t chirc_handler_class(uint64_t cmdcode);
+
+/*! \brief Returns the number of messages dispatched to a command's handler
+ *
+ * This is the information needed to reply to a "STATS m" query.
+ *
+ * \param cmd Command. If NULL, returns the number of messages
+ *        with commands that have no handler.
+ * \return Number of messages with that command that have been handled
+ *         (0 if the command has no handler)
+ */
+unsigned long chirc_handler_hits(char *cmd);
+
 #endif /* HANDLERS_H_ */
@@ -1,67 +1,318 @@
 /* See log.h for details about the functions in this module */
 
 #include <stdio.h>
+#include <stdlib.h>
 #include <stdarg.h>
 #include <string.h>
 #include <time.h>
+#include <pthread.h>
+#include <stdatomic.h>
 
 #include "log.h"
 
 
+/* Maximum length of a log message (longer messages are truncated) */
+#define LOG_LINE_MAX (512)
+
+/* How long the logger thread sleeps when there is nothing to
+ * write (in nanoseconds) */
+#define LOG_IDLE_SLEEP (10 * 1000 * 1000)
+
+
+/* A single-producer, single-consumer ring buffer of formatted log
+ * messages. Each thread that logs something has its own ring buffer
+ * (so threads never contend with each other when logging), which
+ * is drained by the logger thread.
+ *
+ * head is only written by the thread that owns the ring, and tail
+ * is only written by whoever drains the ring, which must hold
+ * drain_lock. That is normally the logger thread, but the owner
+ * of the ring also drains it (instead of waiting for the logger
+ * thread) if the ring is full. */
+typedef struct log_ring
+{
+    /* Number of messages the ring can hold (a power of two) */
+    size_t slots;
+
+    atomic_size_t head;
+    atomic_size_t tail;
+    pthread_mutex_t drain_lock;
+
+    /* Set when the thread that owns the ring exits. The logger
+     * thread frees the ring once it has been drained. */
+    atomic_bool orphaned;
+
+    struct log_ring *next;
+
+    char lines[][LOG_LINE_MAX];
+} log_ring_t;
+
+
 /* Logging level. Set by default to print just informational messages */
-static int loglevel = INFO;
+static atomic_int loglevel = INFO;
+
+/* Number of messages the ring buffers of new threads can hold */
+static atomic_size_t ring_slots = LOG_RING_SLOTS_DEFAULT;
+
+/* All the ring buffers (protected by rings_lock) */
+static log_ring_t *rings = NULL;
+static pthread_mutex_t rings_lock = PTHREAD_MUTEX_INITIALIZER;
+
+/* Used to start the logger thread the first time something is logged */
+static pthread_once_t logger_once = PTHREAD_ONCE_INIT;
+
+/* Used to mark a thread's ring buffer as orphaned when the thread exits */
+static pthread_key_t ring_key;
+
+/* The calling thread's ring buffer, and its cached timestamp (which
+ * is only reformatted when the current second changes) */
+static __thread log_ring_t *thread_ring = NULL;
+static __thread time_t thread_ts_sec = 0;
+static __thread char thread_ts[32];
 
 
 void chirc_setloglevel(loglevel_t level)
 {
-    loglevel = level;
+    atomic_store(&loglevel, level);
 }
 
-/* This function does the actual logging and is called by chilog().
- * It has a va_list parameter instead of being a variadic function */
-void __chilog(loglevel_t level, char *fmt, va_list argptr)
+
+/* See log.h */
+void chirc_log_set_ring_slots(size_t slots)
 {
-    time_t t;
-    char buf[80], *levelstr;
+    size_t n = 1;
 
-    if(level > loglevel)
-        return;
+    while (n < slots)
+        n <<= 1;
+
+    atomic_store(&ring_slots, n);
+}
+
+
+/* See log.h */
+bool chirc_log_enabled(loglevel_t level)
+{
+    return level <= atomic_load_explicit(&loglevel, memory_order_relaxed);
+}
+
+
+/* Writes all the messages in a ring buffer to stdout. Must be
+ * called with the ring's drain_lock held. Returns the number
+ * of messages written. */
+static size_t chirc_log_drain(log_ring_t *ring)
+{
+    size_t head, tail, n;
+
+    tail = atomic_load_explicit(&ring->tail, memory_order_relaxed);
+    head = atomic_load_explicit(&ring->head, memory_order_acquire);
+
+    flockfile(stdout);
+    for (n = tail; n != head; n++)
+        fputs(ring->lines[n & (ring->slots - 1)], stdout);
+    funlockfile(stdout);
+
+    atomic_store_explicit(&ring->tail, head, memory_order_release);
+
+    return head - tail;
+}
+
+
+/* Drains all the ring buffers, and frees the ones whose
+ * threads have exited. Returns the number of messages written. */
+static size_t chirc_log_drain_all()
+{
+    log_ring_t **prev, *ring;
+    size_t n = 0;
+
+    pthread_mutex_lock(&rings_lock);
+
+    prev = &rings;
+    while ((ring = *prev) != NULL)
+    {
+        pthread_mutex_lock(&ring->drain_lock);
+        n += chirc_log_drain(ring);
+        pthread_mutex_unlock(&ring->drain_lock);
+
+        /* An orphaned ring can't get any new messages, so once
+         * it has been drained, it can be freed */
+        if (atomic_load(&ring->orphaned))
+        {
+            *prev = ring->next;
+            pthread_mutex_destroy(&ring->drain_lock);
+            free(ring);
+        }
+        else
+            prev = &ring->next;
+    }
+
+    pthread_mutex_unlock(&rings_lock);
+
+    if (n > 0)
+        fflush(stdout);
+
+    return n;
+}
+
+
+/* The logger thread */
+static void *chirc_log_thread(void *args)
+{
+    struct timespec idle = {0, LOG_IDLE_SLEEP};
+
+    while (true)
+        if (chirc_log_drain_all() == 0)
+            nanosleep(&idle, NULL);
+
+    return NULL;
+}
 
-    t = time(NULL);
-    strftime(buf,80,"%Y-%m-%d %H:%M:%S",localtime(&t));
 
+/* Called when a thread that has a ring buffer exits */
+static void chirc_log_thread_exit(void *ring)
+{
+    atomic_store(&((log_ring_t *) ring)->orphaned, true);
+}
+
+
+/* Called when the server exits, so the messages that the
+ * logger thread hasn't written yet aren't lost */
+static void chirc_log_exit()
+{
+    chirc_log_drain_all();
+}
+
+
+/* Starts the logger thread */
+static void chirc_log_start()
+{
+    pthread_t logger;
+
+    pthread_key_create(&ring_key, chirc_log_thread_exit);
+
+    if (pthread_create(&logger, NULL, chirc_log_thread, NULL) == 0)
+        pthread_detach(logger);
+
+    atexit(chirc_log_exit);
+}
+
+
+/* Returns the calling thread's ring buffer (creating it, if necessary) */
+static log_ring_t *chirc_log_ring()
+{
+    log_ring_t *ring;
+    size_t slots;
+
+    if (thread_ring)
+        return thread_ring;
+
+    pthread_once(&logger_once, chirc_log_start);
+
+    slots = atomic_load_explicit(&ring_slots, memory_order_relaxed);
+    ring = malloc(sizeof(log_ring_t) + slots * LOG_LINE_MAX);
+    if (!ring)
+        return NULL;
+
+    ring->slots = slots;
+    atomic_init(&ring->head, 0);
+    atomic_init(&ring->tail, 0);
+    atomic_init(&ring->orphaned, false);
+    pthread_mutex_init(&ring->drain_lock, NULL);
+
+    pthread_mutex_lock(&rings_lock);
+    ring->next = rings;
+    rings = ring;
+    pthread_mutex_unlock(&rings_lock);
+
+    pthread_setspecific(ring_key, ring);
+    thread_ring = ring;
+
+    return ring;
+}
+
+
+/* Returns the current time, formatted for the log. The formatted
+ * time is cached, and is only updated when the second changes */
+static char *chirc_log_timestamp()
+{
+    struct timespec now;
+    struct tm tm;
+
+    clock_gettime(CLOCK_REALTIME_COARSE, &now);
+
+    if (now.tv_sec != thread_ts_sec)
+    {
+        thread_ts_sec = now.tv_sec;
+        localtime_r(&now.tv_sec, &tm);
+        strftime(thread_ts, sizeof(thread_ts), "%Y-%m-%d %H:%M:%S", &tm);
+    }
+
+    return thread_ts;
+}
+
+
+/* Returns the name of a log level, as shown in the log */
+static char *chirc_log_levelstr(loglevel_t level)
+{
     switch(level)
     {
     case CRITICAL:
-        levelstr = "CRITIC";
-        break;
+        return "CRITIC";
     case ERROR:
-        levelstr = "ERROR";
-        break;
+        return "ERROR";
     case WARNING:
-        levelstr = "WARN";
-        break;
+        return "WARN";
     case INFO:
-        levelstr = "INFO";
-        break;
+        return "INFO";
     case DEBUG:
-        levelstr = "DEBUG";
-        break;
+        return "DEBUG";
     case TRACE:
-        levelstr = "TRACE";
-        break;
+        return "TRACE";
     default:
-        levelstr = "UNKNOWN";
-        break;
+        return "UNKNOWN";
     }
+}
 
-    flockfile(stdout);
-    printf("[%s] %6s ", buf, levelstr);
 
-    vprintf(fmt, argptr);
-    printf("\n");
-    funlockfile(stdout);
-    fflush(stdout);
+/* This function does the actual logging and is called by chilog()
+ * and serverlog(). It has a va_list parameter instead of being a
+ * variadic function. The message is formatted into the calling
+ * thread's ring buffer, and is written by the logger thread. */
+static void __chilog(loglevel_t level, char *prefix, char *fmt, va_list argptr)
+{
+    log_ring_t *ring;
+    char *line;
+    size_t head;
+    int n;
+
+    ring = chirc_log_ring();
+    if (!ring)
+        return;
+
+    head = atomic_load_explicit(&ring->head, memory_order_relaxed);
+
+    /* If the ring is full, we drain it ourselves */
+    if (head - atomic_load_explicit(&ring->tail, memory_order_acquire) == ring->slots)
+    {
+        pthread_mutex_lock(&ring->drain_lock);
+        chirc_log_drain(ring);
+        pthread_mutex_unlock(&ring->drain_lock);
+        fflush(stdout);
+    }
+
+    line = ring->lines[head & (ring->slots - 1)];
+
+    n = snprintf(line, LOG_LINE_MAX, "[%s] %6s %s", chirc_log_timestamp(), chirc_log_levelstr(level), prefix);
+    if (n < LOG_LINE_MAX - 1)
+        n += vsnprintf(line + n, LOG_LINE_MAX - n, fmt, argptr);
+
+    /* Make sure the line always ends in a newline, even if it
+     * had to be truncated */
+    if (n > LOG_LINE_MAX - 2)
+        n = LOG_LINE_MAX - 2;
+    line[n] = '\n';
+    line[n + 1] = '\0';
+
+    atomic_store_explicit(&ring->head, head + 1, memory_order_release);
 }
 
 /* See log.h */
@@ -69,8 +320,11 @@ void chilog(loglevel_t level, char *fmt, ...)
 {
     va_list argptr;
 
+    if (!chirc_log_enabled(level))
+        return;
+
     va_start(argptr, fmt);
-    __chilog(level, fmt, argptr);
+    __chilog(level, "", fmt, argptr);
     va_end(argptr);
 }
 
@@ -79,33 +333,34 @@ void serverlog(loglevel_t level, chirc_connection_t *conn, char *fmt, ...)
 {
     char buf[256];
 
+    if (!chirc_log_enabled(level))
+        return;
+
     if (conn)
     {
         if(conn->type == CONN_TYPE_UNKNOWN)
         {
-            sprintf(buf, "%s -- ", conn->hostname);
+            snprintf(buf, sizeof(buf), "%s -- ", conn->hostname);
         }
         else if(conn->type == CONN_TYPE_USER)
         {
             chirc_user_t *user = conn->peer.user;
             if(user->nick)
-                sprintf(buf, "%s!%s@%s -- ", user->nick, user->username, conn->hostname);
+                snprintf(buf, sizeof(buf), "%s!%s@%s -- ", user->nick, user->username, conn->hostname);
             else
-                sprintf(buf, "unknown!unknown@%s -- ", conn->hostname);
+                snprintf(buf, sizeof(buf), "unknown!unknown@%s -- ", conn->hostname);
         }
         else if (conn->type == CONN_TYPE_SERVER)
         {
-            sprintf(buf, "%s -- ", conn->peer.server->servername);
+            snprintf(buf, sizeof(buf), "%s -- ", conn->peer.server->servername);
         }
     }
     else
         buf[0] = '\0';
 
-    strncat(buf, fmt, 256 - strlen(buf) - 1);
-
     va_list argptr;
 
     va_start(argptr, fmt);
-    __chilog(level, buf, argptr);
+    __chilog(level, buf, fmt, argptr);
     va_end(argptr);
 }
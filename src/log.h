@@ -11,13 +11,42 @@
  *  DEBUG: Lower-level information
  *  TRACE: Very low-level information.
  *
+ *  The level of a message is checked before the message is formatted,
+ *  so messages at levels that are not being printed cost next to nothing.
+ *
+ *  Log messages are not written to stdout right away: each thread
+ *  formats its messages into its own ring buffer (without taking
+ *  any locks), and a dedicated logger thread writes them out.
+ *  So, messages from the same thread are always printed in order,
+ *  but messages from different threads may be printed slightly
+ *  out of order. Any messages that haven't been written when the
+ *  server exits are written by an atexit handler.
+ *
+ *  Each ring buffer holds LOG_RING_SLOTS_DEFAULT messages of up to
+ *  512 bytes (128 KiB per thread). When the server creates one thread
+ *  per connection, that would be 128 KiB per connection, so in that
+ *  mode the connection threads get rings of LOG_RING_SLOTS_CONNECTION
+ *  messages instead (see chirc_log_set_ring_slots). When a thread's
+ *  ring is full, the thread writes the messages out itself, so a
+ *  smaller ring only means that a burst of log messages is written
+ *  by the thread that logs them, instead of by the logger thread.
+ *
  */
 
 #ifndef CHIRC_LOG_H_
 #define CHIRC_LOG_H_
 
+#include <stdbool.h>
+#include <stddef.h>
 #include "connection.h"
 
+/*! \brief Default number of messages each thread's ring buffer can hold */
+#define LOG_RING_SLOTS_DEFAULT (256)
+
+/*! \brief Number of messages the ring buffer of each connection thread
+ *  can hold, in thread-per-connection mode (16 KiB per connection) */
+#define LOG_RING_SLOTS_CONNECTION (32)
+
 /*! \brief Log levels */
 typedef enum {
     QUIET    = 00,
@@ -39,6 +68,25 @@ typedef enum {
  */
 void chirc_setloglevel(loglevel_t level);
 
+/*! \brief Sets the number of messages each thread's ring buffer can hold
+ *
+ * Only affects the threads that log something for the first time after
+ * this is called (the ring buffers of other threads keep their size).
+ *
+ * \param slots Number of messages (rounded up to a power of two)
+ */
+void chirc_log_set_ring_slots(size_t slots);
+
+/*! \brief Checks whether messages at a given level are being printed
+ *
+ * Use this to skip work that is only needed to produce
+ * log messages (e.g., a loop that logs several messages)
+ *
+ * \param level Logging level
+ * \return True if messages at that level are printed
+ */
+bool chirc_log_enabled(loglevel_t level);
+
 /*! \brief Print a log message
  *
  * \param level Logging level of the message
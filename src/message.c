@@ -1,6 +1,7 @@
 /* See message.h for details about the functions in this module */
 
 #include <stdlib.h>
+#include <stdint.h>
 #include <string.h>
 #include <ctype.h>
 #include <assert.h>
@@ -8,121 +9,341 @@
 #include "reply.h"
 #include "connection.h"
 
-/* See message.h */
-int chirc_message_from_string(chirc_message_t *msg, char *s)
+/* Skips the spaces at *p and, if there is a token after them, terminates
+ * it with a NUL and leaves *p pointing right after it. Returns the start
+ * of the token, or NULL if there were no more tokens. */
+static char *chirc_message_next_token(char **p)
 {
-    char *params[15], *pch, *msgstr, *i, *saveptr;
-    unsigned int len;
+    char *start, *end;
 
-    len = strlen(s);
+    for (start = *p; *start == ' '; start++) ;
 
-    msg->nparams = 0;
+    if (*start == '\0')
+    {
+        *p = start;
+        return NULL;
+    }
+
+    for (end = start; *end != ' ' && *end != '\0'; end++) ;
 
-    msgstr = malloc(len);
+    if (*end == ' ')
+        *end++ = '\0';
+    *p = end;
 
-    strncpy(msgstr, s, len - 2);
-    msgstr[len-2] = '\0';
+    return start;
+}
 
-    // For ":" lookahead
-    msgstr[len-1] = '\0';
 
-    pch = strtok_r(msgstr, " ", &saveptr);
-    if (!pch)
+/* See message.h */
+uint64_t chirc_message_pack_cmd(char *cmd)
+{
+    uint64_t code = 0;
+
+    for (size_t i = 0; cmd[i] != '\0'; i++)
     {
-        free(msgstr);
-        return -1;
+        if (i == CHIRC_CMDCODE_MAX)
+            return 0;
+        code = (code << 8) | (unsigned char) toupper(cmd[i]);
     }
 
-    if (*pch == ':')
+    return code;
+}
+
+
+/* See message.h */
+int chirc_message_parse(chirc_message_t *msg, char *s, size_t len)
+{
+    char *p = s, *i;
+
+    s[len] = '\0';
+
+    msg->prefix = NULL;
+    msg->nparams = 0;
+    msg->longlast = false;
+    msg->raw = s;
+    msg->framelen = 0;
+
+    msg->cmd = chirc_message_next_token(&p);
+    if (!msg->cmd)
+        return -1;
+
+    if (*msg->cmd == ':')
     {
-        msg->prefix = pch+1;
-        pch = strtok_r(NULL, " ", &saveptr);
+        msg->prefix = msg->cmd + 1;
+        msg->cmd = chirc_message_next_token(&p);
         /* If the message starts with a prefix, there
            has to be something after the prefix */
-        if (!pch)
-        {
-            free(msgstr);
+        if (!msg->cmd)
             return -1;
-        }
     }
-    else
-        msg->prefix = NULL;
 
-    msg->cmd = pch;
-    for(i=pch; *i; i++)
+    for(i = msg->cmd; *i; i++)
         *i = toupper(*i);
+    msg->cmdcode = chirc_message_pack_cmd(msg->cmd);
 
-    msg->longlast = 0;
-
-    while (pch != NULL)
+    while (msg->nparams < MSG_MAX_PARAMS)
     {
-        i = pch;
-        while (*i++) ;
+        while (*p == ' ')
+            p++;
+        if (*p == '\0')
+            break;
 
-        if (*i == ':')
+        /* The last parameter (either because it starts with a ":",
+         * or because it's the last one allowed) takes up the
+         * rest of the message, spaces included */
+        if (*p == ':' || msg->nparams == MSG_MAX_PARAMS - 1)
         {
-            params[msg->nparams++] = i + 1;
-            msg->longlast = 1;
+            if (*p == ':')
+                p++;
+            msg->params[msg->nparams++] = p;
+            msg->longlast = true;
             break;
         }
 
-        pch = strtok_r(NULL, " ", &saveptr);
-        if(!pch)
-            break;
-        params[msg->nparams++] = pch;
+        msg->params[msg->nparams++] = chirc_message_next_token(&p);
     }
 
-    for (int i=0; i < msg->nparams; i++)
-    {
-        msg->params[i] = params[i];
-    }
+    return 0;
+}
 
-    msg->raw = msgstr;
+
+/* See message.h */
+int chirc_message_from_string(chirc_message_t *msg, char *s)
+{
+    size_t len;
+
+    len = strlen(s);
+    if (len >= 2 && s[len - 2] == '\r' && s[len - 1] == '\n')
+        len -= 2;
+
+    if (len > MSG_MAX - 2)
+        len = MSG_MAX - 2;
+
+    memcpy(msg->frame, s, len);
+
+    if (chirc_message_parse(msg, msg->frame, len))
+        return -1;
+
+    msg->framelen = len + 1;
 
     return 0;
 }
 
 
-/* See message.h */
-int chirc_message_to_string(chirc_message_t *msg, char **s)
+/* Returns the length of the string representation of a message
+ * (including the trailing \r\n) */
+static size_t chirc_message_len(chirc_message_t *msg)
 {
-    char buffer[1024];
+    size_t len;
 
-    buffer[0] = '\0';
+    len = strlen(msg->cmd) + 2;
+
+    if (msg->prefix)
+        len += strlen(msg->prefix) + 2;
+
+    for(int i=0; i < msg->nparams; i++)
+        len += strlen(msg->params[i]) + 1;
+
+    if (msg->nparams > 0 && msg->longlast)
+        len++;
+
+    return len;
+}
+
+
+/* Writes the string representation of a message into buf, which
+ * must have room for chirc_message_len(msg) + 1 bytes */
+static void chirc_message_write(chirc_message_t *msg, char *buf)
+{
+    size_t n;
 
     if (msg->prefix)
     {
-        strcat(buffer, ":");
-        strcat(buffer, msg->prefix);
-        strcat(buffer, " ");
+        *buf++ = ':';
+        n = strlen(msg->prefix);
+        memcpy(buf, msg->prefix, n);
+        buf += n;
+        *buf++ = ' ';
     }
 
-    strcat(buffer, msg->cmd);
+    n = strlen(msg->cmd);
+    memcpy(buf, msg->cmd, n);
+    buf += n;
 
     for(int i=0; i < msg->nparams; i++)
     {
-        strcat(buffer, " ");
+        *buf++ = ' ';
         if (i== msg->nparams - 1 && msg->longlast)
-            strcat(buffer, ":");
-        strcat(buffer, msg->params[i]);
+            *buf++ = ':';
+        n = strlen(msg->params[i]);
+        memcpy(buf, msg->params[i], n);
+        buf += n;
     }
-    strcat(buffer,"\r\n");
 
-    *s = strdup(buffer);
+    memcpy(buf, "\r\n", 3);
+}
+
+
+/* See message.h */
+int chirc_message_to_string(chirc_message_t *msg, char **s)
+{
+    *s = malloc(chirc_message_len(msg) + 1);
+    if (!*s)
+        return -1;
+
+    chirc_message_write(msg, *s);
 
     return 0;
 }
 
 
+/* See message.h */
+int chirc_message_serialize(chirc_message_t *msg, char *buf, size_t size, size_t *len)
+{
+    *len = chirc_message_len(msg);
+    if (*len + 1 > size)
+        return -1;
+
+    chirc_message_write(msg, buf);
+
+    return 0;
+}
+
+
+/* Allocates a chirc_wire_t with room for len bytes
+ * (plus a NUL), and a reference count of 1 */
+static chirc_wire_t *chirc_wire_alloc(size_t len)
+{
+    chirc_wire_t *wire;
+
+    wire = malloc(sizeof(chirc_wire_t) + len + 1);
+    if (!wire)
+        return NULL;
+
+    atomic_init(&wire->refcount, 1);
+    wire->len = len;
+
+    return wire;
+}
+
+
+/* See message.h */
+chirc_wire_t *chirc_message_to_wire(chirc_message_t *msg)
+{
+    chirc_wire_t *wire;
+
+    wire = chirc_wire_alloc(chirc_message_len(msg));
+    if (!wire)
+        return NULL;
+
+    chirc_message_write(msg, wire->data);
+
+    return wire;
+}
+
+
+/* See message.h */
+chirc_wire_t *chirc_wire_new(char *data, size_t len)
+{
+    chirc_wire_t *wire;
+
+    wire = chirc_wire_alloc(len);
+    if (!wire)
+        return NULL;
+
+    memcpy(wire->data, data, len);
+    wire->data[len] = '\0';
+
+    return wire;
+}
+
+
+/* See message.h */
+chirc_wire_t *chirc_wire_from_iov(struct iovec *iov, int iovcnt, size_t skip)
+{
+    chirc_wire_t *wire;
+    size_t len = 0, n, pos = 0;
+
+    for (int i = 0; i < iovcnt; i++)
+        len += iov[i].iov_len;
+
+    wire = chirc_wire_alloc(len - skip);
+    if (!wire)
+        return NULL;
+
+    for (int i = 0; i < iovcnt; i++)
+    {
+        n = iov[i].iov_len;
+        if (skip >= n)
+        {
+            skip -= n;
+            continue;
+        }
+
+        memcpy(wire->data + pos, (char *) iov[i].iov_base + skip, n - skip);
+        pos += n - skip;
+        skip = 0;
+    }
+    wire->data[pos] = '\0';
+
+    return wire;
+}
+
+
+/* See message.h */
+chirc_wire_t *chirc_wire_ref(chirc_wire_t *wire)
+{
+    atomic_fetch_add(&wire->refcount, 1);
+
+    return wire;
+}
+
+
+/* See message.h */
+void chirc_wire_unref(chirc_wire_t *wire)
+{
+    if (atomic_fetch_sub(&wire->refcount, 1) == 1)
+        free(wire);
+}
+
+
+/* Copies (at most max bytes of) a string into the message's frame,
+ * and returns a pointer to the copy */
+static char *chirc_message_copy(chirc_message_t *msg, char *str, size_t max)
+{
+    char *copy = msg->frame + msg->framelen;
+    size_t n;
+
+    n = strnlen(str, max);
+    memcpy(copy, str, n);
+    copy[n] = '\0';
+    msg->framelen += n + 1;
+
+    return copy;
+}
+
+
 /* See message.h */
 int chirc_message_construct(chirc_message_t *msg, char *prefix, char *cmd)
 {
+    size_t len;
+
+    /* ":prefix cmd\r\n" or "cmd\r\n" */
+    len = strlen(cmd) + 2;
     if (prefix)
-        msg->prefix = strdup(prefix);
+        len += strlen(prefix) + 2;
+    if (len > MSG_MAX)
+        return -1;
+
+    msg->framelen = 0;
+
+    if (prefix)
+        msg->prefix = chirc_message_copy(msg, prefix, SIZE_MAX);
     else
         msg->prefix = NULL;
 
-    msg->cmd = strdup(cmd);
+    msg->cmd = chirc_message_copy(msg, cmd, SIZE_MAX);
+    msg->cmdcode = chirc_message_pack_cmd(cmd);
     msg->nparams = 0;
     msg->longlast = 0;
     msg->raw = NULL;
@@ -134,7 +355,25 @@ int chirc_message_construct(chirc_message_t *msg, char *prefix, char *cmd)
 /* See message.h */
 int chirc_message_add_parameter(chirc_message_t *msg, char *param, bool longlast)
 {
-    msg->params[msg->nparams++] = strdup(param);
+    size_t len, max;
+
+    if (msg->nparams == MSG_MAX_PARAMS)
+        return -1;
+
+    /* Length of the message on the wire so far, without the ":" before
+     * the last parameter. The frame contains each field followed by a
+     * NUL, which takes up the same space as the spaces between the
+     * fields (and the ":" before the prefix, if there is one) */
+    len = msg->framelen + 2 - (msg->prefix ? 0 : 1);
+
+    /* The parameter is preceded by a space (and a ":", if it
+     * is a long parameter), and is truncated to whatever fits */
+    len += 1 + (longlast ? 1 : 0);
+    if (len >= MSG_MAX)
+        return -1;
+    max = MSG_MAX - len;
+
+    msg->params[msg->nparams++] = chirc_message_copy(msg, param, max);
     msg->longlast = longlast;
 
     return 0;
@@ -178,18 +417,13 @@ int chirc_message_construct_reply(chirc_message_t *msg, chirc_ctx_t *ctx, chirc_
 /* See message.h */
 void chirc_message_free(chirc_message_t *msg)
 {
-    if(msg->raw)
-    {
-        free(msg->raw);
-    }
-    else
-    {
-        free(msg->prefix);
-        free(msg->cmd);
-        for(int i=0; i < msg->nparams; i++)
-        {
-            free(msg->params[i]);
-        }
-    }
+    /* The fields of the message point into its frame, or into
+     * a buffer owned by the caller, so there is nothing to free */
+    msg->prefix = NULL;
+    msg->cmd = NULL;
+    msg->cmdcode = 0;
+    msg->nparams = 0;
+    msg->raw = NULL;
+    msg->framelen = 0;
 }
 
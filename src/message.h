@@ -11,6 +11,11 @@
  *      chirc_message_t *msg = malloc(sizeof(chirc_message_t));
  *      chirc_message_from_string(msg, "PRIVMSG jrandom :Hello, how are you?");
  *
+ *  chirc_message_from_string copies the string into the message's frame
+ *  (see chirc_message_t). Messages read from a connection are instead
+ *  parsed in place, with chirc_message_parse, so the fields of the message
+ *  point directly into the connection's input buffer.
+ *
  *  chirc_message_from_string will initialize all the fields in the msg variable
  *  to reflect the contents of the message string. For example:
  *
@@ -49,21 +54,68 @@
  *
  *  After this call, the str variable will point to a string containing
  *  the string representation of the message.
+ *
+ *  None of the functions that parse or construct a message allocate any
+ *  memory: the fields of a message are stored in a fixed-size frame inside
+ *  the chirc_message_t struct, and parameters are truncated if they would
+ *  make the message longer than MSG_MAX bytes. chirc_message_serialize
+ *  writes a message into a buffer provided by the caller, so a message
+ *  can be parsed, constructed, and sent without a single allocation.
  */
 #ifndef MESSAGE_H_
 #define MESSAGE_H_
 
+#include <sys/uio.h>
 #include "chirc.h"
 
+/*! Maximum length of a command that can be packed with chirc_message_pack_cmd */
+#define CHIRC_CMDCODE_MAX (8)
+
 /*! \brief Construct a message starting from a string containing an IRC message
+ *
+ * The string is copied into the message's frame (and truncated
+ * to MSG_MAX bytes, including the trailing \r\n, if necessary)
  *
  * \param msg Message. Must point to allocated memory.
- * \param s String containing an IRC message
+ * \param s String containing an IRC message (the trailing
+ *          \r\n is optional)
  * \return 0 on success, non-zero if the message couldn't be parsed
  */
 int chirc_message_from_string(chirc_message_t *msg, char *s);
 
 
+/*! \brief Parses an IRC message in place
+ *
+ * Unlike chirc_message_from_string, the message is not copied:
+ * the buffer is modified (spaces between fields are replaced by NULs,
+ * and the command is converted to uppercase), and the fields of
+ * the message point into it. The buffer must not be modified or
+ * freed while the message is in use.
+ *
+ * \param msg Message. Must point to allocated memory.
+ * \param s Buffer containing an IRC message, without the
+ *          trailing \r\n
+ * \param len Length of the message. s[len] must be writable
+ *            (it will be set to NUL)
+ * \return 0 on success, non-zero if the message couldn't be parsed
+ */
+int chirc_message_parse(chirc_message_t *msg, char *s, size_t len);
+
+
+/*! \brief Packs a command into an integer
+ *
+ * Each character of the command (converted to uppercase) takes up one
+ * byte of the integer, so two commands have the same code if and only
+ * if they are the same command. This is the code stored in the cmdcode
+ * field of chirc_message_t.
+ *
+ * \param cmd Command (e.g., "PRIVMSG" or "001")
+ * \return The packed command, or 0 if the command is empty or longer
+ *         than CHIRC_CMDCODE_MAX characters
+ */
+uint64_t chirc_message_pack_cmd(char *cmd);
+
+
 /*! \brief Produces a string representation of the message
  *
  * \param msg Message.
@@ -74,6 +126,76 @@ int chirc_message_from_string(chirc_message_t *msg, char *s);
 int chirc_message_to_string(chirc_message_t *msg, char **s);
 
 
+/*! \brief Writes the string representation of a message into a buffer
+ *
+ * \param msg Message.
+ * \param buf Buffer. The string representation (including the trailing
+ *            \r\n) is NUL-terminated.
+ * \param size Size of the buffer. Any message constructed with
+ *             chirc_message_construct fits in MSG_MAX + 1 bytes.
+ * \param len Set to the length of the string representation
+ *            (not including the NUL)
+ * \return 0 on success, non-zero if the buffer is too small
+ */
+int chirc_message_serialize(chirc_message_t *msg, char *buf, size_t size, size_t *len);
+
+
+/*! \brief Serializes a message into a chirc_wire_t struct
+ *
+ * The returned struct has a reference count of 1. Use chirc_wire_ref
+ * to add a reference each time it is shared (e.g., when it is queued
+ * for sending through a connection), and chirc_wire_unref to release
+ * each reference.
+ *
+ * \param msg Message.
+ * \return Serialized message, or NULL if memory could not be allocated
+ */
+chirc_wire_t *chirc_message_to_wire(chirc_message_t *msg);
+
+
+/*! \brief Creates a chirc_wire_t struct with a copy of the given bytes
+ *
+ * The returned struct has a reference count of 1 (see chirc_message_to_wire)
+ *
+ * \param data Bytes to copy (typically, a serialized message or
+ *             the part of it that hasn't been sent yet)
+ * \param len Number of bytes
+ * \return Serialized message, or NULL if memory could not be allocated
+ */
+chirc_wire_t *chirc_wire_new(char *data, size_t len);
+
+
+/*! \brief Creates a chirc_wire_t struct with a copy of the bytes
+ *  in an array of buffers (as used by writev/sendmsg)
+ *
+ * The returned struct has a reference count of 1 (see chirc_message_to_wire)
+ *
+ * \param iov Buffers
+ * \param iovcnt Number of buffers
+ * \param skip Number of bytes (from the start of the first buffer)
+ *        not to copy (e.g., because they have already been sent)
+ * \return Serialized message, or NULL if memory could not be allocated
+ */
+chirc_wire_t *chirc_wire_from_iov(struct iovec *iov, int iovcnt, size_t skip);
+
+
+/*! \brief Adds a reference to a serialized message
+ *
+ * \param wire Serialized message
+ * \return The same serialized message
+ */
+chirc_wire_t *chirc_wire_ref(chirc_wire_t *wire);
+
+
+/*! \brief Releases a reference to a serialized message
+ *
+ * The struct is freed when its last reference is released.
+ *
+ * \param wire Serialized message
+ */
+void chirc_wire_unref(chirc_wire_t *wire);
+
+
 /*! \brief Constructs a message
  *
  * The message is constructed with the given prefix and command,
@@ -82,7 +204,8 @@ int chirc_message_to_string(chirc_message_t *msg, char **s);
  * \param msg Message. Must point to allocated memory.
  * \param prefix Prefix (can be NULL)
  * \param cmd Command (cannot be NULL)
- * \return 0 on success, non-zero on failure
+ * \return 0 on success, non-zero on failure (if the prefix and
+ *         command don't fit in a message)
  */
 int chirc_message_construct(chirc_message_t *msg, char *prefix, char *cmd);
 
@@ -94,7 +217,10 @@ int chirc_message_construct(chirc_message_t *msg, char *prefix, char *cmd);
  * \param longlast If true, the parameter is a "long parameter" and will be
  *        rendered with a ":" before it (note: only the last parameter can
  *        be a long parameter).
- * \return 0 on success, non-zero on failure
+ * \return 0 on success (the parameter is truncated if the message would
+ *         otherwise be longer than MSG_MAX bytes), non-zero if the message
+ *         already has MSG_MAX_PARAMS parameters or there is no room left
+ *         in it
  */
 int chirc_message_add_parameter(chirc_message_t *msg, char *param, bool longlast);
 
@@ -119,10 +245,10 @@ int chirc_message_construct_reply(chirc_message_t *msg, chirc_ctx_t *ctx, chirc_
 
 /*! \brief Frees a chirc_message_t struct
  *
- * This function frees memory allocated to the fields of a
- * chirc_message_t struct, but does not free the struct
- * itself (doing so is the responsibility of the caller
- * of this function)
+ * The fields of a chirc_message_t struct are not allocated
+ * separately, so this function only resets them. It does not
+ * free the struct itself (doing so is the responsibility of
+ * the caller of this function)
  *
  * \param msg The message to free
  */
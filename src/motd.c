@@ -0,0 +1,275 @@
+/* See motd.h for details about the functions in this module */
+
+#include <stdlib.h>
+#include <string.h>
+#include <unistd.h>
+#include <fcntl.h>
+#include <pthread.h>
+#include <stdatomic.h>
+#include <sys/stat.h>
+#include <sys/mman.h>
+#include <sys/uio.h>
+
+#include "motd.h"
+#include "connection.h"
+#include "reply.h"
+#include "log.h"
+
+/* Number of replies sent with each sendmsg() call (each reply takes
+ * three buffers: everything before the nick, the nick, and everything
+ * after the nick). Only very long MOTDs need more than one call. */
+#define MOTD_REPLIES_PER_SEND (128)
+
+/* Space reserved for the nick when truncating MOTD lines, so that
+ * the RPL_MOTD replies don't exceed MSG_MAX bytes */
+#define MOTD_NICK_MAX (32)
+
+
+/* The kinds of reply in a MOTD */
+enum
+{
+    MOTD_START = 0,
+    MOTD_LINE,
+    MOTD_END,
+    MOTD_MISSING,
+    MOTD_NUM_HEADS
+};
+
+/* A serialized reply, except for the nick */
+typedef struct
+{
+    /* Everything before the nick (e.g., ":server 372 "). Points
+     * to one of the heads of the MOTD, so it isn't freed separately */
+    sds head;
+
+    /* Everything after the nick (e.g., " :- Hello\r\n") */
+    sds tail;
+} chirc_motd_reply_t;
+
+/* A cached MOTD */
+typedef struct
+{
+    atomic_int refcount;
+
+    /* The file the MOTD was read from (or exists is false,
+     * if there was no file) */
+    bool exists;
+    dev_t dev;
+    ino_t ino;
+    off_t size;
+    struct timespec mtime;
+
+    sds heads[MOTD_NUM_HEADS];
+
+    chirc_motd_reply_t *replies;
+    size_t nreplies;
+} chirc_motd_t;
+
+
+/* The current MOTD (protected by motd_lock). Threads that are sending
+ * the MOTD hold a reference to it, so it can be replaced at any time. */
+static chirc_motd_t *motd = NULL;
+static pthread_mutex_t motd_lock = PTHREAD_MUTEX_INITIALIZER;
+
+
+/* Releases a reference to a cached MOTD */
+static void chirc_motd_unref(chirc_motd_t *m)
+{
+    if (m == NULL || atomic_fetch_sub(&m->refcount, 1) > 1)
+        return;
+
+    for (size_t i = 0; i < m->nreplies; i++)
+        sdsfree(m->replies[i].tail);
+    for (int i = 0; i < MOTD_NUM_HEADS; i++)
+        sdsfree(m->heads[i]);
+    free(m->replies);
+    free(m);
+}
+
+
+/* Adds a reply to a cached MOTD (there must be room for it) */
+static void chirc_motd_add(chirc_motd_t *m, int kind, sds tail)
+{
+    m->replies[m->nreplies].head = m->heads[kind];
+    m->replies[m->nreplies].tail = tail;
+    m->nreplies++;
+}
+
+
+/* Reads the MOTD file (which is mapped into memory while it is split
+ * into lines), and serializes the MOTD replies. Returns NULL if memory
+ * could not be allocated. */
+static chirc_motd_t *chirc_motd_load(chirc_ctx_t *ctx)
+{
+    char *servername = ctx->network.this_server->servername;
+    chirc_motd_t *m;
+    struct stat st;
+    char *map = NULL, *line, *nl, *end;
+    size_t nlines = 0, len, max;
+    int fd;
+
+    m = calloc(1, sizeof(chirc_motd_t));
+    if (!m)
+        return NULL;
+    atomic_init(&m->refcount, 1);
+
+    m->heads[MOTD_START] = sdscatprintf(sdsempty(), ":%s %s ", servername, RPL_MOTDSTART);
+    m->heads[MOTD_LINE] = sdscatprintf(sdsempty(), ":%s %s ", servername, RPL_MOTD);
+    m->heads[MOTD_END] = sdscatprintf(sdsempty(), ":%s %s ", servername, RPL_ENDOFMOTD);
+    m->heads[MOTD_MISSING] = sdscatprintf(sdsempty(), ":%s %s ", servername, ERR_NOMOTD);
+
+    fd = open(MOTD_FILE, O_RDONLY | O_CLOEXEC);
+    if (fd != -1 && fstat(fd, &st) == 0)
+    {
+        m->exists = true;
+        m->dev = st.st_dev;
+        m->ino = st.st_ino;
+        m->size = st.st_size;
+        m->mtime = st.st_mtim;
+
+        if (st.st_size > 0)
+        {
+            map = mmap(NULL, st.st_size, PROT_READ, MAP_PRIVATE, fd, 0);
+            if (map == MAP_FAILED)
+            {
+                serverlog(ERROR, NULL, "Could not read %s", MOTD_FILE);
+                map = NULL;
+                m->exists = false;
+            }
+        }
+    }
+    if (fd != -1)
+        close(fd);
+
+    if (!m->exists)
+    {
+        m->replies = calloc(1, sizeof(chirc_motd_reply_t));
+        if (!m->replies)
+        {
+            chirc_motd_unref(m);
+            return NULL;
+        }
+        chirc_motd_add(m, MOTD_MISSING, sdsnew(" :MOTD File is missing\r\n"));
+        return m;
+    }
+
+    end = map + m->size;
+    for (line = map; line < end; line = nl + 1)
+    {
+        nl = memchr(line, '\n', end - line);
+        nlines++;
+        if (!nl)
+            break;
+    }
+
+    m->replies = calloc(nlines + 2, sizeof(chirc_motd_reply_t));
+    if (!m->replies)
+    {
+        if (map)
+            munmap(map, m->size);
+        chirc_motd_unref(m);
+        return NULL;
+    }
+
+    chirc_motd_add(m, MOTD_START, sdscatprintf(sdsempty(), " :- %s Message of the day - \r\n", servername));
+
+    max = MSG_MAX - sdslen(m->heads[MOTD_LINE]) - MOTD_NICK_MAX - strlen(" :- \r\n");
+    for (line = map; line < end; line = nl + 1)
+    {
+        nl = memchr(line, '\n', end - line);
+        if (!nl)
+            nl = end;
+
+        len = nl - line;
+        if (len > 0 && line[len - 1] == '\r')
+            len--;
+        if (len > max)
+            len = max;
+
+        chirc_motd_add(m, MOTD_LINE, sdscat(sdscatlen(sdsnew(" :- "), line, len), "\r\n"));
+    }
+
+    chirc_motd_add(m, MOTD_END, sdsnew(" :End of MOTD command\r\n"));
+
+    if (map)
+        munmap(map, m->size);
+
+    return m;
+}
+
+
+/* Checks whether the MOTD file has changed since it was cached */
+static bool chirc_motd_changed(chirc_motd_t *m)
+{
+    struct stat st;
+
+    if (stat(MOTD_FILE, &st) == -1)
+        return m->exists;
+
+    return !m->exists || st.st_dev != m->dev || st.st_ino != m->ino || st.st_size != m->size
+           || st.st_mtim.tv_sec != m->mtime.tv_sec || st.st_mtim.tv_nsec != m->mtime.tv_nsec;
+}
+
+
+/* See motd.h */
+int chirc_motd_send(chirc_ctx_t *ctx, chirc_connection_t *conn, char *nick)
+{
+    struct iovec iov[MOTD_REPLIES_PER_SEND * 3];
+    chirc_motd_t *m, *old;
+    size_t nicklen = strlen(nick);
+    int niov = 0, rc = CHIRC_OK;
+
+    pthread_mutex_lock(&motd_lock);
+    if (motd == NULL || chirc_motd_changed(motd))
+    {
+        m = chirc_motd_load(ctx);
+        if (m)
+        {
+            old = motd;
+            motd = m;
+            chirc_motd_unref(old);
+        }
+    }
+    m = motd;
+    if (m)
+        atomic_fetch_add(&m->refcount, 1);
+    pthread_mutex_unlock(&motd_lock);
+
+    if (!m)
+        return CHIRC_FAIL;
+
+    for (size_t i = 0; i < m->nreplies && rc == CHIRC_OK; i++)
+    {
+        iov[niov].iov_base = m->replies[i].head;
+        iov[niov].iov_len = sdslen(m->replies[i].head);
+        iov[niov + 1].iov_base = nick;
+        iov[niov + 1].iov_len = nicklen;
+        iov[niov + 2].iov_base = m->replies[i].tail;
+        iov[niov + 2].iov_len = sdslen(m->replies[i].tail);
+        niov += 3;
+
+        if (niov == sizeof(iov) / sizeof(iov[0]) || i == m->nreplies - 1)
+        {
+            rc = chirc_connection_send_iov(ctx, conn, iov, niov);
+            niov = 0;
+        }
+    }
+
+    chirc_motd_unref(m);
+
+    return rc;
+}
+
+
+/* See motd.h */
+void chirc_motd_invalidate()
+{
+    chirc_motd_t *old;
+
+    pthread_mutex_lock(&motd_lock);
+    old = motd;
+    motd = NULL;
+    pthread_mutex_unlock(&motd_lock);
+
+    chirc_motd_unref(old);
+}
@@ -0,0 +1,42 @@
+/*! \file motd.h
+ *  \brief Message of the day
+ *
+ *  The message of the day (MOTD) is read from the MOTD_FILE file in the
+ *  server's working directory, and is sent to users when they register,
+ *  and when they send a MOTD command.
+ *
+ *  Instead of reading the file every time, the server keeps the MOTD
+ *  replies (RPL_MOTDSTART, one RPL_MOTD per line, and RPL_ENDOFMOTD, or
+ *  ERR_NOMOTD if there is no file) already serialized in memory, except
+ *  for the nick they are addressed to, and sends them all with a single
+ *  sendmsg() call (the nick is spliced in between the buffers of each
+ *  reply). The file is only read again if it changes (i.e., if its inode,
+ *  size, or modification time change), or if the cached MOTD is
+ *  explicitly invalidated (e.g., by a REHASH command).
+ */
+
+#ifndef MOTD_H_
+#define MOTD_H_
+
+#include "chirc.h"
+
+/*! \brief Name of the file with the message of the day */
+#define MOTD_FILE "motd.txt"
+
+
+/*! \brief Sends the message of the day to a user
+ *
+ * \param ctx Server context
+ * \param conn The user's connection
+ * \param nick The user's nick
+ * \return 0 on success, non-zero on failure
+ */
+int chirc_motd_send(chirc_ctx_t *ctx, chirc_connection_t *conn, char *nick);
+
+
+/*! \brief Discards the cached message of the day, so the file
+ *  is read again the next time the MOTD is sent
+ */
+void chirc_motd_invalidate();
+
+#endif /* MOTD_H_ */
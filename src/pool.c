@@ -0,0 +1,262 @@
+/* See pool.h for details about the functions in this module */
+
+#include <stdlib.h>
+#include <string.h>
+#include <stdbool.h>
+#include <stdalign.h>
+#include <stdint.h>
+#include <unistd.h>
+
+#include "pool.h"
+#include "chirc.h"
+#include "log.h"
+
+
+/* A block of memory with room for CHIRC_POOL_SLAB_OBJS structs */
+struct chirc_pool_slab
+{
+    struct chirc_pool_slab *next;
+    alignas(max_align_t) char data[];
+};
+
+/* A thread's cache of free structs for a pool. Free structs (in the
+ * caches and in the pools' free lists) are linked through their
+ * first bytes */
+typedef struct
+{
+    void *head;
+    size_t count;
+} chirc_pool_cache_t;
+
+
+chirc_pool_t chirc_user_pool = CHIRC_POOL_INITIALIZER(0, "users", chirc_user_t);
+chirc_pool_t chirc_channel_pool = CHIRC_POOL_INITIALIZER(1, "channels", chirc_channel_t);
+chirc_pool_t chirc_channeluser_pool = CHIRC_POOL_INITIALIZER(2, "channelusers", chirc_channeluser_t);
+chirc_pool_t chirc_connection_pool = CHIRC_POOL_INITIALIZER(3, "connections", chirc_connection_t);
+
+/* All the pools (in the order of their indices) */
+static chirc_pool_t *pools[] =
+{
+    &chirc_user_pool,
+    &chirc_channel_pool,
+    &chirc_channeluser_pool,
+    &chirc_connection_pool,
+    NULL
+};
+
+/* The calling thread's caches (one per pool) */
+static __thread chirc_pool_cache_t thread_caches[CHIRC_POOL_MAX];
+static __thread bool thread_caches_registered = false;
+
+/* Used to return a thread's caches to the pools when the thread exits */
+static pthread_key_t caches_key;
+static pthread_once_t caches_key_once = PTHREAD_ONCE_INIT;
+
+
+/* Returns the size of each struct in a pool, rounded up
+ * so every struct in a slab is properly aligned */
+static size_t chirc_pool_stride(chirc_pool_t *pool)
+{
+    size_t align = alignof(max_align_t);
+
+    return (pool->objsize + align - 1) / align * align;
+}
+
+
+/* Moves (at most) n structs from a pool's free list to a cache,
+ * allocating a new slab if the free list is empty. Returns the
+ * number of structs moved. */
+static size_t chirc_pool_refill(chirc_pool_t *pool, chirc_pool_cache_t *cache, size_t n)
+{
+    chirc_pool_slab_t *slab;
+    size_t stride, moved;
+    void *obj;
+
+    pthread_mutex_lock(&pool->lock);
+
+    if (pool->free_list == NULL)
+    {
+        stride = chirc_pool_stride(pool);
+        slab = malloc(sizeof(chirc_pool_slab_t) + stride * CHIRC_POOL_SLAB_OBJS);
+        if (slab)
+        {
+            slab->next = pool->slabs;
+            pool->slabs = slab;
+            pool->nslabs++;
+
+            for (size_t i = CHIRC_POOL_SLAB_OBJS; i > 0; i--)
+            {
+                obj = slab->data + (i - 1) * stride;
+                *(void **) obj = pool->free_list;
+                pool->free_list = obj;
+            }
+            pool->nfree += CHIRC_POOL_SLAB_OBJS;
+        }
+    }
+
+    for (moved = 0; moved < n && pool->free_list != NULL; moved++)
+    {
+        obj = pool->free_list;
+        pool->free_list = *(void **) obj;
+        *(void **) obj = cache->head;
+        cache->head = obj;
+    }
+    pool->nfree -= moved;
+    cache->count += moved;
+
+    pthread_mutex_unlock(&pool->lock);
+
+    return moved;
+}
+
+
+/* Moves (at most) n structs from a cache to a pool's free list */
+static void chirc_pool_drain(chirc_pool_t *pool, chirc_pool_cache_t *cache, size_t n)
+{
+    size_t moved;
+    void *obj;
+
+    pthread_mutex_lock(&pool->lock);
+
+    for (moved = 0; moved < n && cache->head != NULL; moved++)
+    {
+        obj = cache->head;
+        cache->head = *(void **) obj;
+        *(void **) obj = pool->free_list;
+        pool->free_list = obj;
+    }
+    pool->nfree += moved;
+    cache->count -= moved;
+
+    pthread_mutex_unlock(&pool->lock);
+}
+
+
+/* Called when a thread that has used the pools exits */
+static void chirc_pool_thread_exit(void *caches)
+{
+    for (int i = 0; pools[i] != NULL; i++)
+        chirc_pool_drain(pools[i], &((chirc_pool_cache_t *) caches)[i], SIZE_MAX);
+}
+
+
+static void chirc_pool_create_key()
+{
+    pthread_key_create(&caches_key, chirc_pool_thread_exit);
+}
+
+
+/* Returns the calling thread's cache for a pool */
+static chirc_pool_cache_t *chirc_pool_cache(chirc_pool_t *pool)
+{
+    if (!thread_caches_registered)
+    {
+        pthread_once(&caches_key_once, chirc_pool_create_key);
+        pthread_setspecific(caches_key, thread_caches);
+        thread_caches_registered = true;
+    }
+
+    return &thread_caches[pool->index];
+}
+
+
+/* See pool.h */
+void *chirc_pool_alloc(chirc_pool_t *pool)
+{
+    chirc_pool_cache_t *cache;
+    void *obj;
+
+    cache = chirc_pool_cache(pool);
+
+    if (cache->head == NULL && chirc_pool_refill(pool, cache, CHIRC_POOL_BATCH) == 0)
+        return NULL;
+
+    obj = cache->head;
+    cache->head = *(void **) obj;
+    cache->count--;
+
+    atomic_fetch_add_explicit(&pool->in_use, 1, memory_order_relaxed);
+
+    memset(obj, 0, pool->objsize);
+
+    return obj;
+}
+
+
+/* See pool.h */
+void chirc_pool_free(chirc_pool_t *pool, void *obj)
+{
+    chirc_pool_cache_t *cache;
+
+    if (obj == NULL)
+        return;
+
+    cache = chirc_pool_cache(pool);
+
+    *(void **) obj = cache->head;
+    cache->head = obj;
+    cache->count++;
+
+    atomic_fetch_sub_explicit(&pool->in_use, 1, memory_order_relaxed);
+
+    /* Don't let a thread hoard free structs (e.g., a thread that
+     * frees many structs that were allocated by other threads) */
+    if (cache->count >= 2 * CHIRC_POOL_BATCH)
+        chirc_pool_drain(pool, cache, CHIRC_POOL_BATCH);
+}
+
+
+/* See pool.h */
+void chirc_pool_log_occupancy()
+{
+    chirc_pool_t *pool;
+    size_t in_use, allocated, nslabs;
+
+    for (int i = 0; pools[i] != NULL; i++)
+    {
+        pool = pools[i];
+
+        pthread_mutex_lock(&pool->lock);
+        nslabs = pool->nslabs;
+        pthread_mutex_unlock(&pool->lock);
+
+        in_use = atomic_load_explicit(&pool->in_use, memory_order_relaxed);
+        allocated = nslabs * CHIRC_POOL_SLAB_OBJS;
+
+        chilog(INFO, "Pool %-12s %8zu in use / %8zu allocated (%zu slabs, %zu KB)",
+               pool->name, in_use, allocated, nslabs,
+               nslabs * (sizeof(chirc_pool_slab_t) + chirc_pool_stride(pool) * CHIRC_POOL_SLAB_OBJS) / 1024);
+    }
+}
+
+
+/* Periodically logs the occupancy of the pools */
+static void *chirc_pool_reporter(void *args)
+{
+    unsigned int interval = (unsigned int) (uintptr_t) args;
+
+    while (true)
+    {
+        sleep(interval);
+        chirc_pool_log_occupancy();
+    }
+
+    return NULL;
+}
+
+
+/* See pool.h */
+int chirc_pool_start_reporter(unsigned int interval)
+{
+    pthread_t reporter;
+
+    if (pthread_create(&reporter, NULL, chirc_pool_reporter, (void *) (uintptr_t) interval) != 0)
+    {
+        chilog(ERROR, "Could not start the pool reporter thread");
+        return CHIRC_FAIL;
+    }
+
+    pthread_detach(reporter);
+
+    return CHIRC_OK;
+}
@@ -0,0 +1,144 @@
+/*! \file pool.h
+ *  \brief Object pools
+ *
+ *  The structs that are created and freed as users connect, join
+ *  channels, etc. (chirc_user_t, chirc_channel_t, chirc_channeluser_t,
+ *  and chirc_connection_t) are not allocated individually with malloc.
+ *  Instead, each type of struct has its own pool, which allocates
+ *  memory for many structs at once (a "slab") and keeps the structs
+ *  that are freed in a free list, so they can be reused. So, a server
+ *  with lots of connections coming and going doesn't fragment the heap,
+ *  and its memory usage stays flat once the pools are large enough
+ *  (memory is never returned from a pool to the system).
+ *
+ *  To avoid contention between threads, each thread also keeps a small
+ *  cache of free structs for each pool, and only takes the pool's lock
+ *  when it needs to refill its cache, or return part of it to the pool.
+ *
+ *  The pools are global variables (chirc_user_pool, etc.) and don't
+ *  need to be initialized. To allocate a struct, use chirc_pool_alloc
+ *  instead of malloc (and then initialize the struct as usual), and use
+ *  chirc_pool_free instead of free:
+ *
+ *      chirc_user_t *user = chirc_pool_alloc(&chirc_user_pool);
+ *      chirc_user_init(user);
+ *      ...
+ *      chirc_user_free(user);
+ *      chirc_pool_free(&chirc_user_pool, user);
+ */
+
+#ifndef POOL_H_
+#define POOL_H_
+
+#include <stddef.h>
+#include <pthread.h>
+#include <stdatomic.h>
+
+/*! \brief Maximum number of pools */
+#define CHIRC_POOL_MAX (8)
+
+/*! \brief Number of structs allocated at a time by a pool */
+#define CHIRC_POOL_SLAB_OBJS (256)
+
+/*! \brief Number of structs moved at a time between a pool
+ *  and a thread's cache */
+#define CHIRC_POOL_BATCH (32)
+
+/* Forward declaration */
+typedef struct chirc_pool_slab chirc_pool_slab_t;
+
+/*! \struct chirc_pool_t
+ * \brief A pool of structs of the same type
+ *
+ * Do not access the fields of this struct directly. Use the
+ * functions in this module instead.
+ */
+typedef struct
+{
+    /*! \brief Name of the pool (used when reporting its occupancy) */
+    char *name;
+
+    /*! \brief Index of the pool in each thread's caches */
+    unsigned int index;
+
+    /*! \brief Size of the structs in the pool */
+    size_t objsize;
+
+    /*! \brief Protects the free list and the slabs */
+    pthread_mutex_t lock;
+
+    /*! \brief Free structs that are not in any thread's cache */
+    void *free_list;
+
+    /*! \brief Number of structs in free_list */
+    size_t nfree;
+
+    /*! \brief Slabs allocated by the pool */
+    chirc_pool_slab_t *slabs;
+
+    /*! \brief Number of slabs allocated by the pool */
+    size_t nslabs;
+
+    /*! \brief Number of structs that have been allocated
+     *  with chirc_pool_alloc and not freed yet */
+    atomic_size_t in_use;
+} chirc_pool_t;
+
+/*! \brief Static initializer for a pool
+ *
+ * \param INDEX Index of the pool (each pool must have a different
+ *        index, from 0 to CHIRC_POOL_MAX - 1)
+ * \param NAME Name of the pool
+ * \param TYPE Type of the structs in the pool
+ */
+#define CHIRC_POOL_INITIALIZER(INDEX, NAME, TYPE) \
+    { NAME, INDEX, sizeof(TYPE), PTHREAD_MUTEX_INITIALIZER, NULL, 0, NULL, 0, 0 }
+
+/*! \brief Pool of chirc_user_t structs */
+extern chirc_pool_t chirc_user_pool;
+
+/*! \brief Pool of chirc_channel_t structs */
+extern chirc_pool_t chirc_channel_pool;
+
+/*! \brief Pool of chirc_channeluser_t structs */
+extern chirc_pool_t chirc_channeluser_pool;
+
+/*! \brief Pool of chirc_connection_t structs */
+extern chirc_pool_t chirc_connection_pool;
+
+
+/*! \brief Allocates a struct from a pool
+ *
+ * \param pool Pool
+ * \return A struct with all its bytes set to zero (like calloc),
+ *         or NULL if memory could not be allocated
+ */
+void *chirc_pool_alloc(chirc_pool_t *pool);
+
+
+/*! \brief Returns a struct to a pool
+ *
+ * \param pool The pool the struct was allocated from
+ * \param obj The struct. Can be NULL (in which case,
+ *        this function does nothing)
+ */
+void chirc_pool_free(chirc_pool_t *pool, void *obj);
+
+
+/*! \brief Logs the occupancy of all the pools
+ *
+ * For each pool, logs (at the INFO level) how many structs are in
+ * use, and how many have been allocated (in use or not)
+ */
+void chirc_pool_log_occupancy();
+
+
+/*! \brief Starts a thread that periodically logs the occupancy
+ *  of all the pools (see chirc_pool_log_occupancy)
+ *
+ * \param interval Number of seconds between reports
+ * \return 0 on success, non-zero if the thread couldn't be started
+ */
+int chirc_pool_start_reporter(unsigned int interval);
+
+#endif /* POOL_H_ */
@@ -0,0 +1,420 @@
+/* See reactor.h for details about the functions in this module */
+
+/* For accept4() */
+#define _GNU_SOURCE
+
+#include <stdlib.h>
+#include <string.h>
+#include <unistd.h>
+#include <errno.h>
+#include <fcntl.h>
+#include <pthread.h>
+#include <stdatomic.h>
+#include <sys/socket.h>
+#include <sys/epoll.h>
+#include <sys/eventfd.h>
+
+#include "ctx.h"
+#include "connection.h"
+#include "handlers.h"
+#include "reactor.h"
+#include "chirc.h"
+#include "log.h"
+#include "pool.h"
+
+
+/* The reactor running in the calling thread (if any) */
+static __thread chirc_reactor_t *current_reactor = NULL;
+
+/* Used to give each connection a unique identifier */
+static atomic_uint_least64_t next_conn_id = 1;
+
+
+/* See reactor.h */
+chirc_reactor_t *chirc_reactor_current()
+{
+    return current_reactor;
+}
+
+
+/* See reactor.h */
+int chirc_reactor_post(chirc_reactor_t *reactor, chirc_connection_t *conn, chirc_wire_t *wire)
+{
+    chirc_reactor_mail_t *mail, *head;
+    uint64_t one = 1;
+
+    mail = malloc(sizeof(chirc_reactor_mail_t));
+    if (!mail)
+        return CHIRC_FAIL;
+
+    mail->conn_id = conn->id;
+    mail->wire = chirc_wire_ref(wire);
+
+    head = atomic_load_explicit(&reactor->mailbox, memory_order_relaxed);
+    do
+        mail->next = head;
+    while (!atomic_compare_exchange_weak_explicit(&reactor->mailbox, &head, mail,
+                                                  memory_order_release, memory_order_relaxed));
+
+    /* If the mailbox was not empty, the reactor has already been
+     * woken up, and hasn't emptied the mailbox yet */
+    if (head == NULL && write(reactor->mailbox_fd, &one, sizeof(one)) == -1)
+        serverlog(ERROR, NULL, "Could not wake up event loop: %s", strerror(errno));
+
+    return CHIRC_OK;
+}
+
+
+/* Sends the messages posted to a reactor's mailbox */
+static void chirc_reactor_read_mailbox(chirc_reactor_t *reactor)
+{
+    chirc_reactor_mail_t *mail, *next, *fifo = NULL;
+    chirc_connection_t *conn;
+    uint64_t count;
+
+    /* This must be done before emptying the mailbox, so a message
+     * posted after that will wake us up again */
+    if (read(reactor->mailbox_fd, &count, sizeof(count)) == -1 && errno != EAGAIN)
+        serverlog(ERROR, NULL, "Could not read from eventfd: %s", strerror(errno));
+
+    mail = atomic_exchange_explicit(&reactor->mailbox, NULL, memory_order_acquire);
+
+    /* The mailbox has the most recently posted message first, but the
+     * messages for a connection must be sent in the order they were posted */
+    for (; mail != NULL; mail = next)
+    {
+        next = mail->next;
+        mail->next = fifo;
+        fifo = mail;
+    }
+
+    for (mail = fifo; mail != NULL; mail = next)
+    {
+        next = mail->next;
+
+        /* The connection may have been closed after the message was posted */
+        HASH_FIND(hh_reactor, reactor->conns, &mail->conn_id, sizeof(uint64_t), conn);
+        if (conn)
+            chirc_connection_send_wire(reactor->ctx, conn, mail->wire);
+
+        chirc_wire_unref(mail->wire);
+        free(mail);
+    }
+}
+
+
+/* See reactor.h */
+int chirc_reactor_want_write(chirc_reactor_t *reactor, chirc_connection_t *conn, bool want_write)
+{
+    struct epoll_event ev;
+
+    ev.events = EPOLLIN | (want_write ? EPOLLOUT : 0);
+    ev.data.ptr = conn;
+
+    if (epoll_ctl(reactor->epfd, EPOLL_CTL_MOD, conn->socket, &ev) == -1)
+    {
+        serverlog(ERROR, conn, "epoll_ctl() failed: %s", strerror(errno));
+        return CHIRC_FAIL;
+    }
+
+    return CHIRC_OK;
+}
+
+
+/* Closes a connection and frees it */
+static void chirc_reactor_close(chirc_reactor_t *reactor, chirc_connection_t *conn)
+{
+    serverlog(DEBUG, conn, "Closing connection");
+
+    /* Make a best effort to send any pending messages (e.g., the
+     * reply to a QUIT) before closing the connection */
+    pthread_mutex_lock(&conn->send_lock);
+    conn->closing = true;
+    chirc_connection_flush(conn);
+    pthread_mutex_unlock(&conn->send_lock);
+
+    epoll_ctl(reactor->epfd, EPOLL_CTL_DEL, conn->socket, NULL);
+    close(conn->socket);
+
+    HASH_DELETE(hh_reactor, reactor->conns, conn);
+    chirc_timer_cancel(&reactor->wheel, &conn->timer);
+    chirc_timer_cancel(&reactor->wheel, &conn->flood.timer);
+
+    chirc_ctx_remove_connection(reactor->ctx, conn);
+    chirc_connection_free(conn);
+    chirc_pool_free(&chirc_connection_pool, conn);
+}
+
+
+/* Accepts all the pending connections on the server socket */
+static void chirc_reactor_accept(chirc_reactor_t *reactor)
+{
+    struct sockaddr_storage addr;
+    socklen_t addrlen;
+    struct epoll_event ev;
+    chirc_connection_t *conn;
+    int client_socket;
+
+    while (true)
+    {
+        addrlen = sizeof(addr);
+        client_socket = accept4(reactor->server_socket, (struct sockaddr *) &addr, &addrlen,
+                                SOCK_NONBLOCK | SOCK_CLOEXEC);
+        if (client_socket == -1)
+        {
+            if (errno == EINTR || errno == ECONNABORTED)
+                continue;
+            if (errno != EAGAIN && errno != EWOULDBLOCK)
+                serverlog(ERROR, NULL, "accept() failed: %s", strerror(errno));
+            return;
+        }
+
+        conn = chirc_pool_alloc(&chirc_connection_pool);
+        chirc_connection_init(conn);
+        conn->reactor = reactor;
+        conn->id = atomic_fetch_add_explicit(&next_conn_id, 1, memory_order_relaxed);
+
+        /* A reverse DNS lookup would block the whole event loop,
+         * so we use the peer's numeric address as its hostname */
+        if (chirc_connection_set_peer(conn, client_socket, (struct sockaddr *) &addr, addrlen, true))
+        {
+            close(client_socket);
+            chirc_connection_free(conn);
+            chirc_pool_free(&chirc_connection_pool, conn);
+            continue;
+        }
+
+        ev.events = EPOLLIN;
+        ev.data.ptr = conn;
+        if (epoll_ctl(reactor->epfd, EPOLL_CTL_ADD, client_socket, &ev) == -1)
+        {
+            serverlog(ERROR, conn, "epoll_ctl() failed: %s", strerror(errno));
+            close(client_socket);
+            chirc_connection_free(conn);
+            chirc_pool_free(&chirc_connection_pool, conn);
+            continue;
+        }
+
+        HASH_ADD(hh_reactor, reactor->conns, id, sizeof(uint64_t), conn);
+        chirc_connection_start_timer(&reactor->wheel, conn);
+        chirc_ctx_add_connection(reactor->ctx, conn);
+
+        serverlog(DEBUG, conn, "Accepted connection");
+    }
+}
+
+
+/* Handles the events reported by epoll for a connection */
+static void chirc_reactor_handle_events(chirc_reactor_t *reactor, chirc_connection_t *conn, uint32_t events)
+{
+    char buf[CHIRC_REACTOR_READ_SIZE];
+    ssize_t nbytes;
+    int rc;
+
+    if (events & EPOLLERR)
+    {
+        chirc_reactor_close(reactor, conn);
+        return;
+    }
+
+    if (events & EPOLLOUT)
+    {
+        pthread_mutex_lock(&conn->send_lock);
+        rc = chirc_connection_flush(conn);
+        /* Once everything has been sent, we no longer
+         * need to know when the connection is writable */
+        if (rc == CHIRC_OK && conn->sendq.head == NULL)
+            chirc_reactor_want_write(reactor, conn, false);
+        pthread_mutex_unlock(&conn->send_lock);
+
+        if (rc)
+        {
+            chirc_reactor_close(reactor, conn);
+            return;
+        }
+    }
+
+    if (events & (EPOLLIN | EPOLLHUP))
+    {
+        nbytes = recv(conn->socket, buf, sizeof(buf), 0);
+        if (nbytes == -1)
+        {
+            if (errno == EINTR || errno == EAGAIN || errno == EWOULDBLOCK)
+                return;
+            chirc_reactor_close(reactor, conn);
+            return;
+        }
+
+        if (nbytes == 0 ||
+            chirc_connection_process_input(reactor->ctx, conn, buf, nbytes) == CHIRC_HANDLER_DISCONNECT)
+        {
+            chirc_reactor_close(reactor, conn);
+            return;
+        }
+    }
+}
+
+
+/* Initializes a reactor, and registers its listening socket and
+ * its mailbox's eventfd with a new epoll instance */
+static int chirc_reactor_init(chirc_reactor_t *reactor, chirc_ctx_t *ctx, int server_socket)
+{
+    struct epoll_event ev;
+
+    reactor->ctx = ctx;
+    reactor->server_socket = server_socket;
+    reactor->conns = NULL;
+    atomic_init(&reactor->mailbox, NULL);
+    chirc_timer_wheel_init(&reactor->wheel, ctx);
+
+    if (fcntl(server_socket, F_SETFL, fcntl(server_socket, F_GETFL, 0) | O_NONBLOCK) == -1)
+    {
+        serverlog(CRITICAL, NULL, "Could not make the server socket non-blocking: %s", strerror(errno));
+        return CHIRC_FAIL;
+    }
+
+    reactor->epfd = epoll_create1(EPOLL_CLOEXEC);
+    if (reactor->epfd == -1)
+    {
+        serverlog(CRITICAL, NULL, "epoll_create1() failed: %s", strerror(errno));
+        return CHIRC_FAIL;
+    }
+
+    reactor->mailbox_fd = eventfd(0, EFD_NONBLOCK | EFD_CLOEXEC);
+    if (reactor->mailbox_fd == -1)
+    {
+        serverlog(CRITICAL, NULL, "eventfd() failed: %s", strerror(errno));
+        close(reactor->epfd);
+        return CHIRC_FAIL;
+    }
+
+    /* The server socket is the only one with a NULL data pointer,
+     * and the mailbox's eventfd is the only one that points to
+     * the reactor (all others point to a connection) */
+    ev.events = EPOLLIN;
+    ev.data.ptr = NULL;
+    if (epoll_ctl(reactor->epfd, EPOLL_CTL_ADD, server_socket, &ev) == -1)
+    {
+        serverlog(CRITICAL, NULL, "epoll_ctl() failed: %s", strerror(errno));
+        close(reactor->mailbox_fd);
+        close(reactor->epfd);
+        return CHIRC_FAIL;
+    }
+
+    ev.events = EPOLLIN;
+    ev.data.ptr = reactor;
+    if (epoll_ctl(reactor->epfd, EPOLL_CTL_ADD, reactor->mailbox_fd, &ev) == -1)
+    {
+        serverlog(CRITICAL, NULL, "epoll_ctl() failed: %s", strerror(errno));
+        close(reactor->mailbox_fd);
+        close(reactor->epfd);
+        return CHIRC_FAIL;
+    }
+
+    return CHIRC_OK;
+}
+
+
+/* Runs a reactor's event loop in the calling thread. Only
+ * returns if epoll_wait() fails. */
+static int chirc_reactor_loop(chirc_reactor_t *reactor)
+{
+    struct epoll_event events[CHIRC_REACTOR_MAX_EVENTS];
+    int nevents, timeout;
+
+    current_reactor = reactor;
+
+    while (true)
+    {
+        /* The timer wheel ticks once per second, so there is no need
+         * to wake up before the next second starts (or at all, if
+         * the wheel is empty) */
+        timeout = (reactor->wheel.count > 0) ? 1000 - (int) (chirc_timer_now_ms() % 1000) : -1;
+
+        nevents = epoll_wait(reactor->epfd, events, CHIRC_REACTOR_MAX_EVENTS, timeout);
+        if (nevents == -1)
+        {
+            if (errno == EINTR)
+                continue;
+            serverlog(CRITICAL, NULL, "epoll_wait() failed: %s", strerror(errno));
+            break;
+        }
+
+        for (int i = 0; i < nevents; i++)
+        {
+            if (events[i].data.ptr == NULL)
+                chirc_reactor_accept(reactor);
+            else if (events[i].data.ptr == reactor)
+                chirc_reactor_read_mailbox(reactor);
+            else
+                chirc_reactor_handle_events(reactor, events[i].data.ptr, events[i].events);
+        }
+
+        chirc_timer_wheel_advance(&reactor->wheel, chirc_timer_now());
+    }
+
+    current_reactor = NULL;
+    close(reactor->mailbox_fd);
+    close(reactor->epfd);
+
+    return CHIRC_FAIL;
+}
+
+
+/* See reactor.h */
+int chirc_reactor_run(chirc_ctx_t *ctx, int server_socket)
+{
+    chirc_reactor_t reactor;
+
+    if (chirc_reactor_init(&reactor, ctx, server_socket))
+        return CHIRC_FAIL;
+
+    serverlog(INFO, NULL, "Running in event loop mode");
+
+    return chirc_reactor_loop(&reactor);
+}
+
+
+/* Entry point of the threads running the additional event loops */
+static void *chirc_reactor_worker(void *args)
+{
+    chirc_reactor_loop(args);
+
+    /* If one event loop fails, the whole server stops */
+    serverlog(CRITICAL, NULL, "Event loop failed. Exiting.");
+    exit(-1);
+
+    return NULL;
+}
+
+
+/* See reactor.h */
+int chirc_reactor_run_workers(chirc_ctx_t *ctx, int *server_sockets, unsigned int n)
+{
+    chirc_reactor_t *reactors;
+    pthread_t worker;
+
+    /* The reactors are never freed, because connections (and the
+     * messages posted to them) can refer to them until the server exits */
+    reactors = calloc(n, sizeof(chirc_reactor_t));
+    if (!reactors)
+        return CHIRC_FAIL;
+
+    for (unsigned int i = 0; i < n; i++)
+        if (chirc_reactor_init(&reactors[i], ctx, server_sockets[i]))
+            return CHIRC_FAIL;
+
+    for (unsigned int i = 1; i < n; i++)
+    {
+        if (pthread_create(&worker, NULL, chirc_reactor_worker, &reactors[i]) != 0)
+        {
+            serverlog(CRITICAL, NULL, "Could not create event loop thread");
+            return CHIRC_FAIL;
+        }
+        pthread_detach(worker);
+    }
+
+    serverlog(INFO, NULL, "Running in event loop mode (%u event loops)", n);
+
+    return chirc_reactor_loop(&reactors[0]);
+}
@@ -0,0 +1,153 @@
+/*! \file reactor.h
+ *  \brief epoll-based event loop
+ *
+ *  By default, chirc handles each connection in its own thread. This
+ *  doesn't scale beyond a few thousand connections (each thread needs its
+ *  own stack, and the server spends more and more time switching between
+ *  threads), so chirc can also run with the -e option, which handles all
+ *  the connections in a single thread, with an epoll event loop (the
+ *  "reactor" in this module).
+ *
+ *  In this mode, all sockets are non-blocking. Each connection has an
+ *  input buffer (with the bytes that don't form a complete message yet)
+ *  and a send queue (with the messages that couldn't be sent right away,
+ *  because the socket's send buffer was full). The reactor reads from
+ *  a connection when it is readable, and flushes its send queue
+ *  when it becomes writable.
+ *
+ *  Messages are dispatched to chirc_handle just like in the
+ *  thread-per-connection mode, so the message handlers don't need
+ *  to know which mode the server is running in: messages are sent with
+ *  chirc_connection_send_message, which will call chirc_reactor_want_write
+ *  if a message has to wait in the send queue of a connection handled
+ *  by a reactor.
+ *
+ *  With the -w option, the server runs several reactors, each in its
+ *  own thread and with its own listening socket (all of them bound to
+ *  the same port with SO_REUSEPORT, so the kernel spreads incoming
+ *  connections across them). A connection stays in the reactor that
+ *  accepted it, and only that reactor's thread touches its socket:
+ *  a message sent to a connection in another reactor is posted to that
+ *  reactor's mailbox (a lock-free queue), and the reactor sends it
+ *  the next time it wakes up.
+ */
+
+#ifndef REACTOR_H_
+#define REACTOR_H_
+
+#include "chirc.h"
+
+/*! \brief Maximum number of events returned by each call to epoll_wait */
+#define CHIRC_REACTOR_MAX_EVENTS (256)
+
+/*! \brief Number of bytes read from a socket at a time */
+#define CHIRC_REACTOR_READ_SIZE (4096)
+
+/*! \struct chirc_reactor_mail_t
+ * \brief A message posted to a reactor's mailbox
+ */
+typedef struct chirc_reactor_mail
+{
+    /*! \brief Identifier of the connection to send the message through */
+    uint64_t conn_id;
+
+    /*! \brief The message */
+    chirc_wire_t *wire;
+
+    /*! \brief Next message in the mailbox */
+    struct chirc_reactor_mail *next;
+} chirc_reactor_mail_t;
+
+/*! \struct chirc_reactor_t
+ * \brief An epoll event loop
+ */
+struct chirc_reactor
+{
+    /*! \brief Server context */
+    chirc_ctx_t *ctx;
+
+    /*! \brief epoll file descriptor */
+    int epfd;
+
+    /*! \brief Listening socket */
+    int server_socket;
+
+    /*! \brief Connections handled by this reactor (keyed by id) */
+    chirc_connection_t *conns;
+
+    /*! \brief Messages posted by other threads, for connections handled
+     *  by this reactor (most recently posted first) */
+    _Atomic(chirc_reactor_mail_t *) mailbox;
+
+    /*! \brief eventfd used to wake up the reactor when a message
+     *  is posted to an empty mailbox */
+    int mailbox_fd;
+
+    /*! \brief Timers of the connections handled by this reactor */
+    chirc_timer_wheel_t wheel;
+};
+
+
+/*! \brief Runs an event loop
+ *
+ * Accepts connections on the server socket, and handles them (and
+ * any connections accepted later) until the server stops.
+ *
+ * \param ctx Server context
+ * \param server_socket A socket that is already listening for
+ *        connections (it will be made non-blocking)
+ * \return Only returns (with a non-zero value) if the event loop fails
+ */
+int chirc_reactor_run(chirc_ctx_t *ctx, int server_socket);
+
+
+/*! \brief Runs several event loops, each in its own thread
+ *
+ * Each event loop gets its own listening socket, which must be bound
+ * (with SO_REUSEPORT) to the same port as the others. One of the event
+ * loops runs in the calling thread.
+ *
+ * \param ctx Server context
+ * \param server_sockets Listening sockets (one per event loop)
+ * \param n Number of event loops
+ * \return Only returns (with a non-zero value) if an event loop fails
+ */
+int chirc_reactor_run_workers(chirc_ctx_t *ctx, int *server_sockets, unsigned int n);
+
+
+/*! \brief Returns the reactor running in the calling thread
+ *
+ * \return The reactor, or NULL if the calling thread isn't
+ *         running an event loop
+ */
+chirc_reactor_t *chirc_reactor_current();
+
+
+/*! \brief Posts a message to a reactor's mailbox
+ *
+ * The reactor will send the message through the connection (with
+ * chirc_connection_send_wire) in its own thread, unless the connection
+ * has been closed by then. This function never blocks.
+ *
+ * \param reactor The reactor handling the connection
+ * \param conn The connection. The caller must keep it from being freed
+ *        until this returns (e.g., by holding the lock of a channel
+ *        its user is in; see chirc.h)
+ * \param wire The serialized message (a reference to it is added)
+ * \return 0 on success, non-zero on failure
+ */
+int chirc_reactor_post(chirc_reactor_t *reactor, chirc_connection_t *conn, chirc_wire_t *wire);
+
+
+/*! \brief Sets whether the reactor must flush a connection's send queue
+ *  when the connection becomes writable
+ *
+ * \param reactor The reactor handling the connection
+ * \param conn The connection
+ * \param want_write True if the connection has messages waiting to be
+ *        sent, false once its send queue is empty
+ * \return 0 on success, non-zero on failure
+ */
+int chirc_reactor_want_write(chirc_reactor_t *reactor, chirc_connection_t *conn, bool want_write);
+
+#endif /* REACTOR_H_ */
@@ -0,0 +1,176 @@
+/* See timer.h for details about the functions in this module */
+
+#include <stdlib.h>
+#include <string.h>
+
+#include "timer.h"
+
+/* Number of ticks covered by a slot in each level */
+#define LEVEL_SHIFT(LEVEL) ((LEVEL) * CHIRC_TIMER_SLOT_BITS)
+
+/* Maximum delay of a timer (timers with longer delays
+ * expire after this many ticks instead) */
+#define MAX_DELAY ((1ULL << LEVEL_SHIFT(CHIRC_TIMER_LEVELS)) - 1)
+
+
+/* See timer.h */
+time_t chirc_timer_now()
+{
+    struct timespec now;
+
+    clock_gettime(CLOCK_MONOTONIC_COARSE, &now);
+
+    return now.tv_sec;
+}
+
+
+/* See timer.h */
+uint64_t chirc_timer_now_ms()
+{
+    struct timespec now;
+
+    clock_gettime(CLOCK_MONOTONIC_COARSE, &now);
+
+    return (uint64_t) now.tv_sec * 1000 + now.tv_nsec / 1000000;
+}
+
+
+/* See timer.h */
+void chirc_timer_wheel_init(chirc_timer_wheel_t *wheel, void *data)
+{
+    memset(wheel->slots, 0, sizeof(wheel->slots));
+    wheel->now = chirc_timer_now();
+    wheel->count = 0;
+    wheel->data = data;
+}
+
+
+/* Puts a timer in the slot that corresponds to its expiry tick.
+ * Each level holds the timers whose expiry tick is in a different
+ * slot-sized span than the current tick at the level below it, so
+ * a timer never ends up in a slot that the wheel has already passed */
+static void chirc_timer_place(chirc_timer_wheel_t *wheel, chirc_timer_t *timer)
+{
+    chirc_timer_t **slot;
+    int level;
+
+    for (level = 0; level < CHIRC_TIMER_LEVELS - 1; level++)
+        if ((timer->expires >> LEVEL_SHIFT(level + 1)) == (wheel->now >> LEVEL_SHIFT(level + 1)))
+            break;
+
+    slot = &wheel->slots[level][(timer->expires >> LEVEL_SHIFT(level)) & (CHIRC_TIMER_SLOTS - 1)];
+
+    timer->next = *slot;
+    if (*slot)
+        (*slot)->pprev = &timer->next;
+    timer->pprev = slot;
+    *slot = timer;
+}
+
+
+/* Removes a timer from its slot */
+static void chirc_timer_unlink(chirc_timer_t *timer)
+{
+    *timer->pprev = timer->next;
+    if (timer->next)
+        timer->next->pprev = timer->pprev;
+    timer->next = NULL;
+    timer->pprev = NULL;
+}
+
+
+/* See timer.h */
+void chirc_timer_add(chirc_timer_wheel_t *wheel, chirc_timer_t *timer, time_t delay)
+{
+    if (timer->pprev)
+        chirc_timer_unlink(timer);
+    else
+        wheel->count++;
+
+    if (delay < 1)
+        delay = 1;
+    if ((uint64_t) delay > MAX_DELAY)
+        delay = MAX_DELAY;
+
+    timer->expires = wheel->now + delay;
+    chirc_timer_place(wheel, timer);
+}
+
+
+/* See timer.h */
+void chirc_timer_cancel(chirc_timer_wheel_t *wheel, chirc_timer_t *timer)
+{
+    if (!timer->pprev)
+        return;
+
+    chirc_timer_unlink(timer);
+    wheel->count--;
+}
+
+
+/* See timer.h */
+bool chirc_timer_pending(chirc_timer_t *timer)
+{
+    return timer->pprev != NULL;
+}
+
+
+/* Moves the timers in a slot to the lower levels */
+static void chirc_timer_cascade(chirc_timer_wheel_t *wheel, int level)
+{
+    chirc_timer_t *timer, *next;
+    chirc_timer_t **slot;
+
+    slot = &wheel->slots[level][(wheel->now >> LEVEL_SHIFT(level)) & (CHIRC_TIMER_SLOTS - 1)];
+
+    timer = *slot;
+    *slot = NULL;
+
+    for (; timer != NULL; timer = next)
+    {
+        next = timer->next;
+        chirc_timer_place(wheel, timer);
+    }
+}
+
+
+/* See timer.h */
+size_t chirc_timer_wheel_advance(chirc_timer_wheel_t *wheel, uint64_t now)
+{
+    chirc_timer_t *timer, **slot;
+    size_t expired = 0;
+
+    while (wheel->now < now)
+    {
+        /* Nothing can expire in an empty wheel */
+        if (wheel->count == 0)
+        {
+            wheel->now = now;
+            break;
+        }
+
+        wheel->now++;
+
+        /* If we've reached the start of a slot in a higher level,
+         * its timers are moved down (starting with the highest level,
+         * since its timers may have to be moved down more than once) */
+        for (int level = CHIRC_TIMER_LEVELS - 1; level > 0; level--)
+            if ((wheel->now & ((1ULL << LEVEL_SHIFT(level)) - 1)) == 0)
+                chirc_timer_cascade(wheel, level);
+
+        /* The callbacks may add timers to this same slot (for the next
+         * turn of the wheel), so we take the timers off the slot one
+         * at a time */
+        slot = &wheel->slots[0][wheel->now & (CHIRC_TIMER_SLOTS - 1)];
+        while ((timer = *slot) != NULL && timer->expires == wheel->now)
+        {
+            chirc_timer_unlink(timer);
+            wheel->count--;
+            expired++;
+
+            timer->callback(wheel, timer);
+        }
+    }
+
+    return expired;
+}
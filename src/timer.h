@@ -0,0 +1,167 @@
+/*! \file timer.h
+ *  \brief Timer wheels
+ *
+ *  The server has to do things at certain times for every connection:
+ *  closing connections that haven't registered after a while, sending
+ *  PINGs to connections that have been quiet for a while, and closing
+ *  connections that don't answer those PINGs. Instead of keeping a
+ *  sorted list of deadlines, the timers are kept in a hierarchical
+ *  timer wheel, where adding and cancelling a timer takes constant
+ *  time, and so does advancing the wheel by one tick (except for the
+ *  timers that expire in that tick, which have to be run anyway).
+ *
+ *  A tick is one second. The wheel has CHIRC_TIMER_LEVELS levels of
+ *  CHIRC_TIMER_SLOTS slots each: level 0 has one slot per tick, for
+ *  the timers that expire in the next CHIRC_TIMER_SLOTS ticks, level 1
+ *  has one slot per CHIRC_TIMER_SLOTS ticks, and so on. When the wheel
+ *  reaches the start of a slot in a higher level, the timers in that
+ *  slot are moved ("cascaded") to the lower levels.
+ *
+ *  The functions in this module are not thread-safe. A timer wheel
+ *  must be used by a single thread (e.g., an event loop), or protected
+ *  by a lock. Timer callbacks are run by chirc_timer_wheel_advance,
+ *  and can add (or re-add) timers to the wheel.
+ */
+
+#ifndef TIMER_H_
+#define TIMER_H_
+
+#include <stddef.h>
+#include <stdint.h>
+#include <stdbool.h>
+#include <time.h>
+
+/*! \brief Number of bits of a tick used to choose a slot in each level */
+#define CHIRC_TIMER_SLOT_BITS (6)
+
+/*! \brief Number of slots in each level of a timer wheel */
+#define CHIRC_TIMER_SLOTS (1 << CHIRC_TIMER_SLOT_BITS)
+
+/*! \brief Number of levels in a timer wheel. Timers that expire later
+ *  than CHIRC_TIMER_SLOTS^CHIRC_TIMER_LEVELS ticks in the future
+ *  (about six months) expire at that point instead. */
+#define CHIRC_TIMER_LEVELS (4)
+
+/* Forward declarations */
+typedef struct chirc_timer chirc_timer_t;
+typedef struct chirc_timer_wheel chirc_timer_wheel_t;
+
+/*! \brief Function called when a timer expires
+ *
+ * \param wheel The wheel the timer was in
+ * \param timer The timer (which is no longer in the wheel)
+ */
+typedef void (*chirc_timer_callback_t)(chirc_timer_wheel_t *wheel, chirc_timer_t *timer);
+
+/*! \struct chirc_timer_t
+ * \brief A timer
+ *
+ * Timers are meant to be embedded in other structs. Before adding a
+ * timer to a wheel, set its callback and data fields (the other fields
+ * are managed by the wheel, and must be zero while the timer is not
+ * in a wheel)
+ */
+struct chirc_timer
+{
+    /*! \brief Function to call when the timer expires */
+    chirc_timer_callback_t callback;
+
+    /*! \brief Data for the callback (e.g., the connection the timer is for) */
+    void *data;
+
+    /*! \brief Tick at which the timer expires */
+    uint64_t expires;
+
+    /*! \brief Next timer in the same slot */
+    chirc_timer_t *next;
+
+    /*! \brief Pointer to the pointer to this timer in its slot's list
+     *  (NULL if the timer is not in a wheel) */
+    chirc_timer_t **pprev;
+};
+
+/*! \struct chirc_timer_wheel_t
+ * \brief A hierarchical timer wheel
+ */
+struct chirc_timer_wheel
+{
+    /*! \brief Current tick */
+    uint64_t now;
+
+    /*! \brief Timers in the wheel */
+    chirc_timer_t *slots[CHIRC_TIMER_LEVELS][CHIRC_TIMER_SLOTS];
+
+    /*! \brief Number of timers in the wheel */
+    size_t count;
+
+    /*! \brief Data for the timer callbacks (e.g., the server context) */
+    void *data;
+};
+
+
+/*! \brief Returns the current time, in ticks
+ *
+ * The time comes from a monotonic clock, so it is only meaningful
+ * when compared with other values returned by this function.
+ *
+ * \return Current time (in seconds)
+ */
+time_t chirc_timer_now();
+
+
+/*! \brief Returns the current time, in milliseconds
+ *
+ * Uses the same clock as chirc_timer_now.
+ *
+ * \return Current time (in milliseconds)
+ */
+uint64_t chirc_timer_now_ms();
+
+
+/*! \brief Initializes a timer wheel
+ *
+ * \param wheel The wheel
+ * \param data Data for the timer callbacks
+ */
+void chirc_timer_wheel_init(chirc_timer_wheel_t *wheel, void *data);
+
+
+/*! \brief Adds a timer to a wheel
+ *
+ * If the timer is already in the wheel, it is rescheduled.
+ *
+ * \param wheel The wheel
+ * \param timer The timer
+ * \param delay Number of ticks until the timer expires (a delay of
+ *        zero is treated as a delay of one tick)
+ */
+void chirc_timer_add(chirc_timer_wheel_t *wheel, chirc_timer_t *timer, time_t delay);
+
+
+/*! \brief Removes a timer from a wheel
+ *
+ * \param wheel The wheel
+ * \param timer The timer. Can be a timer that is not in the wheel
+ *        (in which case, this function does nothing)
+ */
+void chirc_timer_cancel(chirc_timer_wheel_t *wheel, chirc_timer_t *timer);
+
+
+/*! \brief Checks whether a timer is in a wheel
+ *
+ * \param timer The timer
+ * \return true if the timer is in a wheel, false otherwise
+ */
+bool chirc_timer_pending(chirc_timer_t *timer);
+
+
+/*! \brief Advances a wheel up to the given tick, running the
+ *  callbacks of all the timers that expire along the way
+ *
+ * \param wheel The wheel
+ * \param now Current tick (see chirc_timer_now)
+ * \return Number of timers that expired
+ */
+size_t chirc_timer_wheel_advance(chirc_timer_wheel_t *wheel, uint64_t now);
+
+#endif /* TIMER_H_ */
@@ -13,6 +13,7 @@
 void chirc_user_init(chirc_user_t *user)
 {
     user->nick = NULL;
+    user->nick_folded = NULL;
     user->username = NULL;
     user->fullname = NULL;
     user->modes[0] = '\0';
@@ -21,6 +22,8 @@ void chirc_user_init(chirc_user_t *user)
     user->registered = false;
 
     user->channels = NULL;
+    user->conn = NULL;
+    pthread_mutex_init(&user->lock, NULL);
 }
 
 
@@ -28,6 +31,7 @@ void chirc_user_init(chirc_user_t *user)
 void chirc_user_free(chirc_user_t *user)
 {
     sdsfree(user->nick);
+    sdsfree(user->nick_folded);
     sdsfree(user->username);
     sdsfree(user->fullname);
     sdsfree(user->awaymsg);
@@ -35,6 +39,8 @@ void chirc_user_free(chirc_user_t *user)
     /* We shouldn't free a user until all their channels
      * have been removed */
     assert(user->channels == NULL);
+
+    pthread_mutex_destroy(&user->lock);
 }
 
 
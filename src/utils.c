@@ -50,3 +50,34 @@ int remove_mode(char *modes, char mode)
 
     return 0;
 }
+
+
+/* See utils.h */
+size_t irc_casefold(char *dst, const char *src, size_t size)
+{
+    size_t i;
+    char c;
+
+    for (i = 0; src[i] != '\0'; i++)
+    {
+        if (i + 1 >= size)
+            break;
+
+        c = src[i];
+        if (c >= 'A' && c <= 'Z')
+            c += 'a' - 'A';
+        else if (c == '[')
+            c = '{';
+        else if (c == ']')
+            c = '}';
+        else if (c == '\\')
+            c = '|';
+
+        dst[i] = c;
+    }
+
+    if (size > 0)
+        dst[i] = '\0';
+
+    return i + strlen(src + i);
+}
@@ -11,6 +11,8 @@
 #ifndef UTILS_H_
 #define UTILS_H_
 
+#include <stddef.h>
+
 /* Add the declarations for your helper functions here,
  * and implement them in utils.c*/
 
@@ -44,4 +46,20 @@ int set_mode(char *modes, char mode);
  */
 int remove_mode(char *modes, char mode);
 
+
+/*! \brief Folds a nick or channel name, so that names that only
+ *  differ in case are folded to the same string
+ *
+ * Uses the casemapping in RFC 1459: uppercase letters are converted
+ * to lowercase, and the characters []\\ are considered the uppercase
+ * versions of {}|
+ *
+ * \param dst Buffer for the folded name (can be the same as src)
+ * \param src Name to fold
+ * \param size Size of dst. If the name doesn't fit, it is truncated
+ *        (but dst is still NUL-terminated)
+ * \return Length of src. If it is size or more, the name was truncated.
+ */
+size_t irc_casefold(char *dst, const char *src, size_t size);
+
 #endif /* UTILS_H_ */
@@ -1,8 +1,13 @@
-import telnetlib
+import asyncio
 import time
+from collections import deque
 from chirc.types import CouldNotConnectException, ReplyTimeoutException,\
     IRCMessage
+import select
 import socket
+
+# Maximum number of bytes read from the socket in a single recv()
+RECV_SIZE = 65536
             
 class ChircClient(object):
     
@@ -10,40 +15,224 @@ class ChircClient(object):
         self.host = host
         self.port = port
         self.msg_timeout = msg_timeout
+
+        # Messages that were read off the socket but not consumed yet
+        # (e.g., while waiting for a PONG in a quiescence probe)
+        self.pending = deque()
+
+        # Complete lines received from the server that have not been
+        # returned by get_message yet, and bytes received after the
+        # last complete line.
+        self.frames = deque()
+        self.buffer = bytearray()
+        self.eof = False
+
+        # Time of the most recent send_cmd/send_raw, and the command that
+        # was sent (None if it was sent with send_raw)
+        self.last_send = None
+        self.last_cmd = None
+
+        # Time at which the message most recently returned by
+        # get_message was received
+        self.last_recv = None
         
-        tries = 3
+        # Retry with exponential backoff (for a total of ~2.5 seconds),
+        # in case the server is not accepting connections yet
+        tries = 8
+        delay = 0.01
 
         while tries > 0:
             try:
-                self.client = telnetlib.Telnet("localhost", str(self.port), 1)
-                #self.client.set_debuglevel(100)
+                self.sock = socket.create_connection((self.host, self.port), 1)
+                self.sock.settimeout(None)
                 if nodelay:
-                    self.client.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
                 break
             except Exception:
                 tries -= 1
-                time.sleep(0.1)
+                time.sleep(delay)
+                delay *= 2
 
         if tries == 0:
             raise CouldNotConnectException()
     
     def disconnect(self):
-        self.client.close()
+        self.sock.close()
+
+    def _recv(self, timeout):
+        '''
+        Reads as much as is available from the socket (up to RECV_SIZE
+        bytes), waiting at most `timeout` seconds, and moves all the
+        complete lines into self.frames. Returns False if nothing
+        was read (because of a timeout or the connection being closed)
+        '''
+        if self.eof:
+            return False
+
+        readable, _, _ = select.select([self.sock], [], [], timeout)
+        if not readable:
+            return False
+
+        try:
+            data = self.sock.recv(RECV_SIZE)
+        except ConnectionResetError:
+            data = b""
+
+        if len(data) == 0:
+            self.eof = True
+            return False
+
+        now = time.monotonic()
+        self.buffer += data
+
+        start = 0
+        while True:
+            i = self.buffer.find(b"\r\n", start)
+            if i == -1:
+                break
+            self.frames.append( (bytes(self.buffer[start:i+2]), now) )
+            start = i + 2
+        del self.buffer[:start]
+
+        return True
         
     def get_message(self):
-        msg = self.client.read_until(str.encode("\r\n"), timeout=self.msg_timeout)
-        msg = msg.decode()
-        if msg[-2:] != "\r\n":
-            raise ReplyTimeoutException(msg)
-        msg = IRCMessage(msg)
-        return msg
+        if self.pending:
+            self.last_recv = None
+            return self.pending.popleft()
+
+        deadline = time.monotonic() + self.msg_timeout
+        while not self.frames:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not self._recv(remaining):
+                if self.frames:
+                    break
+                # Same semantics as telnetlib's read_until, which this
+                # client was originally built on: EOFError if the
+                # connection is closed and there is nothing buffered.
+                if self.eof and len(self.buffer) == 0:
+                    raise EOFError()
+                raise ReplyTimeoutException(self.buffer.decode(errors="replace"))
+
+        frame, self.last_recv = self.frames.popleft()
+        return IRCMessage(frame)
+
+    def get_messages(self, n):
+        '''
+        Returns the next `n` messages. All the messages that arrive
+        together are read with a single recv(), so this is typically
+        used to read a burst of replies (e.g., the LUSERS or NAMES replies)
+        '''
+        return [self.get_message() for _ in range(n)]
 
     def send_cmd(self, cmd):
-        self.client.write(str.encode("%s\r\n" % cmd))
+        fields = cmd.split(" ", 2)
+        if fields[0].startswith(":") and len(fields) > 1:
+            self.last_cmd = fields[1].upper()
+        else:
+            self.last_cmd = fields[0].upper()
+        self.last_send = time.monotonic()
+        self.sock.sendall(str.encode("%s\r\n" % cmd))
         
     def send_raw(self, l, wait = None):
         
         for s in l:
             if wait is not None:
                 time.sleep(wait)
-            self.client.write(str.encode(s))
+            self.last_cmd = None
+            self.last_send = time.monotonic()
+            self.sock.sendall(str.encode(s))
+
+
+class AsyncChircClient(object):
+    '''
+    asyncio counterpart of ChircClient. It provides the same
+    send_cmd/get_message/send_raw methods (as coroutines), so a single
+    event loop can drive many simulated users against one chirc server.
+
+    The constructor does not open the connection; await connect() first:
+
+        client = await AsyncChircClient(port=port).connect()
+    '''
+
+    def __init__(self, host = "localhost", port = 7776, msg_timeout = 0.1, nodelay=False):
+        self.host = host
+        self.port = port
+        self.msg_timeout = msg_timeout
+        self.nodelay = nodelay
+
+        self.reader = None
+        self.writer = None
+        self._buffer = bytearray()
+
+    async def connect(self):
+        tries = 8
+        delay = 0.01
+
+        while tries > 0:
+            try:
+                self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+                if self.nodelay:
+                    sock = self.writer.get_extra_info("socket")
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                break
+            except OSError:
+                tries -= 1
+                await asyncio.sleep(delay)
+                delay *= 2
+
+        if tries == 0:
+            raise CouldNotConnectException()
+
+        return self
+
+    async def disconnect(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+
+    async def get_message(self):
+        # Same semantics as telnetlib's read_until: EOFError if the
+        # connection is closed and there is nothing buffered, and a
+        # ReplyTimeoutException with the partial bytes otherwise.
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.msg_timeout
+
+        while True:
+            i = self._buffer.find(b"\r\n")
+            if i != -1:
+                line = bytes(self._buffer[:i+2])
+                del self._buffer[:i+2]
+                return IRCMessage(line)
+
+            remaining = deadline - loop.time()
+            try:
+                if remaining <= 0:
+                    raise asyncio.TimeoutError()
+                data = await asyncio.wait_for(self.reader.read(RECV_SIZE), remaining)
+            except asyncio.TimeoutError:
+                raise ReplyTimeoutException(self._buffer.decode(errors="replace"))
+
+            if len(data) == 0:
+                if len(self._buffer) == 0:
+                    raise EOFError()
+                raise ReplyTimeoutException(self._buffer.decode(errors="replace"))
+
+            self._buffer += data
+
+    async def get_messages(self, n):
+        return [await self.get_message() for _ in range(n)]
+
+    async def send_cmd(self, cmd):
+        self.writer.write(str.encode("%s\r\n" % cmd))
+        await self.writer.drain()
+
+    async def send_raw(self, l, wait = None):
+
+        for s in l:
+            if wait is not None:
+                await asyncio.sleep(wait)
+            self.writer.write(str.encode(s))
+            await self.writer.drain()
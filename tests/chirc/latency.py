@@ -0,0 +1,115 @@
+class LatencyHistogram(object):
+    '''
+    HDR-style histogram of latencies (in microseconds).
+
+    Values below 2**(SUB_BUCKET_BITS+1) are counted exactly. Larger values
+    are counted in buckets whose width is a power of two, with
+    2**SUB_BUCKET_BITS buckets between consecutive powers of two,
+    so every value is recorded with a relative error of at most ~3%,
+    using a small number of buckets.
+    '''
+
+    SUB_BUCKET_BITS = 5
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    @classmethod
+    def bucket_bounds(cls, value):
+        '''
+        Returns the lowest and highest values of the bucket
+        that `value` is counted in.
+        '''
+        shift = max(0, value.bit_length() - cls.SUB_BUCKET_BITS - 1)
+        lower = (value >> shift) << shift
+        return lower, lower + (1 << shift) - 1
+
+    def record(self, value):
+        value = max(0, int(value))
+        lower, _ = self.bucket_bounds(value)
+
+        self.buckets[lower] = self.buckets.get(lower, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for lower, count in other.buckets.items():
+            self.buckets[lower] = self.buckets.get(lower, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    def percentile(self, p):
+        if self.count == 0:
+            return None
+
+        rank = max(1, int(round(p / 100.0 * self.count)))
+        seen = 0
+        for lower in sorted(self.buckets):
+            seen += self.buckets[lower]
+            if seen >= rank:
+                _, upper = self.bucket_bounds(lower)
+                return min(upper, self.max)
+
+        return self.max
+
+    def to_dict(self):
+        d = {"count": self.count,
+             "min_us": self.min,
+             "max_us": self.max,
+             "mean_us": self.total / self.count if self.count > 0 else None}
+        for p in (50, 90, 99, 99.9):
+            d["p{}_us".format(str(p).replace(".", ""))] = self.percentile(p)
+        d["total_us"] = self.total
+        d["buckets"] = {str(lower): count for lower, count in sorted(self.buckets.items())}
+        return d
+
+    @classmethod
+    def from_dict(cls, d):
+        h = cls()
+        h.buckets = {int(lower): count for lower, count in d["buckets"].items()}
+        h.count = d["count"]
+        h.total = d["total_us"]
+        h.min = d["min_us"]
+        h.max = d["max_us"]
+        return h
+
+
+class LatencyRecorder(object):
+    '''
+    Keeps one LatencyHistogram per IRC command (NICK, JOIN, PRIVMSG, ...)
+    '''
+
+    def __init__(self):
+        self.histograms = {}
+
+    def record(self, cmd, seconds):
+        if cmd not in self.histograms:
+            self.histograms[cmd] = LatencyHistogram()
+        self.histograms[cmd].record(seconds * 1e6)
+
+    def merge(self, other):
+        for cmd, h in other.histograms.items():
+            if cmd not in self.histograms:
+                self.histograms[cmd] = LatencyHistogram()
+            self.histograms[cmd].merge(h)
+
+    def to_dict(self):
+        return {cmd: h.to_dict() for cmd, h in sorted(self.histograms.items())}
+
+    @classmethod
+    def from_dict(cls, d):
+        r = cls()
+        r.histograms = {cmd: LatencyHistogram.from_dict(h) for cmd, h in d.items()}
+        return r
@@ -5,13 +5,102 @@ import os
 import shutil
 import re
 import string
+import itertools
+import socket
 
 import chirc.replies as replies
 from chirc.client import ChircClient
+from chirc.latency import LatencyRecorder
 from chirc.types import ReplyTimeoutException
 import pytest
 import time
 
+# How long (in seconds) a quiescence probe waits for its PONG. This is much
+# longer than the message timeout: the probe is only done when the PONG has
+# arrived (a probe that times out fails the test, instead of leaving the PONG
+# to be read later as an unexpected reply)
+QUIESCENCE_PONG_TIMEOUT = 5.0
+
+
+def get_free_ports(n = 1):
+    '''
+    Returns `n` distinct TCP ports that are currently unused, as assigned
+    by the kernel when binding to port 0. All the sockets are kept open
+    until every port has been assigned, so the ports are distinct from
+    each other.
+
+    The sockets are closed before returning (so that chirc can bind to
+    the ports), so another process (e.g., another pytest-xdist worker)
+    can still take one of the ports before chirc binds to it. This only
+    narrows that window, so callers should be ready to retry with
+    fresh ports if chirc fails to start.
+    '''
+    socks = []
+    try:
+        for _ in range(n):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            socks.append(sock)
+            sock.bind(("", 0))
+        return [sock.getsockname()[1] for sock in socks]
+    finally:
+        for sock in socks:
+            sock.close()
+
+
+def get_free_port():
+    return get_free_ports(1)[0]
+
+
+def is_port_listening(port, pid = None):
+    '''
+    Checks whether there is a socket listening on TCP port `port` (and,
+    if `pid` is specified, whether that socket belongs to process `pid`).
+
+    This is done by looking at /proc/net/tcp and /proc/net/tcp6, instead
+    of trying to connect to the port, because a probe connection would
+    show up in the server as an unknown connection.
+
+    Returns None if this cannot be determined (i.e., if /proc is not
+    available on this platform)
+    '''
+    inodes = set()
+    found_proc = False
+    for proc_file in ("/proc/net/tcp", "/proc/net/tcp6"):
+        try:
+            with open(proc_file) as f:
+                lines = f.readlines()[1:]
+        except OSError:
+            continue
+
+        found_proc = True
+        for line in lines:
+            fields = line.split()
+            local_port = int(fields[1].rsplit(":", 1)[1], 16)
+            state = fields[3]
+            if local_port == port and state == "0A":
+                inodes.add(fields[9])
+
+    if not found_proc:
+        return None
+
+    if pid is None or len(inodes) == 0:
+        return len(inodes) > 0
+
+    fd_dir = "/proc/{}/fd".format(pid)
+    try:
+        fds = os.listdir(fd_dir)
+    except OSError:
+        return None
+
+    for fd in fds:
+        try:
+            target = os.readlink(os.path.join(fd_dir, fd))
+        except OSError:
+            continue
+        if target.startswith("socket:[") and target[8:-1] in inodes:
+            return True
+
+    return False
 
 
 class SingleIRCSession:
@@ -26,7 +115,9 @@ class SingleIRCSession:
 
     def __init__(self, chirc_exe = None, msg_timeout = 0.1,
                  chirc_port = None, loglevel = -1, debug = False,
-                 irc_network = None, irc_network_server = None, external_chirc_port=None):
+                 irc_network = None, irc_network_server = None, external_chirc_port=None,
+                 quiescence = False, pipeline_connect = False, record_latency = False,
+                 event_loop = False):
         if chirc_exe is None:
             self.chirc_exe = "../build/chirc"
         else:            
@@ -39,7 +130,9 @@ class SingleIRCSession:
             assert irc_network_server in irc_network
 
             self.chirc_port = irc_network_server.port
-            self.randomize_ports = False
+            # If the network's ports were picked at random, a server
+            # that can't bind to its port is retried with a new one
+            self.randomize_ports = (chirc_port == -1)
             self.irc_network = irc_network
             self.irc_network_server = irc_network_server
         else:
@@ -60,10 +153,36 @@ class SingleIRCSession:
         self.debug = debug
         self.external_chirc_port = external_chirc_port
 
+        # If True, chirc is run with -e (handling all the
+        # connections with an event loop)
+        self.event_loop = event_loop
+
+        # If True, get_reply(..., expect_timeout=True) uses a PING/PONG
+        # round trip to decide that no reply is coming, instead of
+        # waiting for the full msg_timeout
+        self.quiescence = quiescence
+        self.probe_tokens = itertools.count(1)
+        self.pong_echoes_token = False
+
+        # When the last quiescence barrier finished (see _verify_quiescence)
+        self.last_barrier = None
+
+        # If True, connect_clients and connect_and_join_channels register
+        # all their users at once (see connect_users)
+        self.pipeline_connect = pipeline_connect
+
+        # If True, the time between a command being sent and the first
+        # message it produces (a reply to the sender, or a message relayed
+        # to another client) is recorded for each command (see _record_latency)
+        self.record_latency = record_latency
+        self.latency = LatencyRecorder() if record_latency else None
+        self.latency_marks = {}
+
         random_str = "".join([random.choice(string.ascii_letters + string.digits) for _ in range(8)])
         self.oper_password = "oper-{}".format(random_str)
         self.started = False
         self.clients = []
+        self.registered_clients = set()
 
     # Testing functions
     
@@ -101,8 +220,8 @@ class SingleIRCSession:
 
         self.tmpdir = tempfile.mkdtemp()
         
-        if self.randomize_ports:
-            self.port = random.randint(10000,60000)
+        if self.randomize_ports and self.irc_network is None:
+            self.port = get_free_port()
         else:
             self.port = self.chirc_port
  
@@ -131,6 +250,9 @@ class SingleIRCSession:
 
             chirc_cmd += ["-o", self.oper_password]
 
+            if self.event_loop:
+                chirc_cmd.append("-e")
+
 
             if self.loglevel == -1:
                 chirc_cmd.append("-q")
@@ -140,19 +262,75 @@ class SingleIRCSession:
                 chirc_cmd.append("-vv")
 
             self.chirc_proc = subprocess.Popen(chirc_cmd, cwd = self.tmpdir)
-            time.sleep(0.01)
-            rc = self.chirc_proc.poll()        
+            rc = self._wait_until_listening()
             if rc != None:
                 tries -=1
                 if tries == 0:
                     pytest.fail("chirc process failed to start. rc = %i" % rc)
+                elif self.irc_network is not None:
+                    self._pick_network_ports()
                 else:
-                    if self.randomize_ports:
-                        self.port = random.randint(10000,60000)
+                    self.port = get_free_port()
             else:
                 break        
 
         self.started = True
+
+    def _pick_network_ports(self):
+        '''
+        Called when this server could not start in network mode (most
+        likely because another process took its port). Gives fresh ports
+        to this server and to every other server in the network that
+        hasn't been started yet (the servers that are already running
+        have read the network file, so their ports can't change). The
+        network file is rewritten with the new ports before chirc is
+        started again.
+        '''
+        servers = [server for server in self.irc_network
+                   if server is self.irc_network_server or
+                      server.irc_session is None or not server.irc_session.started]
+        ports = get_free_ports(len(servers))
+
+        for server, port in zip(servers, ports):
+            server.port = port
+            if server.irc_session is not None:
+                server.irc_session.chirc_port = port
+
+        self.port = self.irc_network_server.port
+
+    def _wait_until_listening(self, timeout = 5.0):
+        '''
+        Waits until the chirc process is listening on its port, polling
+        with exponential backoff. Returns the process's return code if it
+        exits in the meantime (e.g., because the port was already in use),
+        and None if it is ready to accept connections.
+        '''
+        delay = 0.001
+        deadline = time.monotonic() + timeout
+
+        while True:
+            rc = self.chirc_proc.poll()
+            if rc is not None:
+                return rc
+
+            listening = is_port_listening(self.port, self.chirc_proc.pid)
+            if listening is None:
+                # We can't check for the listening socket on this platform,
+                # so we just give the server a moment to start (and rely on
+                # ChircClient retrying the connection)
+                time.sleep(0.01)
+                return self.chirc_proc.poll()
+            elif listening:
+                return None
+
+            if time.monotonic() > deadline:
+                self.chirc_proc.kill()
+                self.chirc_proc.wait()
+                shutil.rmtree(self.tmpdir)
+                pytest.fail("chirc process did not start listening on port %i" % self.port)
+
+            time.sleep(delay)
+            delay = min(delay * 2, 0.05)
         
     def end_session(self):
         if not self.started:
@@ -162,18 +340,108 @@ class SingleIRCSession:
             self.disconnect_client(c)
 
         if self.external_chirc_port is None:
-            rc = self.chirc_proc.poll()
-            if rc is not None:
-                if rc != 0:
-                    shutil.rmtree(self.tmpdir)
+            # The server is cleaned up (and marked as stopped) even if
+            # it crashed, so that it can be started again
+            try:
+                rc = self.chirc_proc.poll()
+                if rc is None:
+                    self.chirc_proc.kill()
+                elif rc != 0:
                     pytest.fail("chirc process failed during test. rc = %i" % rc)
-            else:
-                self.chirc_proc.kill()
-            self.chirc_proc.wait()
-            shutil.rmtree(self.tmpdir)
+            finally:
+                self.chirc_proc.wait()
+                shutil.rmtree(self.tmpdir, ignore_errors=True)
+                self.started = False
 
         self.started = False
 
+    def reset_session(self):
+        '''
+        Used when a chirc server is reused across tests. Disconnects all
+        the clients, removes any files created in the server's working
+        directory (e.g., motd.txt), and checks that the server is back to
+        its initial state (no users, operators, unknown connections or
+        channels). If it isn't, the server is restarted (if it crashed,
+        the crash is reported, but the server is still restarted, so
+        that the following tests don't run against a dead server).
+        '''
+        if self.external_chirc_port is not None:
+            return
+
+        for c in self.clients[:]:
+            self.disconnect_client(c)
+
+        if self.record_latency:
+            self.latency = LatencyRecorder()
+
+        if self.chirc_proc.poll() is None and self._is_pristine():
+            for entry in os.listdir(self.tmpdir):
+                path = os.path.join(self.tmpdir, entry)
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            return
+
+        try:
+            self.end_session()
+        finally:
+            self.start_session()
+
+    def _is_pristine(self, tries = 5):
+        # The server may still be processing the disconnections,
+        # so we retry a few times before giving up.
+        delay = 0.01
+        for _ in range(tries):
+            if self._check_initial_state():
+                return True
+            time.sleep(delay)
+            delay *= 2
+
+        return False
+
+    def _check_initial_state(self):
+        '''
+        Registers a user and checks that the LUSERS replies report only
+        that user. The user then QUITs, and we wait (up to the message
+        timeout) for the server to close its connection.
+        '''
+        client = self.get_client()
+        try:
+            client.send_cmd("NICK chircpool")
+            client.send_cmd("USER chircpool * * :chirc server pool")
+
+            lusers = {}
+            while replies.RPL_LUSERME not in lusers:
+                msg = client.get_message()
+                lusers[msg.cmd] = msg
+
+            luserclient = re.match(r"^:There are (\d+) users", lusers[replies.RPL_LUSERCLIENT].params[-1])
+            luserme = re.match(r"^:I have (\d+) clients", lusers[replies.RPL_LUSERME].params[-1])
+
+            pristine = (luserclient is not None and luserclient.group(1) == "1" and
+                        luserme is not None and luserme.group(1) == "1" and
+                        lusers[replies.RPL_LUSEROP].params[1] == "0" and
+                        lusers[replies.RPL_LUSERUNKNOWN].params[1] == "0" and
+                        lusers[replies.RPL_LUSERCHANNELS].params[1] == "0")
+
+            # The server's state has already been checked, so a server
+            # that is just slow to close the connection is still pristine
+            # (otherwise, on a loaded machine, the server would be
+            # restarted before every test)
+            client.send_cmd("QUIT")
+            try:
+                while True:
+                    client.get_message()
+            except (EOFError, ReplyTimeoutException):
+                pass
+
+            return pristine
+        except (ReplyTimeoutException, EOFError, KeyError, IndexError):
+            return False
+        finally:
+            self.disconnect_client(client)
+
     # Client connect/disconnect        
         
     def get_client(self, nodelay = False):
@@ -181,6 +449,13 @@ class SingleIRCSession:
             port = self.external_chirc_port
         else:
             port = self.port
+
+        # Quiescence probes are small writes that usually follow another
+        # write, so Nagle's algorithm would hold them until the previous
+        # write is ACKed (which can take tens of milliseconds)
+        if self.quiescence:
+            nodelay = True
+
         c = ChircClient(msg_timeout = self.msg_timeout, port=port, nodelay = nodelay)
         self.clients.append(c)
         return c
@@ -188,6 +463,8 @@ class SingleIRCSession:
     def disconnect_client(self, c):
         c.disconnect()
         self.clients.remove(c)
+        self.registered_clients.discard(c)
+        self.latency_marks.pop(c, None)
     
     def connect_user(self, nick, username):
         client = self.get_client()
@@ -200,14 +477,44 @@ class SingleIRCSession:
         self.verify_motd(client, nick)
         
         return client    
+
+    def connect_users(self, users):
+        '''
+        Connects several users at once. All the connections are opened, and
+        all the NICK/USER commands are sent, before verifying any replies,
+        so the registrations overlap (instead of taking one round trip per
+        user, as when calling connect_user repeatedly)
+
+        `users` is a list of (nick, username) tuples. Returns the
+        clients, in the same order.
+        '''
+        clients = [self.get_client() for _ in users]
+
+        for (nick, username), client in zip(users, clients):
+            client.send_cmd("NICK %s" % nick)
+            client.send_cmd("USER %s * * :%s" % (nick, username))
+
+        for (nick, _), client in zip(users, clients):
+            self.verify_welcome_messages(client, nick)
+            self.verify_lusers(client, nick)
+            self.verify_motd(client, nick)
+
+        return clients
     
-    def connect_clients(self, numclients, join_channel = None):
-        clients = []
-        for i in range(numclients):
-            nick = "user%i" % (i+1)
-            username = "User %s" % nick
-            client =  self.connect_user(nick, username)
-            clients.append( (nick, client) )
+    def connect_clients(self, numclients, join_channel = None, pipelined = None):
+        if pipelined is None:
+            pipelined = self.pipeline_connect
+
+        nicks = ["user%i" % (i+1) for i in range(numclients)]
+        usernames = ["User %s" % nick for nick in nicks]
+
+        if pipelined:
+            clients = list(zip(nicks, self.connect_users(list(zip(nicks, usernames)))))
+        else:
+            clients = []
+            for nick, username in zip(nicks, usernames):
+                client =  self.connect_user(nick, username)
+                clients.append( (nick, client) )
         
         if join_channel != None:
             self.join_channel(clients, join_channel)
@@ -216,6 +523,19 @@ class SingleIRCSession:
     
     def connect_and_join_channels(self, channels, aways = [], ircops = [], test_names = False):
         users = {}
+
+        if self.pipeline_connect:
+            # Register every user up front, in the order in which
+            # they would otherwise be connected below
+            nicks = []
+            for channel in [None] + sorted([k for k in channels.keys() if k is not None]):
+                for user in channels.get(channel, ()):
+                    nick = user[1:] if user[0] in ("@", "+") else user
+                    if nick not in nicks:
+                        nicks.append(nick)
+
+            clients = self.connect_users([(nick, nick) for nick in nicks])
+            users.update(zip(nicks, clients))
         
         if None in channels:
             for user in channels[None]:
@@ -398,6 +718,11 @@ class SingleIRCSession:
     def get_reply(self, client, expect_code = None, expect_nick = None, expect_nparams = None,
                   expect_short_params = None, long_param_re = None, long_param_values = None,
                   expect_timeout = False):
+        if expect_timeout and self.quiescence and client in self.registered_clients:
+            senders = self._senders_since_barrier()
+            if all(sender in self.registered_clients for sender in senders):
+                return self._verify_quiescence(client, senders)
+
         try:
             msg = client.get_message()
             
@@ -419,11 +744,126 @@ class SingleIRCSession:
             else:
                 failmsg = f"Expected a {reply_str} but did not get valid reply terminated with \\r\\n. Bytes received:\n|||{rte.bytes_received}|||"
             pytest.fail(failmsg)  
+
+        self._record_latency(client)
             
         self.verify_reply(msg, expect_code, expect_nick, expect_nparams, expect_short_params, long_param_re, long_param_values)
         
         return msg
     
+    def _last_sender(self):
+        senders = [c for c in self.clients if c.last_send is not None]
+        if len(senders) == 0:
+            return None
+        return max(senders, key = lambda c: c.last_send)
+
+    def _senders_since_barrier(self):
+        '''
+        Returns the clients that have sent something since the
+        last quiescence barrier (see _verify_quiescence)
+        '''
+        return [c for c in self.clients if c.last_send is not None and
+                (self.last_barrier is None or c.last_send > self.last_barrier)]
+
+    def _record_latency(self, client):
+        '''
+        Called after a message is read from `client`. If it is the first
+        message `client` has received since the most recent command was
+        sent, records the time it took to arrive. This is recorded under
+        the command's name (e.g., "JOIN") if `client` sent the command, and
+        with a ":relay" suffix (e.g., "JOIN:relay") if it was sent by
+        another client.
+        '''
+        if self.latency is None or client.last_recv is None:
+            return
+
+        origin = self._last_sender()
+        if origin is None or origin.last_cmd is None:
+            return
+
+        # Messages that were already waiting to be read when the command
+        # was sent cannot be a response to it, and we only want the first
+        # response to each command.
+        if client.last_recv < origin.last_send or self.latency_marks.get(client) == origin.last_send:
+            return
+        self.latency_marks[client] = origin.last_send
+
+        if client is origin:
+            cmd = origin.last_cmd
+        else:
+            cmd = origin.last_cmd + ":relay"
+
+        self.latency.record(cmd, client.last_recv - origin.last_send)
+
+    def _ping_barrier(self, client):
+        '''
+        Sends a PING with a unique token through `client`, and reads
+        messages until the corresponding PONG arrives. Since the server
+        processes a connection's commands in order, the PONG proves that
+        everything sent before the PING has been processed.
+
+        A PONG is accepted if it carries our token. chirc replies to
+        PING with just "PONG <servername>", so, as long as the server has
+        not been seen to echo the token, a PONG with a single parameter
+        (other than the token of an earlier probe) is accepted too.
+
+        Messages are read for up to QUIESCENCE_PONG_TIMEOUT seconds.
+        Returns a tuple with the messages received before the PONG, and
+        None if the PONG arrived (or, otherwise, the ReplyTimeoutException
+        or EOFError raised while waiting for it)
+        '''
+        token = "quiescence-{}".format(next(self.probe_tokens))
+        client.send_cmd("PING {}".format(token))
+
+        deadline = time.monotonic() + QUIESCENCE_PONG_TIMEOUT
+        received = []
+        while True:
+            try:
+                msg = client.get_message()
+            except ReplyTimeoutException as e:
+                if time.monotonic() < deadline:
+                    continue
+                return received, e
+            except EOFError as e:
+                return received, e
+
+            if msg.cmd == "PONG":
+                params = [p[1:] if p.startswith(":") else p for p in msg.params]
+                if token in params:
+                    self.pong_echoes_token = True
+                    return received, None
+                if (not self.pong_echoes_token and len(params) <= 1 and
+                        not any(p.startswith("quiescence-") for p in params)):
+                    return received, None
+
+            received.append(msg)
+
+    def _check_barrier_error(self, error):
+        if isinstance(error, EOFError):
+            pytest.fail("Server closed connection unexpectedly. Possible segfault in server?")
+        if isinstance(error, ReplyTimeoutException):
+            pytest.fail("Did not get a PONG for a quiescence probe within {} seconds".format(QUIESCENCE_PONG_TIMEOUT))
+
+    def _verify_quiescence(self, client, senders):
+        # If other clients have sent commands since the last barrier, make
+        # sure the server is done processing them (and relaying whatever
+        # it relays to `client`) before probing `client` itself. Messages
+        # the senders receive in the meantime are kept for the test to read.
+        for sender in senders:
+            if sender is not client:
+                received, error = self._ping_barrier(sender)
+                sender.pending.extend(received)
+                self._check_barrier_error(error)
+
+        received, error = self._ping_barrier(client)
+        self.last_barrier = time.monotonic()
+
+        if len(received) > 0:
+            pytest.fail("Was not expecting a reply, but got one:\n" + received[0].raw(bookends=True))
+        self._check_barrier_error(error)
+
+        return None
+
     def get_ERR_NEEDMOREPARAMS_reply(self, client, expect_nick, expect_cmd):
         reply = self.get_reply(client, expect_code = replies.ERR_NEEDMOREPARAMS, 
                                expect_nick = expect_nick, expect_nparams = 2,
@@ -437,6 +877,8 @@ class SingleIRCSession:
             msg = client.get_message()
         except EOFError:
             pytest.fail("Server closed connection unexpectedly. Possible segfault in server?")
+
+        self._record_latency(client)
             
         self.verify_message(msg, expect_prefix, expect_cmd, 
                            expect_nparams, expect_short_params, 
@@ -512,8 +954,9 @@ class SingleIRCSession:
             user = nick
 
         reply = self.get_reply(client, expect_code = replies.RPL_WELCOME, expect_nick = nick, expect_nparams = 1,
-                               long_param_re= "Welcome to the Internet Relay Network {}!{}.*".format(nick, user))
+                               long_param_re= "Welcome to the Internet Relay Network {}!{}.*".format(re.escape(nick), re.escape(user)))
         r.append(reply)
+        self.registered_clients.add(client)
         
         reply = self.get_reply(client, expect_code = replies.RPL_YOURHOST, expect_nick = nick, expect_nparams = 1)
         r.append(reply)
@@ -815,7 +1258,8 @@ class IRCNetworkSession:
     '''
 
     def __init__(self, chirc_exe=None, msg_timeout = 0.1,
-                 default_start_port=7776, loglevel=-1, debug=False):
+                 default_start_port=7776, loglevel=-1, debug=False,
+                 record_latency=False, event_loop=False):
 
         # We skip validating many of the parameters, because this will be done in
         # the SingleIRCSession constructor
@@ -825,31 +1269,55 @@ class IRCNetworkSession:
         self.default_start_port = default_start_port
         self.loglevel = loglevel
         self.debug = debug
+        self.record_latency = record_latency
+        self.event_loop = event_loop
         self.servers = []
 
+    @property
+    def latency(self):
+        '''
+        The latencies recorded by all the servers' sessions, combined
+        (None if latencies are not being recorded)
+        '''
+        if not self.record_latency:
+            return None
+
+        latency = LatencyRecorder()
+        for server in self.servers:
+            latency.merge(server.irc_session.latency)
+        return latency
+
     def set_servers(self, num_servers):
 
         if self.default_start_port == -1:
-            port = random.randint(10000,60000)
+            ports = get_free_ports(num_servers)
         else:
-            port = self.default_start_port
+            ports = [self.default_start_port + i for i in range(num_servers)]
 
         for i in range(num_servers):
             n = i+1
             servername = "irc-{}.example.net".format(n)
             hostname = "127.0.0.1"
-            port = port + i
+            port = ports[i]
             passwd = "passwd{}".format(n)
 
             server = IRCNetworkServer(servername, hostname, port, passwd)
             self.servers.append(server)
 
+        # Quiescence is never used in network sessions: a PING/PONG round
+        # trip only shows that one server is done with a client's commands,
+        # not that the messages it relays through other servers have
+        # arrived, so a relay that shouldn't happen could go unnoticed.
         for server in self.servers:
             session =  SingleIRCSession(chirc_exe=self.chirc_exe,
+                                        chirc_port=-1 if self.default_start_port == -1 else None,
                                         loglevel=self.loglevel,
                                         debug=self.debug,
                                         irc_network=self.servers,
-                                        irc_network_server=server)
+                                        irc_network_server=server,
+                                        quiescence=False,
+                                        record_latency=self.record_latency,
+                                        event_loop=self.event_loop)
             server.irc_session = session
 
     def start_session(self, server_idx):
@@ -2,23 +2,78 @@ import pytest
 from chirc.tests.common.sessions import SingleIRCSession
 
 
-@pytest.fixture
-def irc_session(request):   
-    chirc_exe = request.config.getoption("--chirc-exe")
-    chirc_loglevel = request.config.getoption("--chirc-loglevel")
-    chirc_port = request.config.getoption("--chirc-port")
-    external_chirc_port = request.config.getoption("--chirc-external-port")
-    
+def create_irc_session(config):
+    chirc_exe = config.getoption("--chirc-exe")
+    chirc_loglevel = config.getoption("--chirc-loglevel")
+    chirc_port = config.getoption("--chirc-port")
+    external_chirc_port = config.getoption("--chirc-external-port")
+    quiescence = config.getoption("--chirc-quiescence")
+    pipeline_connect = config.getoption("--chirc-pipeline-connect")
+    record_latency = config.getoption("--chirc-latency")
+    event_loop = config.getoption("--chirc-event-loop")
+
     session = SingleIRCSession(chirc_exe=chirc_exe,
                                loglevel=chirc_loglevel,
                                chirc_port=chirc_port,
-                               external_chirc_port=external_chirc_port)
-    
+                               external_chirc_port=external_chirc_port,
+                               quiescence=quiescence,
+                               pipeline_connect=pipeline_connect,
+                               record_latency=record_latency,
+                               event_loop=event_loop)
+
+    return session
+
+
+@pytest.fixture(scope="session")
+def irc_session_pool(request):
+    """
+    Holds the chirc server that is reused across tests when running
+    with --chirc-reuse-server (with pytest-xdist, there is one such
+    server per worker)
+    """
+    pool = []
+
+    def fin():
+        for session in pool:
+            session.end_session()
+
+    request.addfinalizer(fin)
+
+    return pool
+
+
+@pytest.fixture
+def irc_session(request, irc_session_pool):
+    reuse_server = request.config.getoption("--chirc-reuse-server")
+    external_chirc_port = request.config.getoption("--chirc-external-port")
+
+    if reuse_server and external_chirc_port is None:
+        if len(irc_session_pool) == 0:
+            irc_session_pool.append(create_irc_session(request.config))
+
+        session = irc_session_pool[0]
+
+        # The server will not be running if it could not be restarted
+        # after the previous test (see SingleIRCSession.reset_session)
+        if not session.started:
+            session.start_session()
+
+        def fin():
+            session.reset_session()
+
+        request.addfinalizer(fin)
+        request.node.chirc_session = session
+
+        return session
+
+    session = create_irc_session(request.config)
+
     session.start_session()
-    
+
     def fin():
         session.end_session()
-        
-    request.addfinalizer(fin)    
-    
+
+    request.addfinalizer(fin)
+    request.node.chirc_session = session
+
     return session
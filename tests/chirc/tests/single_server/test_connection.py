@@ -617,8 +617,24 @@ class TestMultiuserConnection(object):
         client2.send_cmd("NICK user1")
         reply = irc_session.get_reply(client2, expect_code = replies.ERR_NICKNAMEINUSE, expect_nick = "*", expect_nparams = 2,
                                       expect_short_params = ["user1"],
-                                      long_param_re = "Nickname is already in use")     
-        
+                                      long_param_re = "Nickname is already in use")
+
+    def test_connect_duplicate_nick_casemapping(self, irc_session):
+        """
+        Like test_connect_duplicate_nick, but the second client's
+        nickname only differs from the first client's in case
+        (using the RFC 1459 casemapping, where []\\ are the
+        uppercase versions of {}|)
+        """
+
+        client1 = irc_session.connect_user("user[1]", "User One")
+
+        client2 = irc_session.get_client()
+        client2.send_cmd("NICK USER{1}")
+        reply = irc_session.get_reply(client2, expect_code = replies.ERR_NICKNAMEINUSE, expect_nick = "*", expect_nparams = 2,
+                                      expect_short_params = ["USER{1}"],
+                                      long_param_re = "Nickname is already in use")
+
 
 @pytest.mark.category("CONNECTION_REGISTRATION")            
 class TestQUIT(object):  
@@ -1,3 +1,4 @@
+import threading
 import pytest
 from chirc import replies
 
@@ -164,6 +165,64 @@ class TestRobustness(object):
             assert len(privmsg.raw()) == 510
             relayed_msg = privmsg.params[-1]
             assert relayed_msg[0] == ":"
-            assert msg.startswith(relayed_msg[1:])               
-           
+            assert msg.startswith(relayed_msg[1:])
 
+
+@pytest.mark.category("STRESS")
+class TestStress(object):
+    """
+    Stress tests. These are not part of any rubric (they are not graded),
+    and are skipped unless pytest is run with --chirc-stress.
+    """
+
+    def test_stress_channels1(self, irc_session):
+        """
+        Connect 40 clients, split them across 10 channels, and have all of
+        them send 50 messages to their channel at the same time (each client
+        sends its messages from its own thread). Every client must receive,
+        in the order they were sent, all the messages sent by the other
+        users in its channel.
+        """
+
+        nclients = 40
+        nchannels = 10
+        nmsgs = 50
+
+        clients = irc_session.connect_clients(nclients)
+
+        channels = {}
+        for i, (nick, client) in enumerate(clients):
+            channels.setdefault("#stress%i" % (i % nchannels), []).append( (nick, client) )
+
+        for channel, members in channels.items():
+            irc_session.join_channel(members, channel)
+
+        def send_msgs(nick, client, channel):
+            for i in range(nmsgs):
+                client.send_cmd("PRIVMSG %s :%s %i" % (channel, nick, i))
+
+        threads = []
+        for channel, members in channels.items():
+            for nick, client in members:
+                threads.append(threading.Thread(target=send_msgs, args=(nick, client, channel)))
+
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        for channel, members in channels.items():
+            for nick, client in members:
+                expected = {other: 0 for other, _ in members if other != nick}
+
+                for _ in range(nmsgs * len(expected)):
+                    msg = irc_session.get_message(client, expect_prefix = True, expect_cmd = "PRIVMSG",
+                                                  expect_nparams = 2, expect_short_params = [channel])
+                    from_nick, n = msg.params[-1][1:].split()
+
+                    assert from_nick in expected, "Unexpected PRIVMSG: " + msg.raw(bookends=True)
+                    assert int(n) == expected[from_nick], \
+                        "Expected message {} from {}, got: {}".format(expected[from_nick], from_nick, msg.raw(bookends=True))
+                    expected[from_nick] += 1
+
+                irc_session.get_reply(client, expect_timeout = True)
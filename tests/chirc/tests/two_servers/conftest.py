@@ -7,15 +7,20 @@ def irc_network_session(request):
     chirc_exe = request.config.getoption("--chirc-exe")
     chirc_loglevel = request.config.getoption("--chirc-loglevel")
     chirc_port = request.config.getoption("--chirc-port")
+    record_latency = request.config.getoption("--chirc-latency")
+    event_loop = request.config.getoption("--chirc-event-loop")
 
     session = IRCNetworkSession(chirc_exe=chirc_exe,
                                 loglevel=chirc_loglevel,
-                                default_start_port=chirc_port)
+                                default_start_port=chirc_port,
+                                record_latency=record_latency,
+                                event_loop=event_loop)
 
     def fin():
         session.end_sessions()
         
     request.addfinalizer(fin)    
+    request.node.chirc_session = session
     
     return session
 
@@ -1,7 +1,3 @@
-import re
-
-
-
 class CouldNotStartChircException(Exception):
     pass
 
@@ -26,62 +22,168 @@ class MessageNotWellFormedException(Exception):
 class PrefixNotWellFormedException(Exception):
     pass
 
+# Sentinel for fields that have not been materialized yet
+_UNSET = object()
+
 class IRCPrefix(object):
+    __slots__ = ("_s", "nick", "username", "hostname")
+
     def __init__(self, s):
         self._s = s
         
         self.nick = self.username = self.hostname = None
+
+        bang = s.find("!")
+        at = s.find("@")
         
-        if not "@" in s and not "!" in s:
+        if bang == -1 and at == -1:
             self.nick = s[1:]
             self.hostname = s[1:]
-        elif "@" in s and "!" in s:
-            match = re.match("^:(?P<nick>[^!@]+)!(?P<username>[^!@]+)@(?P<hostname>[^!@]+)$", s)
-            if match == None:
-                raise PrefixNotWellFormedException()
-            else:
-                # TODO: This could be validated further
-                self.nick = match.group("nick")
-                self.username = match.group("username")
-                self.hostname = match.group("hostname")                
+        elif _is_valid_user_prefix(s, len(s), bang, at):
+            # TODO: This could be validated further
+            self.nick = s[1:bang]
+            self.username = s[bang+1:at]
+            self.hostname = s[at+1:]
         else:
             raise PrefixNotWellFormedException()
 
+
+def _is_valid_user_prefix(s, end, bang, at):
+    """
+    Checks that s[:end] has the form ":nick!username@hostname", where
+    `bang` and `at` are the positions of the first "!" and "@" in s[:end].
+    This is equivalent to matching this regular expression:
+
+        ^:(?P<nick>[^!@]+)!(?P<username>[^!@]+)@(?P<hostname>[^!@]+)$
+
+    Works on both str and bytes.
+    """
+    return (bang >= 2 and at >= bang + 2 and at < end - 1 and
+            s.count(s[bang:bang+1], bang + 1, end) == 0 and
+            s.count(s[at:at+1], at + 1, end) == 0)
+
+
 class IRCMessage(object):
+    """
+    An IRC message, parsed from a line terminated by \\r\\n (either
+    bytes, which are used without being copied or decoded as a whole,
+    or a str).
+
+    The structure of the message (including the prefix) is validated
+    when the object is created, but the prefix, command, and parameters
+    are only decoded the first time they are accessed.
+    """
+    __slots__ = ("_buf", "_prefix_end", "_bang", "_at", "_cmd_end", "_prefix", "_cmd", "_params")
+
     def __init__(self, s):
-        if s[-2:] != "\r\n":
-            raise MessageNotWellFormedException("Message does not end in \\r\\n", s)
-        
-        self._s = s[:-2]
-        
-        if len(self._s) == 0:
-            raise MessageNotWellFormedException("Entire message is just \\r\\n", s)
-        
-        fields = self._s.split(" ")
-               
-        if fields[0][0] == ":":
-            if len(fields) == 1: 
-                raise MessageNotWellFormedException("Message contains a prefix but no command.", s)
-            self.prefix = IRCPrefix(fields[0])
-            self.cmd = fields[1]
-            p = 2
+        if isinstance(s, bytes):
+            buf = s
+        elif isinstance(s, str):
+            buf = s.encode()
         else:
-            self.prefix = None
-            self.cmd = fields[0]
-            p = 1
-            
-        self.params = []
+            buf = bytes(s)
+
+        if not buf.endswith(b"\r\n"):
+            raise MessageNotWellFormedException("Message does not end in \\r\\n", buf.decode())
+
+        end = len(buf) - 2
         
-        while p < len(fields):
-            if fields[p][0] == ":":
-                self.params.append(" ".join(fields[p:]))
-                break
+        if end == 0:
+            raise MessageNotWellFormedException("Entire message is just \\r\\n", buf.decode())
+
+        if buf[0] == 0x3A:   # ":"
+            prefix_end = buf.find(b" ", 0, end)
+            if prefix_end == -1:
+                raise MessageNotWellFormedException("Message contains a prefix but no command.", buf.decode())
+
+            bang = buf.find(b"!", 0, prefix_end)
+            at = buf.find(b"@", 0, prefix_end)
+            if (bang != -1 or at != -1) and not _is_valid_user_prefix(buf, prefix_end, bang, at):
+                raise PrefixNotWellFormedException()
+
+            self._bang = bang
+            self._at = at
+            self._prefix = _UNSET
+        else:
+            prefix_end = -1
+            self._prefix = None
+
+        cmd_end = buf.find(b" ", prefix_end + 1, end)
+        if cmd_end == -1:
+            cmd_end = end
+
+        self._buf = buf
+        self._prefix_end = prefix_end
+        self._cmd_end = cmd_end
+        self._cmd = None
+        self._params = None
+
+    @property
+    def prefix(self):
+        prefix = self._prefix
+        if prefix is _UNSET:
+            # The prefix was already validated, so we don't go
+            # through IRCPrefix's constructor
+            buf = self._buf
+            prefix = IRCPrefix.__new__(IRCPrefix)
+            prefix._s = buf[:self._prefix_end].decode()
+            if self._bang == -1:
+                prefix.nick = prefix.hostname = prefix._s[1:]
+                prefix.username = None
             else:
-                self.params.append(fields[p])
-                p += 1
+                prefix.nick = buf[1:self._bang].decode()
+                prefix.username = buf[self._bang+1:self._at].decode()
+                prefix.hostname = buf[self._at+1:self._prefix_end].decode()
+            self._prefix = prefix
+        return prefix
+
+    @property
+    def cmd(self):
+        cmd = self._cmd
+        if cmd is None:
+            cmd = self._cmd = self._buf[self._prefix_end+1:self._cmd_end].decode()
+        return cmd
+
+    @property
+    def params(self):
+        params = self._params
+        if params is None:
+            params = self._params = self._parse_params()
+        return params
+
+    def _parse_params(self):
+        buf = self._buf
+        end = len(buf) - 2
+        start = self._cmd_end + 1
+
+        if start > end:
+            return []
+
+        # The long parameter (if any) is kept with its leading ":"
+        if buf[start] == 0x3A:
+            return [buf[start:end].decode()]
+
+        longparam = buf.find(b" :", start, end)
+        if longparam == -1:
+            fields = buf[start:end].split(b" ")
+        else:
+            fields = buf[start:longparam].split(b" ")
+
+        if b"" in fields:
+            raise MessageNotWellFormedException("Message contains an empty parameter", self._s)
+
+        params = [f.decode() for f in fields]
+        if longparam != -1:
+            params.append(buf[longparam+1:end].decode())
+
+        return params
+
+    @property
+    def _s(self):
+        return self._buf[:-2].decode()
                 
     def raw(self, bookends = False):
         if not bookends:
             return self._s
         else:
-            return "|||{}|||".format(self._s)
\ No newline at end of file
+            return "|||{}|||".format(self._s)
@@ -3,6 +3,8 @@ import json
 import pytest
 import os.path
 
+from chirc.latency import LatencyRecorder
+
 def pytest_addoption(parser):
     parser.addoption("--chirc-category", action="store", metavar="CATEGORY_ID",
         help="only run tests in category CATEGORY_ID.")
@@ -16,6 +18,18 @@ def pytest_addoption(parser):
         help="port to run chirc on (use -1 to use a random port in each test)")
     parser.addoption("--chirc-external-port", action="store", type=int,
                      help="Do not launch chirc, and instead connect to chirc on this port")
+    parser.addoption("--chirc-reuse-server", action="store_true",
+                     help="reuse the same chirc process across tests (restarting it only if it is not reset to its initial state)")
+    parser.addoption("--chirc-pipeline-connect", action="store_true",
+                     help="when a test needs several users, register all of them at once instead of one at a time")
+    parser.addoption("--chirc-quiescence", action="store_true",
+                     help="when checking that no reply is sent, use a PING/PONG round trip instead of waiting for a timeout (single-server tests only)")
+    parser.addoption("--chirc-event-loop", action="store_true",
+                     help="run chirc with -e (handling all the connections with an event loop)")
+    parser.addoption("--chirc-latency", action="store_true",
+                     help="record the latency of the server's replies to each command (included in the JSON report)")
+    parser.addoption("--chirc-stress", action="store_true",
+                     help="also run the stress tests (category STRESS). These are not part of any rubric, so they are never run otherwise")
     parser.addoption("--generate-alltests-file", action="store", type=str, default=None,
                      help="Generate file with all the test categories and names")
 
@@ -49,6 +63,10 @@ def pytest_collection_finish(session):
 
 
 def pytest_runtest_setup(item):
+    category_marker = item.get_closest_marker("category")
+    if category_marker is not None and category_marker.args[0] == "STRESS" and not item.config.getoption("--chirc-stress"):
+        pytest.skip("Stress tests only run with --chirc-stress")
+
     rubric_categories = item.session.rubric_categories
     only_category = item.config.getoption("--chirc-category")
     if only_category is not None or rubric_categories is not None:
@@ -64,4 +82,25 @@ def pytest_runtest_setup(item):
 def pytest_json_runtest_metadata(item, call):
     category = item.get_closest_marker("category").args[0]
 
-    return {'category': category}
\ No newline at end of file
+    metadata = {'category': category}
+
+    session = getattr(item, "chirc_session", None)
+    if call.when == "call" and session is not None and session.latency is not None:
+        metadata['latency'] = session.latency.to_dict()
+
+    return metadata
+
+
+def pytest_json_modifyreport(json_report):
+    # Combine the latencies recorded in each test (which, with pytest-xdist,
+    # may have run in different workers) into a single profile of the server
+    latency = None
+    for test in json_report.get("tests", []):
+        test_latency = test.get("metadata", {}).get("latency")
+        if test_latency is not None:
+            if latency is None:
+                latency = LatencyRecorder()
+            latency.merge(LatencyRecorder.from_dict(test_latency))
+
+    if latency is not None:
+        json_report["chirc_latency"] = latency.to_dict()
\ No newline at end of file
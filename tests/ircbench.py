@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+
+"""
+ircbench: load generator for chirc
+
+Connects N users to a running chirc server, spreads them across M
+channels, and then drives a mix of PRIVMSG/JOIN/PART/NICK commands at
+a target rate. Every channel PRIVMSG carries the time at which it was
+sent, so each user that receives it can measure the fan-out latency.
+
+Example (with chirc already running on port 6667):
+
+    ./ircbench.py --port 6667 --users 500 --channels 20 --rate 2000 --duration 30
+"""
+
+import asyncio
+import json
+import math
+import random
+import time
+import click
+
+from chirc.client import AsyncChircClient
+from chirc.types import ReplyTimeoutException
+import chirc.replies as replies
+
+# Prefix of the PRIVMSG bodies sent by ircbench
+BODY_TAG = "ircbench"
+
+
+class BenchUser:
+
+    def __init__(self, idx, client):
+        self.idx = idx
+        self.nick = "bench{}".format(idx)
+        self.nick_changes = 0
+        self.client = client
+        self.channels = set()
+
+
+class Stats:
+
+    def __init__(self):
+        self.sent = {"PRIVMSG": 0, "JOIN": 0, "PART": 0, "NICK": 0}
+        self.expected_deliveries = 0
+        self.latencies = []
+        self.errors = 0
+
+    def percentile(self, p):
+        if len(self.latencies) == 0:
+            return None
+        latencies = sorted(self.latencies)
+        k = min(len(latencies) - 1, max(0, int(round(p / 100.0 * len(latencies))) - 1))
+        return latencies[k]
+
+
+def parse_mix(mix):
+    weights = {}
+    for entry in mix.split(","):
+        cmd, _, weight = entry.partition("=")
+        cmd = cmd.strip().upper()
+        if cmd not in ("PRIVMSG", "JOIN", "PART", "NICK"):
+            raise click.BadParameter("Unknown command in mix: {}".format(cmd))
+        try:
+            weights[cmd] = float(weight)
+        except ValueError:
+            raise click.BadParameter("Invalid weight for {}: {}".format(cmd, weight))
+        if not math.isfinite(weights[cmd]) or weights[cmd] < 0:
+            raise click.BadParameter("Invalid weight for {}: {}".format(cmd, weight))
+    if sum(weights.values()) <= 0:
+        raise click.BadParameter("At least one command in the mix must have a positive weight")
+    return weights
+
+
+async def wait_for(client, codes, timeout):
+    """
+    Reads messages until one of the given commands/reply codes
+    arrives (answering PINGs in the meantime)
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            msg = await client.get_message()
+        except ReplyTimeoutException:
+            continue
+        if msg.cmd == "PING":
+            await client.send_cmd("PONG {}".format(" ".join(msg.params)))
+        elif msg.cmd in codes:
+            return msg
+    raise RuntimeError("Timed out waiting for {}".format("/".join(codes)))
+
+
+async def connect_user(host, port, idx, channels, timeout):
+    client = await AsyncChircClient(host=host, port=port, msg_timeout=timeout, nodelay=True).connect()
+    user = BenchUser(idx, client)
+
+    await client.send_cmd("NICK {}".format(user.nick))
+    await client.send_cmd("USER {} * * :ircbench user {}".format(user.nick, idx))
+    await wait_for(client, (replies.RPL_ENDOFMOTD, replies.ERR_NOMOTD), timeout)
+
+    channel = channels[idx % len(channels)]
+    await client.send_cmd("JOIN {}".format(channel))
+    await wait_for(client, (replies.RPL_ENDOFNAMES,), timeout)
+    user.channels.add(channel)
+
+    return user
+
+
+async def reader(user, stats):
+    client = user.client
+    while True:
+        try:
+            msg = await client.get_message()
+        except ReplyTimeoutException:
+            continue
+        except EOFError:
+            return
+
+        if msg.cmd == "PING":
+            await client.send_cmd("PONG {}".format(" ".join(msg.params)))
+        elif msg.cmd == "PRIVMSG":
+            fields = msg.params[-1][1:].split(" ")
+            if len(fields) == 3 and fields[0] == BODY_TAG:
+                stats.latencies.append(time.monotonic_ns() - int(fields[1]))
+        elif msg.cmd == "ERROR" or (len(msg.cmd) == 3 and msg.cmd[0] in "45"):
+            stats.errors += 1
+
+
+async def driver(users, channels, weights, rate, duration, stats):
+    members = {channel: set() for channel in channels}
+    for user in users:
+        for channel in user.channels:
+            members[channel].add(user.idx)
+
+    cmds = list(weights.keys())
+    cmd_weights = [weights[cmd] for cmd in cmds]
+
+    interval = 1.0 / rate
+    start = time.monotonic()
+    next_send = start
+    seq = 0
+
+    while time.monotonic() - start < duration:
+        user = random.choice(users)
+        cmd = random.choices(cmds, cmd_weights)[0]
+
+        # Fall back to a PRIVMSG if the chosen command doesn't make
+        # sense for this user right now
+        if cmd == "PART" and len(user.channels) <= 1:
+            cmd = "PRIVMSG"
+        if cmd == "JOIN" and len(user.channels) == len(channels):
+            cmd = "PRIVMSG"
+
+        if cmd == "PRIVMSG":
+            channel = random.choice(sorted(user.channels))
+            seq += 1
+            body = "{} {} {}".format(BODY_TAG, time.monotonic_ns(), seq)
+            await user.client.send_cmd("PRIVMSG {} :{}".format(channel, body))
+            stats.expected_deliveries += len(members[channel]) - 1
+        elif cmd == "JOIN":
+            channel = random.choice(sorted(set(channels) - user.channels))
+            await user.client.send_cmd("JOIN {}".format(channel))
+            user.channels.add(channel)
+            members[channel].add(user.idx)
+        elif cmd == "PART":
+            channel = random.choice(sorted(user.channels))
+            await user.client.send_cmd("PART {}".format(channel))
+            user.channels.remove(channel)
+            members[channel].discard(user.idx)
+        elif cmd == "NICK":
+            user.nick_changes += 1
+            user.nick = "bench{}-{}".format(user.idx, user.nick_changes)
+            await user.client.send_cmd("NICK {}".format(user.nick))
+
+        stats.sent[cmd] += 1
+
+        next_send += interval
+        delay = next_send - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    return time.monotonic() - start
+
+
+async def run(host, port, num_users, num_channels, rate, duration, weights, timeout, grace):
+    channels = ["#bench{}".format(i) for i in range(num_channels)]
+    stats = Stats()
+
+    print("Connecting {} users to {}:{}...".format(num_users, host, port))
+    start = time.monotonic()
+    users = await asyncio.gather(*[connect_user(host, port, i, channels, timeout)
+                                   for i in range(num_users)])
+    connect_time = time.monotonic() - start
+    print("Connected in {:.2f} seconds".format(connect_time))
+
+    readers = [asyncio.create_task(reader(user, stats)) for user in users]
+
+    print("Running for {} seconds at {} commands/second...".format(duration, rate))
+    elapsed = await driver(users, channels, weights, rate, duration, stats)
+
+    # Give in-flight messages a chance to be delivered
+    await asyncio.sleep(grace)
+
+    for task in readers:
+        task.cancel()
+    for user in users:
+        await user.client.disconnect()
+
+    return stats, elapsed, connect_time
+
+
+@click.command(name="ircbench")
+@click.option("--host", default="localhost", help="Host chirc is running on")
+@click.option("--port", type=int, default=6667, help="Port chirc is listening on")
+@click.option("--users", "num_users", type=int, default=100, help="Number of users (N)")
+@click.option("--channels", "num_channels", type=int, default=10, help="Number of channels (M)")
+@click.option("--rate", type=float, default=1000.0, help="Target rate (commands/second, across all users)")
+@click.option("--duration", type=float, default=10.0, help="Duration of the run (seconds)")
+@click.option("--mix", default="privmsg=90,join=4,part=4,nick=2",
+              help="Relative weights of the commands to send")
+@click.option("--timeout", type=float, default=5.0, help="Timeout for registering/joining (seconds)")
+@click.option("--grace", type=float, default=1.0,
+              help="Time to wait for in-flight messages at the end of the run (seconds)")
+@click.option("--seed", type=int, default=None, help="Random seed")
+@click.option("--json-file", type=click.File("w"), default=None, help="Also write the results to this JSON file")
+def cmd(host, port, num_users, num_channels, rate, duration, mix, timeout, grace, seed, json_file):
+    if num_users < 1 or num_channels < 1 or rate <= 0:
+        raise click.BadParameter("--users, --channels, and --rate must be positive")
+
+    weights = parse_mix(mix)
+    random.seed(seed)
+
+    stats, elapsed, connect_time = asyncio.run(run(host, port, num_users, num_channels,
+                                                   rate, duration, weights, timeout, grace))
+
+    sent = sum(stats.sent.values())
+    delivered = len(stats.latencies)
+
+    results = {
+        "users": num_users,
+        "channels": num_channels,
+        "connect_time": connect_time,
+        "elapsed": elapsed,
+        "sent": stats.sent,
+        "commands_per_second": sent / elapsed,
+        "expected_deliveries": stats.expected_deliveries,
+        "deliveries": delivered,
+        "deliveries_per_second": delivered / elapsed,
+        "errors": stats.errors,
+        "latency_ms": {}
+    }
+    for p in (50, 99, 99.9):
+        latency = stats.percentile(p)
+        results["latency_ms"]["p{}".format(str(p).replace(".", ""))] = None if latency is None else latency / 1e6
+
+    print("=" * 60)
+    print("%-30s %s" % ("Commands sent", ", ".join("{} {}".format(k, v) for k, v in stats.sent.items())))
+    print("%-30s %.1f" % ("Commands/second", results["commands_per_second"]))
+    print("%-30s %i / %i" % ("Deliveries (received/expected)", delivered, stats.expected_deliveries))
+    print("%-30s %.1f" % ("Deliveries/second", results["deliveries_per_second"]))
+    print("%-30s %i" % ("Error replies", stats.errors))
+    for name, latency in results["latency_ms"].items():
+        if latency is None:
+            print("%-30s -" % ("Fan-out latency " + name))
+        else:
+            print("%-30s %.3f ms" % ("Fan-out latency " + name, latency))
+    print("=" * 60)
+
+    if json_file is not None:
+        json.dump(results, json_file, indent=2)
+
+if __name__ == "__main__":
+    cmd()